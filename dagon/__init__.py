@@ -22,8 +22,21 @@ from dagon.batch import Batch
 from dagon.batch import Slurm
 from dagon.communication.data_transfer import GlobusManager
 from dagon.communication.data_transfer import SKYCDS
+from dagon.communication import ConnectivityWaiter
+from dagon.communication.ssh import SSHConnectionPool
+from dagon.communication.transfer import SFTPTransferEngine
+from dagon.communication.tarpipe import TarPipe
 from dagon.docker_task import DockerRemoteTask
 from dagon.remote import RemoteTask
+from dagon.scheduler import ReadyQueueScheduler
+from dagon.slots import SlotManager
+from dagon.hostinfo import HostInfoCache
+from dagon.graph import validate, CycleError
+from dagon.staging import StagingEngine, StagingCache, DeltaSync
+from dagon.lineage import LineageIndex
+from dagon.scratch import ScratchManager
+from dagon.slurm import SlurmMonitor, PackManager
+from dagon.expansion import Expansion
 
 
 class Status(Enum):
@@ -44,6 +57,18 @@ class Status(Enum):
     FAILED = "FAILED"
 
 
+class SchedulerType(Enum):
+    """
+    Possible ways to schedule the tasks of a :class:`dagon.Workflow`
+
+    :cvar THREADS: Each task runs on its own thread waiting for its dependencies
+    :cvar READY_QUEUE: A bounded pool of workers executes the tasks when its dependencies are resolved
+    """
+
+    THREADS = 0
+    READY_QUEUE = 1
+
+
 class Workflow(object):
     """
     **Represents a workflow executed by DagOn**
@@ -66,7 +91,11 @@ class Workflow(object):
 
     SCHEMA = "workflow://"
 
-    def __init__(self, name, config=None, config_file='dagon.ini', max_threads=10, jsonload=None):
+    # Replaced by each item in the command of a task in map mode
+    ITEM = "{item}"
+
+    def __init__(self, name, config=None, config_file='dagon.ini', max_threads=10, jsonload=None,
+                 scheduler=None):
         """
         Create a workflow
 
@@ -78,6 +107,12 @@ class Workflow(object):
 
         :param config_file: Path to the configuration file of the workflow. By default, try to loads 'dagon.ini'
         :type config_file: str
+
+        :param max_threads: Maximum number of tasks executed at the same time
+        :type max_threads: int
+
+        :param scheduler: How the tasks are scheduled. By default, one thread per task
+        :type scheduler: :class:`dagon.SchedulerType`
         """
 
         if config is not None:
@@ -85,7 +120,24 @@ class Workflow(object):
         else:
             self.cfg = read_config(config_file)
             fileConfig(config_file)
-        self.sem = threading.Semaphore(max_threads)
+        self.max_threads = max_threads
+        self.slots = SlotManager(max_threads, self.cfg.get('slots'))
+        try:
+            self.host_info = HostInfoCache(self.cfg['context']['ttl'])
+        except KeyError:
+            self.host_info = HostInfoCache()
+        if self.cfg.get('ssh') is not None:
+            SSHConnectionPool.configure(self.cfg['ssh'].get('max_sessions'), self.cfg['ssh'].get('keepalive'),
+                                        self.cfg['ssh'].get('connect_timeout'))
+        self.staging_cache = None
+        staging = self.cfg.get('staging')
+        if staging is not None and staging.get('cache') == "True":
+            self.staging_cache = StagingCache(staging.get('cache_dir', self.cfg['batch']['scratch_dir_base'] +
+                                                          "/.dagon-cache"),
+                                              int(staging.get('cache_size', 10 * 1024 ** 3)))
+        self.lineage = LineageIndex()
+        self.scratch = ScratchManager.from_config(self.cfg)
+        self.scheduler = scheduler if scheduler is not None else SchedulerType.THREADS
         # supress some logs
         logging.getLogger("paramiko").setLevel(logging.WARNING)
         logging.getLogger("globus_sdk").setLevel(logging.WARNING)
@@ -93,7 +145,13 @@ class Workflow(object):
         self.logger = logging.getLogger()
         self.dag_tps = None
         self.dry = False
+        self.overhead_accounting = False
         self.tasks = []
+        self.tasks_by_name = {}
+        self.expansions = []
+        self.expansion_lock = threading.Lock()
+        self.runner = None
+        self.topology = None
         self.capio_server_path = None
         self.capio_libcapioposix_path = None
         self.workflow_id = 0
@@ -141,6 +199,19 @@ class Workflow(object):
     def set_dry(self, dry):
         self.dry = dry
 
+    def get_overhead_accounting(self):
+        return self.overhead_accounting
+
+    def set_overhead_accounting(self, overhead_accounting):
+        """
+        Enable the accounting of the time spent by each task in scheduling, context discovery, staging,
+        script generation and execution
+
+        :param overhead_accounting: True to account the overhead
+        :type overhead_accounting: bool
+        """
+        self.overhead_accounting = overhead_accounting
+
     def get_data_mover(self):
         return self.data_mover
 
@@ -150,6 +221,95 @@ class Workflow(object):
     def set_stager_mover(self, stager_mover):
         self.stager_mover = stager_mover
 
+    def get_slot_manager(self):
+        return self.slots
+
+    def set_slot_manager(self, slot_manager):
+        """
+        Plug the manager of the execution slots used by the tasks of this workflow
+
+        :param slot_manager: :class:`dagon.slots.SlotManager` instance
+        :type slot_manager: :class:`dagon.slots.SlotManager`
+        """
+        self.slots = slot_manager
+        for task in self.tasks:
+            task.set_slot_manager(slot_manager)
+
+    def set_slot_limit(self, kind, limit):
+        """
+        Change the maximum number of tasks holding a kind of execution slot at the same time
+
+        :param kind: kind of slot (batch, slurm, ssh, docker, cloud)
+        :type kind: str
+
+        :param limit: maximum number of tasks (per host for the ssh slots)
+        :type limit: int
+        """
+        self.slots.set_limit(kind, limit)
+
+    def set_host_info_cache(self, host_info):
+        """
+        Set the cache of the context discovered on each host
+
+        :param host_info: :class:`dagon.hostinfo.HostInfoCache` instance
+        :type host_info: :class:`dagon.hostinfo.HostInfoCache`
+        """
+        self.host_info = host_info
+
+    def get_staging_cache(self):
+        return self.staging_cache
+
+    def set_staging_cache(self, staging_cache):
+        """
+        Set the store of the files staged in by the native staging engine, None to copy them
+
+        :param staging_cache: :class:`dagon.staging.StagingCache` instance
+        :type staging_cache: :class:`dagon.staging.StagingCache`
+        """
+        self.staging_cache = staging_cache
+
+    def get_scratch_manager(self):
+        """
+        Returns the manager removing the scratch directories of the tasks
+
+        :return: the scratch manager
+        :rtype: :class:`dagon.scratch.ScratchManager`
+        """
+        return self.scratch
+
+    def set_scratch_retention(self, names):
+        """
+        Keep the scratch directory of some tasks after the workflow ends
+
+        :param names: names of the tasks
+        :type names: list(str)
+        """
+        self.scratch.set_retention(names)
+
+    def get_lineage(self):
+        """
+        Returns the producer and the consumers of the files exchanged by the tasks
+
+        :return: the lineage index
+        :rtype: :class:`dagon.lineage.LineageIndex`
+        """
+        return self.lineage
+
+    def invalidate_host_info(self, host=None):
+        """
+        Forget the context discovered on the hosts, it will be discovered again by the next task
+
+        :param host: host to forget. By default, all of them
+        :type host: str
+        """
+        self.host_info.invalidate(host)
+
+    def get_scheduler(self):
+        return self.scheduler
+
+    def set_scheduler(self, scheduler):
+        self.scheduler = scheduler
+
     def set_capio_server_path(self, path):
         self.capio_server_path = path
 
@@ -187,14 +347,7 @@ class Workflow(object):
 
         # Check if the workflow is the current one
         if workflow_name == self.name:
-
-            # For each task in the tasks collection
-            for task in self.tasks:
-
-                # Check the task name
-                if task_name == task.name:
-                    # Return the result
-                    return task
+            return self.tasks_by_name.get(task_name)
 
         return None
 
@@ -211,10 +364,65 @@ class Workflow(object):
             task.set_stager_mover(self.stager_mover)
 
         self.tasks.append(task)
+        self.tasks_by_name.setdefault(task.name, task)
         task.set_workflow(self)
+        task.set_slot_manager(self.slots)
+        task.index_references()
         if self.is_api_available:
             self.api.add_task(self.workflow_id, task)
 
+    def expand(self, parent, children, limit=None):
+        """
+        Add tasks to the workflow while it is executed. The tasks depend on the task expanded and the tasks
+        depending on it also depend on all of them. Only the dependencies of the tasks added are resolved,
+        the rest of the graph is not changed
+
+        :param parent: task expanded, it is being executed
+        :type parent: :class:`dagon.task.Task`
+
+        :param children: tasks to be added
+        :type children: list(:class:`dagon.task.Task`)
+
+        :param limit: maximum number of tasks added executed at the same time
+        :type limit: int
+
+        :return: the expansion
+        :rtype: :class:`dagon.expansion.Expansion`
+        """
+        with self.expansion_lock:
+            gathers = []
+            for task in parent.nexts:
+                if task not in gathers:
+                    gathers.append(task)
+            expansion = Expansion(parent, children, gathers, limit)
+            for child in children:
+                child.expansion = expansion
+                self.add_task(child)
+                child.set_dag_tps(self.dag_tps)
+                child.pre_run()
+                child.add_dependency_to(parent)
+                for gather in gathers:
+                    gather.add_dependency_to(child)
+            self.expansions.append(expansion)
+
+        if self.runner is not None:
+            self.runner.insert(expansion)
+        else:
+            for child in children:
+                child.start()
+        return expansion
+
+    def on_submitted(self, task):
+        """
+        Called when the job of a task is submitted to a batch system, the tasks chained to it can be submitted
+        before it ends
+
+        :param task: task submitted
+        :type task: :class:`dagon.task.Task`
+        """
+        if self.runner is not None:
+            self.runner.on_submitted(task)
+
     def set_dag_tps(self, DAG_tps):
         """
         Set the DAG_tps workflow which execute this workflow
@@ -238,7 +446,7 @@ class Workflow(object):
         # Automatically detect dependencies
         for task in self.tasks:
             # Invoke pre run
-            task.set_semaphore(self.sem)
+            task.set_slot_manager(self.slots)
             task.set_dag_tps(self.dag_tps)
             task.pre_run()
         self.Validate_WF()
@@ -371,6 +579,28 @@ class Workflow(object):
 
         self.tasks[0].on_execute(script, "run_pipeline.sh")
 
+    def overhead_report(self):
+        """
+        Return the engine overhead vs. compute report of the workflow. The time spent executing the
+        launcher scripts is accounted as compute, the rest as engine overhead
+
+        :return: time spent by each task in each phase, totals and overhead ratio
+        :rtype: dict(str, object)
+        """
+        report = {"name": self.name, "tasks": {}, "phases": {}, "overhead": 0.0, "compute": 0.0}
+        for task in self.tasks:
+            phases = dict(task.overhead)
+            report['tasks'][task.name] = phases
+            for phase, seconds in phases.items():
+                report['phases'][phase] = report['phases'].get(phase, 0.0) + seconds
+                if phase == "execution":
+                    report['compute'] += seconds
+                else:
+                    report['overhead'] += seconds
+        total = report['overhead'] + report['compute']
+        report['overhead_ratio'] = report['overhead'] / total if total > 0 else 0.0
+        return report
+
     def remove_all_task_reference_workflow(self):
         for task in self.tasks:
             task.remove_reference_workflow()
@@ -379,20 +609,52 @@ class Workflow(object):
     def run(self):
         self.logger.debug("Running workflow: %s", self.name)
         start_time = time()
-        for task in self.tasks:
-            try:
-                task.start()
-            except:
-                pass
+        if self.scheduler == SchedulerType.READY_QUEUE:
+            self.runner = ReadyQueueScheduler(self, self.max_threads)
+            self.runner.run()
+            self.runner = None
+        else:
+            # The tasks added by the expansions are started by them
+            for task in list(self.tasks):
+                try:
+                    task.start()
+                except:
+                    pass
+
+            for task in self.tasks:
+                try:
+                    task.join()
+                except:
+                    pass
 
-        for task in self.tasks:
-            try:
-                task.join()
-            except:
-                pass
-        
         completed_in = (time() - start_time)
         self.logger.info("Workflow '" + self.name + "' completed in %s seconds ---" % completed_in)
+        self.scratch.drain()
+        self.logger.debug("Workflow '" + self.name + "' scratch: %s", json.dumps(self.scratch.get_metrics()))
+        self.logger.debug("Workflow '" + self.name + "' slots: %s", json.dumps(self.slots.get_metrics()))
+        if self.staging_cache is not None:
+            self.logger.debug("Workflow '" + self.name + "' staging cache: %s", json.dumps(self.staging_cache.as_json()))
+        if len(self.expansions):
+            self.logger.debug("Workflow '" + self.name + "' expansions: %s",
+                              json.dumps({e.parent.name: e.get_metrics() for e in self.expansions}))
+        lineage = self.lineage.as_json()
+        if len(lineage):
+            self.logger.debug("Workflow '" + self.name + "' lineage: %d files, %d intermediates removed", len(lineage),
+                              len([f for f in lineage.values() if f['removed']]))
+        for monitor in list(SlurmMonitor.instances.values()):
+            self.logger.debug("Workflow '" + self.name + "' Slurm jobs: %s", json.dumps(monitor.get_metrics()))
+        for manager in list(PackManager.instances.values()):
+            self.logger.debug("Workflow '" + self.name + "' Slurm allocations: %s", json.dumps(manager.get_metrics()))
+        for manager in list(GlobusManager.instances.values()):
+            self.logger.debug("Workflow '" + self.name + "' Globus transfers: %s", json.dumps(manager.get_metrics()))
+        reachability = ConnectivityWaiter.get_instance().get_metrics()
+        if len(reachability):
+            self.logger.debug("Workflow '" + self.name + "' hosts reachability: %s", json.dumps(reachability))
+        if self.overhead_accounting:
+            report = self.overhead_report()
+            self.logger.info("Workflow '" + self.name + "' engine overhead %.3f seconds vs. compute %.3f seconds "
+                             "(%.1f%% overhead)", report['overhead'], report['compute'],
+                             report['overhead_ratio'] * 100)
 
     def load_json(self, Json_data):
         from dagon.task import DagonTask, TaskType
@@ -408,24 +670,19 @@ class Workflow(object):
         """
         Validate the workflow to avoid any kind of cycle on the grap
 
-        Raise an Exception when a cylce is founded
+        :return: topological order and critical path of the workflow
+        :rtype: :class:`dagon.graph.Topology`
+
+        :raises CycleError: when a cycle is found, with the tasks forming the cycle
         """
-        needed = []
-        needy = []
-        for task in self.tasks:
-            for prev in task.prevs:
-                bool_needed = False
-                bool_needy = False
-                needed.append(prev)  # dependency task is added
-                if task in needed or task.nexts in needed: bool_needed = True  # are you or your decendents needed?
-                if prev in needy: bool_needy = True  # that who you need is also needed?
-                if bool_needy and bool_needed:
-                    logging.warning('A cycle have been found')
-                    raise Exception("A cycle have been found from %s to %s" % (prev.name, task.name))
-                else:
-                    needy.append(task)  # add the task and decendets to the needys array
-                    for t in task.nexts:
-                        needy.append(t)
+        try:
+            self.topology = validate(self.tasks)
+        except CycleError:
+            logging.warning('A cycle have been found')
+            raise
+        self.logger.debug("Workflow '%s' critical path: %s", self.name,
+                          " -> ".join(task.name for task in self.topology.critical_path))
+        return self.topology
 
 
 class DataMover(Enum):
@@ -441,6 +698,12 @@ class DataMover(Enum):
     :cvar FTP: Using FTP
     :cvar SFTP: Using secure FTP
     :cvar GRIDFTP: Using Globus GridFTP
+    :cvar SKYCDS: Using SkyCDS
+    :cvar HARDLINK: Using a hard link, copying the data across filesystems
+    :cvar REFLINK: Using a copy-on-write clone, copying the data when it is not supported
+    :cvar TAR: Streaming a tar archive over SSH, for many small files
+    :cvar DELTA: Synchronizing with the copy of a previous run, kept out of the scratch directories, writing
+        only the blocks changed
     """
 
     DONTMOVE = 0
@@ -453,6 +716,10 @@ class DataMover(Enum):
     SFTP = 7
     GRIDFTP = 8
     SKYCDS = 9
+    HARDLINK = 10
+    REFLINK = 11
+    TAR = 12
+    DELTA = 13
 
 
 class StagerMover(Enum):
@@ -462,10 +729,13 @@ class StagerMover(Enum):
     :cvar NORMAL: sequential
     :cvar PARALLEL: using threads
     :cvar SLURM: using Slurm
+    :cvar NATIVE: in-process, using a thread pool (LINK, COPY, HARDLINK and REFLINK between local tasks) or
+        parallel SFTP channels (SCP between a local and a remote task)
     """
     NORMAL = 0
     PARALLEL = 1
     SLURM = 2
+    NATIVE = 3
 
 
 class ProtocolStatus(Enum):
@@ -487,11 +757,53 @@ class Stager(object):
     Choose the transference protocol to move data between tasks
     """
 
+    # Movers whose commands are written in the launcher script, the data is moved when the script runs
+    SCRIPT_MOVERS = [DataMover.DONTMOVE, DataMover.LINK, DataMover.COPY, DataMover.SCP, DataMover.HARDLINK,
+                     DataMover.REFLINK]
+
+    # Method of the native staging engine for each data mover
+    NATIVE_METHODS = {DataMover.LINK: "link", DataMover.COPY: "sendfile",
+                      DataMover.HARDLINK: "hardlink", DataMover.REFLINK: "reflink"}
+
+    # Movers used instead of scp when the tasks are on different machines
+    SSH_MOVERS = [DataMover.TAR, DataMover.DELTA]
+
+    # Hard link on the same filesystem (symbolic link if it is not possible) and copy across devices,
+    # printing the bytes not copied
+    LINK_FUNCTION = """
+dagon_link() {
+    mkdir -p "$(dirname "$2")"
+    if [ "$(stat -c %d "$1")" = "$(stat -c %d "$(dirname "$2")")" ]; then
+        cp -rl "$1" "$2" 2>/dev/null || ln -sfn "$(readlink -f "$1")" "$2" || return 1
+        echo "Linked $(du -sb "$1" | cut -f1) bytes from $1"
+    else
+        cp -r "$1" "$2"
+    fi
+}
+export -f dagon_link
+"""
+
+    # Hard link, copying the data when it is not possible
+    HARDLINK_FUNCTION = """
+dagon_hardlink() {
+    cp -rl "$1" "$2" 2>/dev/null || cp -r "$1" "$2"
+}
+export -f dagon_hardlink
+"""
+
     def __init__(self, data_mover, stager_mover, cfg):
         self.data_mover = data_mover
         self.stager_mover = stager_mover
         self.cfg = cfg
 
+    @staticmethod
+    def is_in_script(data_mover, stager_mover):
+        """
+        :return: True if the data is moved by the launcher script when it runs, not when it is generated
+        :rtype: bool
+        """
+        return data_mover in Stager.SCRIPT_MOVERS and StagerMover(stager_mover) != StagerMover.NATIVE
+
     def stage_in(self, dst_task, src_task, dst_path, local_path):
         """
         Evaluates the context of the machines and choose the transfer protocol
@@ -512,6 +824,16 @@ class Stager(object):
         :rtype: str with the command
         """
 
+        # Move only the files known under a directory instead of the whole directory
+        if (self.cfg.get("staging") or {}).get("lineage") == "True":
+            files = src_task.workflow.lineage.get_files(src_task, local_path)
+            if len(files):
+                command = ""
+                for file_path in files:
+                    command += "mkdir -p " + dst_path + "/" + os.path.dirname("/" + file_path) + "\n"
+                    command += self.stage_in(dst_task, src_task, dst_path, "/" + file_path)
+                return command
+
         data_mover = DataMover.DONTMOVE
         command = ""
 
@@ -540,6 +862,10 @@ class Stager(object):
         else:  # best effort (SCP)
             data_mover = self.data_mover
 
+        # The movers working over SSH replace scp between different machines
+        if data_mover == DataMover.SCP and self.data_mover in Stager.SSH_MOVERS:
+            data_mover = self.data_mover
+
         src = src_task.get_scratch_dir() + "/" + local_path
 
         #get filename from path 
@@ -549,19 +875,42 @@ class Stager(object):
         #dst = "output.txt"
 
 
+        # Stage the data in this process when both tasks are local
+        if StagerMover(self.stager_mover) == StagerMover.NATIVE and data_mover in Stager.NATIVE_METHODS and \
+                not isinstance(dst_task, RemoteTask) and not isinstance(src_task, RemoteTask):
+            return self.stage_native(dst_task, src, dst, Stager.NATIVE_METHODS[data_mover])
+
+        # Transfer the data in this process when only one of the tasks is remote
+        if StagerMover(self.stager_mover) == StagerMover.NATIVE and data_mover == DataMover.SCP and \
+                isinstance(dst_task, RemoteTask) != isinstance(src_task, RemoteTask):
+            return self.transfer_native(dst_task, src_task, src, dst)
+
+        # Stream the data in a tar archive
+        if data_mover == DataMover.TAR:
+            return self.tar_pipe(dst_task, src_task, src, dst)
+
+        # Synchronize the data with the previous copy
+        if data_mover == DataMover.DELTA:
+            return self.delta_sync(dst_task, src_task, src, dst)
+
         # Check if the symbolic link have to be used...
         if data_mover == DataMover.GRIDFTP:
             # data could be copy using globus sdk
             ep1 = src_task.get_endpoint()
             ep2 = dst_task.get_endpoint()
-            gm = GlobusManager(ep1, ep2, self.cfg["globus"]["clientid"], self.cfg["globus"]["intermadiate_endpoint"])
+            globus = self.cfg["globus"]
+            gm = GlobusManager.get_instance(globus["clientid"], globus.get("intermadiate_endpoint"),
+                                            globus.get("token_file"), globus.get("batch_delay"),
+                                            globus.get("poll_interval"), globus.get("timeout"))
 
             # generate tar with data
             #tar_path = src + "/data.tar"
             #command_tar = "tar -czvf %s %s --exclude=*.tar" % (tar_path, src_task.get_scratch_dir())
             #result = src_task.execute_command(command_tar)
 
-            gm.copy_data(src, dst, intermediate_filename)# + "/" + "data.tar.gz")
+            # The transfer is batched with the other stage-ins, the task waits for it before its execution
+            dst_task.add_pending_transfer(gm.submit(ep1, ep2, src, dst))
+            command = command + "# Data transferred by Globus from " + src + "\n"
 
         elif data_mover == DataMover.SKYCDS:
             skycds = SKYCDS()
@@ -572,11 +921,11 @@ class Stager(object):
         elif data_mover == DataMover.LINK:
             # Add the link command
             command = command + "# Add the link command\n"
-            cmd = "ls $file $dst"
+            cmd = "dagon_link $file $dst"
             if StagerMover(self.stager_mover) == StagerMover.PARALLEL:
-                cmd = "ls {} $dst"
-            command = command + self.generate_command(src, dst, cmd, self.stager_mover.value)
-                      
+                cmd = "dagon_link {} $dst"
+            command = command + self.generate_command(src, dst, cmd, self.stager_mover.value, Stager.LINK_FUNCTION)
+
         # Check if the copy have to be used...
         elif data_mover == DataMover.COPY:
             # Add the copy command
@@ -586,6 +935,25 @@ class Stager(object):
                 cmd = "cp -r {} $dst"
             command = command + self.generate_command(src, dst, cmd, self.stager_mover.value)
 
+        # Check if the hard link have to be used...
+        elif data_mover == DataMover.HARDLINK:
+            # Add the hard link command, cp copies the data if the link is not possible
+            command = command + "# Add the hard link command\n"
+            cmd = "dagon_hardlink $file $dst"
+            if StagerMover(self.stager_mover) == StagerMover.PARALLEL:
+                cmd = "dagon_hardlink {} $dst"
+            command = command + self.generate_command(src, dst, cmd, self.stager_mover.value,
+                                                      Stager.HARDLINK_FUNCTION)
+
+        # Check if the copy-on-write clone have to be used...
+        elif data_mover == DataMover.REFLINK:
+            # Add the clone command
+            command = command + "# Add the clone command\n"
+            cmd = "cp -r --reflink=auto $file $dst"
+            if StagerMover(self.stager_mover) == StagerMover.PARALLEL:
+                cmd = "cp -r --reflink=auto {} $dst"
+            command = command + self.generate_command(src, dst, cmd, self.stager_mover.value)
+
         # Check if the secure copy have to be used...
         elif data_mover == DataMover.SCP:
             # Add the copy command
@@ -632,10 +1000,213 @@ class Stager(object):
 
         return command
 
-    def generate_command(self, src, dst, cmd, mode):
+    def get_staging_engine(self):
+        """
+        Returns the process-wide staging engine, with as many threads as the staging section of the
+        configuration says
+
+        :return: the engine
+        :rtype: :class:`dagon.staging.StagingEngine`
+        """
+        staging = self.cfg.get("staging") or {}
+        return StagingEngine.get_instance(staging.get("threads") or StagingEngine.THREADS)
+
+    def stage_native(self, dst_task, src, dst, method):
+        """
+        Stage the data with the native staging engine instead of generating a command
+
+        :param dst_task: task where the data has to be put
+        :type dst_task: :class:`dagon.task.Task`
+
+        :param src: path of the data, it can be a glob pattern
+        :type src: str
+
+        :param dst: path where the data is staged
+        :type dst: str
+
+        :param method: staging method (symlink, sendfile, hardlink, reflink)
+        :type method: str
+
+        :return: comment for the launcher script
+        :rtype: str
+
+        :raises Exception: a file could not be staged
+        """
+        engine = self.get_staging_engine()
+        results = engine.stage(src, dst, method, dst_task.workflow.staging_cache)
+        return self.check_results(dst_task, src, results)
+
+    def transfer_native(self, dst_task, src_task, src, dst):
+        """
+        Transfer the data between a local and a remote task over parallel SFTP channels instead of scp
+
+        :param dst_task: task where the data has to be put
+        :type dst_task: :class:`dagon.task.Task`
+
+        :param src_task: task from the data has to be taken
+        :type src_task: :class:`dagon.task.Task`
+
+        :param src: path of the data, it can be a glob pattern
+        :type src: str
+
+        :param dst: path where the data is staged
+        :type dst: str
+
+        :return: comment for the launcher script
+        :rtype: str
+
+        :raises Exception: a file could not be transferred
+        """
+        staging = self.cfg.get("staging") or {}
+        if isinstance(dst_task, RemoteTask):
+            engine = SFTPTransferEngine(dst_task.ssh_connection.pooled, staging.get("channels", 4),
+                                        staging.get("chunk_size"), dst_root=dst_task.working_dir)
+            results = engine.upload(src, dst)
+        else:
+            engine = SFTPTransferEngine(src_task.ssh_connection.pooled, staging.get("channels", 4),
+                                        staging.get("chunk_size"), dst_root=dst_task.working_dir)
+            results = engine.download(src, dst)
+        return self.check_results(dst_task, src, results)
+
+    def tar_pipe(self, dst_task, src_task, src, dst):
+        """
+        Stream the data in a tar archive. When only one of the tasks is remote, the archive is streamed by
+        this process over the pooled SSH connection. Otherwise, the destination task pulls it in its launcher
+
+        :param dst_task: task where the data has to be put
+        :type dst_task: :class:`dagon.task.Task`
+
+        :param src_task: task from the data has to be taken
+        :type src_task: :class:`dagon.task.Task`
+
+        :param src: path of the data, its last element can be a glob pattern
+        :type src: str
+
+        :param dst: path where the data is staged
+        :type dst: str
+
+        :return: command to move the data
+        :rtype: str
+
+        :raises Exception: the data could not be streamed
+        """
+        compression = (self.cfg.get("staging") or {}).get("compression", "auto")
+        if isinstance(dst_task, RemoteTask) and not isinstance(src_task, RemoteTask):
+            return self.check_results(dst_task, src, TarPipe(dst_task.ssh_connection.pooled,
+                                                             compression).upload(src, dst))
+        if isinstance(src_task, RemoteTask) and not isinstance(dst_task, RemoteTask):
+            return self.check_results(dst_task, src, TarPipe(src_task.ssh_connection.pooled,
+                                                             compression).download(src, dst))
+
+        command = "# Add the tar pipe command\n"
+        if isinstance(src_task, RemoteTask):
+            # copy my public key
+            key = dst_task.get_public_key()
+            src_task.add_public_key(key)
+            available = TarPipe.get_remote_compressors(src_task.ssh_connection.pooled) & \
+                TarPipe.get_remote_compressors(dst_task.ssh_connection.pooled)
+            compressor = TarPipe.choose_compression(src_task.get_ip(), available, compression)
+            command += "(set -o pipefail; ssh -o LogLevel=ERROR -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -i " + \
+                dst_task.working_dir + "/.dagon/ssh_key " + src_task.get_user() + "@" + src_task.get_ip() + \
+                " \"" + TarPipe.pack_command(src, compressor) + "\" | " + TarPipe.unpack_command(dst, compressor) + ")"
+        else:
+            command += "(set -o pipefail; " + TarPipe.pack_command(src) + " | (" + TarPipe.unpack_command(dst) + "))"
+        return command + "\nif [ $? -ne 0 ]; then code=1; fi\n"
+
+    def delta_sync(self, dst_task, src_task, src, dst):
+        """
+        Synchronize the data with the copy of a previous run. The copies are kept in a store that outlives the
+        scratch directories, keyed by workflow, task and destination path, and linked into the destination.
+        Between local tasks it is done by this process with :class:`dagon.staging.DeltaSync`, otherwise
+        rsync updates the store on the destination machine
+
+        :param dst_task: task where the data has to be put
+        :type dst_task: :class:`dagon.task.Task`
+
+        :param src_task: task from the data has to be taken
+        :type src_task: :class:`dagon.task.Task`
+
+        :param src: path of the data, it can be a glob pattern
+        :type src: str
+
+        :param dst: path where the data is staged
+        :type dst: str
+
+        :return: command to move the data
+        :rtype: str
+
+        :raises Exception: the data could not be synchronized
+        """
+        prefix = dst_task.workflow.name + "/" + dst_task.name
+        ssh = "ssh -o LogLevel=ERROR -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -i "
+        if not isinstance(dst_task, RemoteTask) and not isinstance(src_task, RemoteTask):
+            staging = dst_task.workflow.cfg.get("staging") or {}
+            store = staging.get("delta_dir") or dst_task.workflow.get_scratch_dir_base() + "/.dagon-delta"
+            delta = DeltaSync(store, self.get_staging_engine(), dst_task.working_dir, prefix)
+            return self.check_results(dst_task, src, delta.sync(src, dst))
+
+        # rsync updates the copy in the store, which is linked into the destination directory
+        store = os.path.dirname(dst_task.working_dir.rstrip("/")) + "/.dagon-delta/" + \
+            DeltaSync.get_key(dst, dst_task.working_dir, prefix)
+        place = "mkdir -p " + os.path.dirname(dst) + " && cp -alf " + store + "/. " + os.path.dirname(dst) + "/"
+
+        if isinstance(src_task, RemoteTask):  # the destination pulls the data
+            # copy my public key
+            key = dst_task.get_public_key()
+            src_task.add_public_key(key)
+            command = "# Add the rsync command\n"
+            command += "mkdir -p " + store + " && rsync -a -e \"" + ssh + dst_task.working_dir + "/.dagon/ssh_key\" " + \
+                       src_task.get_user() + "@" + src_task.get_ip() + ":\"" + src + "\" " + store + "/ && " + place
+            return command + "\nif [ $? -ne 0 ]; then code=1; fi\n"
+
+        # if source is a local machine, the data is pushed from here
+        key = src_task.get_public_key()
+        dst_task.add_public_key(key)
+        res = dst_task.execute_remote("mkdir -p " + store)
+        if res['code']:
+            raise Exception("Couldn't create directory %s" % store)
+        res = Batch.execute_command("rsync -a -e \"" + ssh + src_task.working_dir + "/.dagon/ssh_key\" " + src + " " +
+                                    dst_task.get_user() + "@" + dst_task.get_ip() + ":" + store + "/")
+        if res['code']:
+            raise Exception("Couldn't synchronize data from %s to %s: %s" % (src_task.get_ip(), dst_task.get_ip(),
+                                                                             res['message']))
+        res = dst_task.execute_remote(place)
+        if res['code']:
+            raise Exception("Couldn't link the data synchronized in %s" % os.path.dirname(dst))
+        return "# Data synchronized by dagon from " + src + "\n"
+
+    def check_results(self, dst_task, src, results):
+        """
+        Keep and log the results of the data staged in by dagon
+
+        :param dst_task: task where the data has been put
+        :type dst_task: :class:`dagon.task.Task`
+
+        :param src: path of the data
+        :type src: str
+
+        :param results: result of each file staged
+        :type results: list(:class:`dagon.staging.StagingResult`)
+
+        :return: comment for the launcher script
+        :rtype: str
+
+        :raises Exception: a file could not be staged
+        """
+        dst_task.add_staging_results(results)
+
+        failed = [result for result in results if not result.is_ok()]
+        dst_task.workflow.logger.debug("%s: Staged %d files from %s (%d bytes written, %d bytes avoided, %d failed)",
+                                       dst_task.name, len(results), src, sum(result.bytes for result in results),
+                                       sum(result.bytes_avoided for result in results), len(failed))
+        if len(failed):
+            raise Exception("Couldn't stage %s: %s" % (failed[0].src, failed[0].error))
+        return "# Data staged in by dagon from " + src + "\n"
+
+    def generate_command(self, src, dst, cmd, mode, functions=""):
         return """
 #! /bin/bash
-
+{}
 src={}
 dst={}
 mode={}
@@ -653,14 +1224,14 @@ case $mode in
     ;;
     2)
     # Run in parallel using slurm
-    srun --partition=$partition --ntasks=1 --cpus-per-task=1 $cmd &
+    srun --partition=$partition --ntasks=1 --cpus-per-task=1 bash -c "$cmd" &
     ;;
     *)
     # Run requentially
-    $cmd
+    eval "$cmd"
     ;;
 esac
 done
 
 wait
-        """.format(src, dst, mode, self.cfg["batch"]["threads"], self.cfg["sulrm"]["partition"], cmd)
\ No newline at end of file
+        """.format(functions, src, dst, mode, self.cfg["batch"]["threads"], self.cfg["sulrm"]["partition"], cmd)
\ No newline at end of file
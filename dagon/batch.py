@@ -1,9 +1,15 @@
+import threading
+from os import chmod, path
+
+import dagon
+
 from fabric.api import local, env
 from fabric.context_managers import settings, hide
 
 from dagon.task import Task
 from dagon.remote import RemoteTask
-from subprocess import Popen, PIPE, STDOUT
+from dagon.executor import ProcessReaper
+from dagon.slurm import SlurmMonitor, PackManager
 
 
 class Batch(Task):
@@ -11,6 +17,8 @@ class Batch(Task):
     **Executes a Batch task**
     """
 
+    FAN_OUT = True
+
     def __init__(self, name, command, working_dir=None, globusendpoint=None, transversal_workflow=None):
         """
         :param name: task name
@@ -26,6 +34,8 @@ class Batch(Task):
         :type globusendpoint: str
         """
         Task.__init__(self, name, command, working_dir,transversal_workflow = transversal_workflow, globusendpoint=globusendpoint)
+        # The output of the launcher is streamed to .dagon/stdout.txt by the executor
+        self.stream_output = True
 
     def __new__(cls, *args, **kwargs):
         """Create an Batch task local or remote
@@ -49,72 +59,61 @@ class Batch(Task):
         else:
             return super().__new__(cls)
 
+    def get_slot_keys(self):
+        """
+        Returns the execution slots held by the task while it is executed
+
+        :return: list of slot keys (kind of slot, host)
+        :rtype: list(tuple(str, str))
+        """
+        return [("batch", None)]
+
+    @staticmethod
+    def submit_command(command, timeout=None, stdout_path=None, stderr_path=None):
+        """
+        Starts a local command without waiting for it
+
+        :param command: command to be executed
+        :type command: str
+
+        :param timeout: seconds before the command is killed
+        :type timeout: float
+
+        :param stdout_path: file where the standard output is streamed
+        :type stdout_path: str
+
+        :param stderr_path: file where the standard error is streamed
+        :type stderr_path: str
+
+        :return: handle to wait for or cancel the command
+        :rtype: :class:`dagon.executor.ProcessHandle`
+        """
+        return ProcessReaper.get_instance().submit(command, timeout=timeout, stdout_path=stdout_path,
+                                                   stderr_path=stderr_path)
+
     @staticmethod
-    def execute_command(command):
+    def execute_command(command, timeout=None, stdout_path=None, stderr_path=None):
         """
         Executes a local command
 
         :param command: command to be executed
         :type command: str
+
+        :param timeout: seconds before the command is killed
+        :type timeout: float
+
+        :param stdout_path: file where the standard output is streamed
+        :type stdout_path: str
+
+        :param stderr_path: file where the standard error is streamed
+        :type stderr_path: str
+
         :return: execution result
-        :rtype: dict() with the execution output (str), code (int) and error (str)
-        """
-        # Execute the bash command
-        # with settings(
-        #         hide('warnings', 'running', 'stdout', 'stderr'),
-        #         warn_only=True
-        # ):
-        #     result = local(command, capture=True)
-        #     # check for an error
-        #     code, message = 0, ""
-        #     if len(result.stderr):
-        #         code, message = 1, result.stderr
-        #
-        #     return {"code": code, "message": message, "output": result.stdout}
-        p = Popen(command.split(" "), stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=True, bufsize=-1, universal_newlines=True)
-        #print(command)
-        """out, err = p.communicate()
-
-        code, message = 0, ""
-        if len(err):
-            code, message = 1, err
-        return {"code": code, "message": message, "output": out}
-        
-        
-        AGGIUNGERE eventualmente una classe che eredita da thread che lancia il tutto per non renderlo bloccante:
-        
-        import subprocess
-        import threading
-        
-        class CommandExecutor(threading.Thread):
-            def __init__(self, command):
-                threading.Thread.__init__(self)
-                self.command = command
-                self.output = None
-                self.error = None
-        
-            def run(self):
-                try:
-                    process = subprocess.Popen(self.command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    self.output, self.error = process.communicate()
-                except Exception as e:
-                    self.error = str(e)
-        
-        # Esempio di utilizzo
-        command = "ls -l"  # Sostituisci con il tuo comando
-        executor = CommandExecutor(command)
-        executor.start()
-        
-        # Attendere il completamento dell'esecuzione del comando
-        executor.join()
-        
-        # Ottenere l'output e gli errori, se presenti
-        output = executor.output.decode("utf-8") if executor.output else None
-        error = executor.error.decode("utf-8") if executor.error else None
-        
-        print("Output:", output)
-        print("Error:", error)
+        :rtype: dict() with the execution output (str), code (int), message (str), exit code (int),
+            elapsed time (float) and resource usage (dict)
         """
+        handle = Batch.submit_command(command, timeout=timeout, stdout_path=stdout_path, stderr_path=stderr_path)
+        return handle.wait()
 
     def on_execute(self, script, script_name):
         """
@@ -130,8 +129,69 @@ class Batch(Task):
         # Invoke the base method
         super(Batch, self).on_execute(script, script_name)
         #print("sono entrato", script)
+        if script_name == "launcher.sh":
+            # Stream the output of the task while it is running
+            return Batch.execute_command("bash " + "/home/s.perrotta/dagonstar/examples/dataflow/batch/" + script_name,
+                                         stdout_path=self.working_dir + "/.dagon/stdout.txt",
+                                         stderr_path=self.working_dir + "/.dagon/stderr.txt")
         return Batch.execute_command("bash " + "/home/s.perrotta/dagonstar/examples/dataflow/batch/" + script_name)
 
+    def write_script(self, script, script_name):
+        """
+        Write a script in the .dagon directory of the task
+
+        :param script: script content
+        :type script: str
+
+        :param script_name: script name
+        :type script_name: str
+        """
+        script_name = self.working_dir + "/.dagon/" + script_name
+        with open(script_name, "w") as f:
+            f.write(script)
+        chmod(script_name, 0o744)
+
+    def get_fan_out_limit(self):
+        """
+        :return: maximum number of elements of the fan-out running at the same time
+        :rtype: int
+        """
+        if self.fan_out_limit is not None:
+            return max(1, int(self.fan_out_limit))
+        return max(1, int((self.workflow.cfg.get("batch") or {}).get("threads", 4)))
+
+    def execute_elements(self):
+        """
+        Execute the elements of the fan-out as local processes, a bounded number at the same time
+
+        :return: execution result
+        :rtype: dict() with the execution output (str), code (int) and message (str)
+        """
+        slots = threading.Semaphore(self.get_fan_out_limit())
+        handles = []
+        for element in self.elements:
+            self.write_script(self.get_element_script(element), "element-%d.sh" % element['index'])
+
+        def update(element, result):
+            element['exit_code'] = result['exit_code']
+            element['state'] = "COMPLETED" if result['code'] == 0 else "FAILED"
+
+        def done(element, handle):
+            update(element, handle.result)
+            slots.release()
+
+        for element in self.elements:
+            slots.acquire()
+            element['state'] = "RUNNING"
+            prefix = self.working_dir + "/.dagon/element-%d" % element['index']
+            handle = Batch.submit_command("bash " + prefix + ".sh", stdout_path=prefix + ".out",
+                                          stderr_path=prefix + ".err")
+            handle.add_done_callback(lambda h, element=element: done(element, h))
+            handles.append((element, handle))
+        for element, handle in handles:
+            update(element, handle.wait())
+        return self.get_elements_result()
+
     # returns public key
     def get_public_key(self):
         """
@@ -163,6 +223,8 @@ class RemoteBatch(RemoteTask, Batch):
     **Execute a Batch task on a remote machine**
     """
 
+    FAN_OUT = False
+
     def __init__(self, name, command, ssh_username=None, keypath=None, ip=None, working_dir=None, globusendpoint=None):
         """
         :param name: name of the task
@@ -204,7 +266,7 @@ class RemoteBatch(RemoteTask, Batch):
         """
         # Invoke the base method
         RemoteTask.on_execute(self, launcher_script, script_name)
-        result = self.ssh_connection.execute_command("bash " + self.working_dir + "/.dagon/" + script_name)
+        result = self.execute_remote("bash " + self.working_dir + "/.dagon/" + script_name)
         return result
 
 
@@ -245,9 +307,13 @@ class Slurm(Batch):
         """
 
         Batch.__init__(self, name, command, working_dir, globusendpoint=globusendpoint)
+        # The job output is written by Slurm, not by the executor
+        self.stream_output = False
         self.partition = partition
         self.ntasks = ntasks
         self.memory = memory
+        self.job = None
+        self.pack = None
 
     def __new__(cls, *args, **kwargs):
         """Create an Slurm task local or remote
@@ -265,7 +331,16 @@ class Slurm(Batch):
         else:
             return super().__new__(cls)
 
-    def generate_command(self, script_name):
+    def get_slot_keys(self):
+        """
+        Returns the execution slots held by the task while it is executed
+
+        :return: list of slot keys (kind of slot, host)
+        :rtype: list(tuple(str, str))
+        """
+        return [("slurm", None)]
+
+    def generate_command(self, script_name, options=""):
 
         """
         Generates the Slurm command including the partition and number of task parameters
@@ -273,6 +348,9 @@ class Slurm(Batch):
         :param script_name: script to be executed
         :type script: str
 
+        :param options: other sbatch options
+        :type options: str
+
         :return: execution result
         :rtype: dict() with the execution output (str) and code (int)
         """
@@ -291,10 +369,267 @@ class Slurm(Batch):
 
         # Add the slurm batch command
         # command = "sbatch " + partition_text + " " + ntasks_text + " --job-name=" + self.name + " --chdir=" + self.working_dir + " --output=" + self.working_dir + "/.dagon/stdout.txt --wait " + self.working_dir+"/.dagon/launcher.sh"
-        command = "sbatch " + partition_text + " " + ntasks_text + " " + memory_text + " -J " + self.name + " -D " \
-                  + self.working_dir + " -W " + self.working_dir + "/.dagon/" + script_name
+        # The job is not waited by sbatch, its state is tracked by the Slurm monitor
+        command = "sbatch --parsable " + partition_text + " " + ntasks_text + " " + memory_text + " -J " + \
+                  self.name + " -D " + self.working_dir + " " + options + " " + self.working_dir + "/.dagon/" + script_name
         return command
 
+    @staticmethod
+    def run_slurm_command(command):
+        """
+        Execute a Slurm command on this machine, used by the Slurm monitor
+
+        :param command: command to be executed
+        :type command: str
+
+        :return: exit code, output and error
+        :rtype: tuple(int, str, str)
+        """
+        result = Batch.execute_command(command)
+        return result['exit_code'], result['output'], result['error']
+
+    def get_slurm_key(self):
+        """
+        :return: identifies the Slurm controller where the jobs of the task are submitted, None for the local one
+        :rtype: tuple
+        """
+        return None
+
+    def get_slurm_execute(self):
+        """
+        :return: function executing a command where Slurm is, returning the exit code, output and error
+        :rtype: callable(str) -> tuple(int, str, str)
+        """
+        return Slurm.run_slurm_command
+
+    def get_slurm_monitor(self):
+        """
+        Returns the monitor of the Slurm controller where the jobs of the task are submitted
+
+        :return: the monitor
+        :rtype: :class:`dagon.slurm.SlurmMonitor`
+        """
+        return SlurmMonitor.get_instance(self.get_slurm_key(), self.get_slurm_execute(),
+                                         (self.workflow.cfg.get("sulrm") or {}).get("poll_interval"))
+
+    def set_pack(self, estimate=None):
+        """
+        Execute the task inside an allocation shared with other short tasks instead of in its own job
+
+        :param estimate: seconds the task is expected to run, by default the task_time of the pack section
+            of the configuration
+        :type estimate: int
+        """
+        self.pack = estimate if estimate is not None else True
+
+    def is_packed(self):
+        """
+        Returns True if the task is executed inside a shared allocation: it was set with
+        :meth:`dagon.batch.Slurm.set_pack` or the pack section of the configuration is used, and it is a
+        sequential task of one Slurm task
+
+        :return: True if the task is packed
+        :rtype: bool
+        """
+        packed = self.pack is not None or (self.workflow.cfg.get("pack") or {}).get("use") == "True"
+        return packed and self.mode == "sequential" and self.ntasks in [None, 1, "1"]
+
+    def get_pack_estimate(self):
+        """
+        :return: seconds the task is expected to run
+        :rtype: int
+        """
+        if self.pack is not None and self.pack is not True:
+            return int(self.pack)
+        return int((self.workflow.cfg.get("pack") or {}).get("task_time") or 60)
+
+    def get_pack_dir(self):
+        """
+        :return: directory where the directories of the allocations are created
+        :rtype: str
+        """
+        return (self.workflow.cfg.get("pack") or {}).get("dir") or self.workflow.get_scratch_dir_base() + \
+            "/.dagon-pack"
+
+    def get_pack_manager(self):
+        """
+        Returns the manager of the allocations of the Slurm controller in the partition of the task
+
+        :return: the manager
+        :rtype: :class:`dagon.slurm.PackManager`
+        """
+        options = "--partition=" + self.partition if self.partition else ""
+        return PackManager.get_instance((self.get_slurm_key(), options), self.get_slurm_execute(),
+                                        self.get_slurm_monitor(), self.get_pack_dir(),
+                                        self.workflow.cfg.get("pack"), options)
+
+    def flush_scripts(self):
+        """
+        Make the scripts of the task available where Slurm is before submitting them
+        """
+        pass
+
+    def wait_pack(self, script_name):
+        """
+        Queue the script in a shared allocation and wait until it ends
+
+        :param script_name: script to be executed
+        :type script_name: str
+
+        :return: execution result
+        :rtype: dict() with the execution output (str), code (int), exit code (int) and job ID (str)
+        """
+        self.flush_scripts()
+        packed = self.get_pack_manager().submit(self.name, self.working_dir,
+                                                self.working_dir + "/.dagon/" + script_name,
+                                                self.get_pack_estimate())
+        result = packed.wait()
+        self.workflow.logger.debug("%s: Ended with exit code %s in the allocation %s", self.name,
+                                   result['exit_code'], result['job_id'])
+        return result
+
+    def chains_to(self, task):
+        """
+        Returns True if the job of this task can be submitted before the task ends, depending on its job. It
+        needs the chaining enabled in the sulrm section of the configuration, both tasks submitted to the same
+        controller in sequential mode and the data staged by the launcher script
+
+        :param task: task this task depends on
+        :type task: :class:`dagon.task.Task`
+
+        :return: True if the dependency is resolved by Slurm
+        :rtype: bool
+        """
+        return (self.workflow.cfg.get("sulrm") or {}).get("chain") == "True" and isinstance(task, Slurm) and \
+            task.workflow is self.workflow and self.mode == "sequential" and task.mode == "sequential" and \
+            not self.is_packed() and not task.is_packed() and \
+            task.get_slurm_key() == self.get_slurm_key() and not self.workflow.dry and \
+            dagon.Stager.is_in_script(self.data_mover, self.stager_mover)
+
+    def is_submitted(self):
+        """
+        :return: True if the job of the task has been submitted
+        :rtype: bool
+        """
+        job = self.job
+        return job is not None and job.job_id is not None
+
+    def get_dependency_option(self):
+        """
+        Returns the sbatch option making the job start after the jobs of the tasks it is chained to complete.
+        Slurm cancels it if one of them fails
+
+        :return: dependency option, empty if the job doesn't wait for other job
+        :rtype: str
+        """
+        job_ids = []
+        for task in set(self.prevs):
+            if not self.chains_to(task) or not task.is_submitted():
+                continue
+            job = task.job
+            if job.done() and job.result['code'] == 0:
+                continue
+            job_ids.append(job.job_id)
+        if not len(job_ids):
+            return ""
+        return "--dependency=afterok:" + ":".join(sorted(job_ids)) + " --kill-on-invalid-dep=yes"
+
+    def wait_job(self, command):
+        """
+        Submit the job and wait until the Slurm monitor sees it ended
+
+        :param command: sbatch command
+        :type command: str
+
+        :return: execution result
+        :rtype: dict() with the execution output (str), code (int), job ID (str) and state (str)
+        """
+        self.flush_scripts()
+        self.job = self.get_slurm_monitor().submit(command, self.name)
+        if self.job.wait_submitted() is not None:
+            # The tasks chained to this one can be submitted now
+            self.workflow.on_submitted(self)
+        result = self.job.wait()
+        self.workflow.logger.debug("%s: Slurm job %s ended with state %s", self.name, self.job.job_id,
+                                   self.job.state)
+        return result
+
+    def get_fan_out_limit(self):
+        """
+        :return: maximum number of elements of the array job running at the same time, None for no limit
+        :rtype: int
+        """
+        if self.fan_out_limit is not None:
+            return max(1, int(self.fan_out_limit))
+        limit = (self.workflow.cfg.get("sulrm") or {}).get("array_limit")
+        return max(1, int(limit)) if limit else None
+
+    def get_max_array_size(self):
+        """
+        :return: maximum number of elements of an array job, from the sulrm section of the configuration or the
+            MaxArraySize of the Slurm controller
+        :rtype: int
+        """
+        size = (self.workflow.cfg.get("sulrm") or {}).get("max_array_size")
+        if size:
+            return max(1, int(size))
+        return self.get_slurm_monitor().get_max_array_size()
+
+    def execute_elements(self):
+        """
+        Execute the elements of the fan-out as Slurm array jobs, whose state is tracked with the other jobs by
+        the Slurm monitor. The elements are split in several arrays when there are more than the MaxArraySize
+        of the controller. With a fan-out limit, each array is submitted when the previous one ends, so the
+        limit holds for the whole fan-out
+
+        :return: execution result
+        :rtype: dict() with the execution output (str), code (int), message (str), job ID (str) and state (str)
+        """
+        for element in self.elements:
+            self.write_script(self.get_element_script(element), "element-%d.sh" % element['index'])
+
+        limit = self.get_fan_out_limit()
+        size = self.get_max_array_size()
+        arrays = []
+        for offset in range(0, len(self.elements), size):
+            count = min(size, len(self.elements) - offset)
+            script_name = "array-%d.sh" % (offset // size)
+            self.write_script("#! /bin/bash\nindex=$((%d + SLURM_ARRAY_TASK_ID))\nbash %s/.dagon/element-$index.sh > "
+                              "%s/.dagon/element-$index.out 2>&1\n" % (offset, self.working_dir, self.working_dir),
+                              script_name)
+            options = "--array=0-%d%s -o /dev/null" % (count - 1, "%%%d" % limit if limit else "")
+            arrays.append((offset, self.generate_command(script_name, options)))
+        self.flush_scripts()
+
+        monitor = self.get_slurm_monitor()
+        jobs = []
+        results = []
+        for offset, command in arrays:
+            self.job = monitor.submit(command, self.name)
+            jobs.append((offset, self.job))
+            if len(jobs) == 1 and self.job.wait_submitted() is not None:
+                self.workflow.on_submitted(self)
+            if limit:
+                results.append(self.job.wait())
+        if not limit:
+            results = [job.wait() for _, job in jobs]
+        for _, job in jobs:
+            self.workflow.logger.debug("%s: Slurm array job %s ended with state %s", self.name, job.job_id,
+                                       job.state)
+
+        # Without per element states, the elements take the state of their array job
+        for offset, job in jobs:
+            for element in self.elements[offset:offset + size]:
+                state, exit_code = job.elements.get(element['index'] - offset, (job.state, job.exit_code))
+                element['state'] = "COMPLETED" if state == "COMPLETED" and exit_code == 0 else state
+                element['exit_code'] = exit_code
+        failed = [result for result in results if result['code']]
+        result = dict(failed[0] if len(failed) else results[-1])
+        result['job_id'] = ",".join(job.job_id or "" for _, job in jobs)
+        elements = self.get_elements_result()
+        result.update(code=elements['code'] or result['code'], message=elements['message'] or result['message'])
+        return result
+
     def on_execute(self, script, script_name):
 
         """
@@ -315,11 +650,18 @@ class Slurm(Batch):
         if script_name == "context.sh":
             return Batch.execute_command(self.working_dir + "/.dagon/" + script_name)
 
-        command = self.generate_command(script_name)
+        # In parallel mode the launcher only stages the data, the elements are submitted as an array job
+        if len(self.elements):
+            return Batch.execute_command("bash " + self.working_dir + "/.dagon/" + script_name)
 
-        # Execute the bash command
-        result = Batch.execute_command(command)
-        return result
+        # Short tasks share an allocation
+        if self.is_packed():
+            return self.wait_pack(script_name)
+
+        command = self.generate_command(script_name, self.get_dependency_option())
+
+        # Submit the job
+        return self.wait_job(command)
 
 
 class RemoteSlurm(RemoteTask, Slurm):
@@ -327,6 +669,8 @@ class RemoteSlurm(RemoteTask, Slurm):
     ** Represent a task that runs on a remote slurm deployment **
     """
 
+    FAN_OUT = True
+
     def __init__(self, name, command, partition=None, ntasks=None, memory=None, working_dir=None, ssh_username=None, keypath=None,
                  ip=None, globusendpoint=None):
         """
@@ -362,6 +706,36 @@ class RemoteSlurm(RemoteTask, Slurm):
                        globusendpoint=globusendpoint)
         RemoteTask.__init__(self, name, ssh_username, keypath, command, ip, working_dir, globusendpoint=None)
 
+    def get_slot_keys(self):
+        """
+        Returns the execution slots held by the task while it is executed
+
+        :return: list of slot keys (kind of slot, host)
+        :rtype: list(tuple(str, str))
+        """
+        return Slurm.get_slot_keys(self) + RemoteTask.get_slot_keys(self)
+
+    def get_slurm_key(self):
+        """
+        :return: host and user reaching the remote Slurm controller
+        :rtype: tuple(str, str)
+        """
+        return self.ip, self.ssh_username
+
+    def get_slurm_execute(self):
+        """
+        :return: function executing a command on the remote machine through the pooled SSH connection
+        :rtype: callable(str) -> tuple(int, str, str)
+        """
+        return self.ssh_connection.pooled.exec_command
+
+    def get_pack_dir(self):
+        """
+        :return: directory on the remote machine where the directories of the allocations are created
+        :rtype: str
+        """
+        return (self.workflow.cfg.get("pack") or {}).get("dir") or path.dirname(self.working_dir) + "/.dagon-pack"
+
     def on_execute(self, script, script_name):
         """
         Execute a script using slurm
@@ -377,11 +751,31 @@ class RemoteSlurm(RemoteTask, Slurm):
         """
 
         RemoteTask.on_execute(self, script, script_name)
-        if script_name == "context.sh":
-            return self.ssh_connection.execute_command("bash " + self.working_dir + "/.dagon/" + script_name)
+        if script_name == "context.sh" or len(self.elements):
+            return self.execute_remote("bash " + self.working_dir + "/.dagon/" + script_name)
 
-        command = self.generate_command(script_name)
-        # Execute the bash command
-        result = self.ssh_connection.execute_command(command)
-        return result
+        if self.is_packed():
+            return self.wait_pack(script_name)
+
+        command = self.generate_command(script_name, self.get_dependency_option())
+        return self.wait_job(command)
+
+    def write_script(self, script, script_name):
+        """
+        Write a script in the .dagon directory of the task, it is sent with the next remote command
+
+        :param script: script content
+        :type script: str
+
+        :param script_name: script name
+        :type script_name: str
+        """
+        RemoteTask.on_execute(self, script, script_name)
+
+    def flush_scripts(self):
+        """
+        Send the pending bootstrap commands, writing the scripts of the task on the remote machine
+        """
+        if len(self.bootstrap):
+            self.execute_remote("true")
 
@@ -1,4 +1,7 @@
+import random
 import socket
+import threading
+from time import time, sleep
 
 
 def is_port_open(host, port, timeout=5):
@@ -17,7 +20,136 @@ def is_port_open(host, port, timeout=5):
     :return: True if the port is open
     :rtype: bool
     """
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.settimeout(timeout)
-    result = sock.connect_ex((host, port))
-    return result is 0
+    try:
+        sock = socket.create_connection((host, port), timeout)
+    except (socket.error, socket.timeout):
+        return False
+    sock.close()
+    return True
+
+
+class ConnectivityWaiter(object):
+    """
+    **Waits until a port of a remote host is reachable**
+
+    The port is probed with exponential backoff and jitter until an overall deadline expires. The tasks
+    waiting for the same host and port share the probes of the first one.
+
+    :ivar metrics: waiting metrics by host:port
+    :vartype metrics: dict(str, dict)
+    """
+
+    # Seconds before the first retry
+    INITIAL_DELAY = 0.5
+
+    # Maximum seconds between retries
+    MAX_DELAY = 15
+
+    # Seconds before giving up
+    DEADLINE = 600
+
+    instance = None
+    instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waits = {}
+        self.metrics = {}
+
+    @staticmethod
+    def get_instance():
+        """
+        Returns the process-wide waiter
+
+        :return: the waiter
+        :rtype: :class:`dagon.communication.ConnectivityWaiter`
+        """
+        with ConnectivityWaiter.instance_lock:
+            if ConnectivityWaiter.instance is None:
+                ConnectivityWaiter.instance = ConnectivityWaiter()
+            return ConnectivityWaiter.instance
+
+    def wait(self, host, port=22, deadline=None):
+        """
+        Wait until a port of a host is reachable
+
+        :param host: IP of the remote host
+        :type host: str
+
+        :param port: port to check
+        :type port: int
+
+        :param deadline: seconds before giving up, by default :attr:`DEADLINE`
+        :type deadline: float
+
+        :raises Exception: the port is not reachable before the deadline
+        """
+        deadline = ConnectivityWaiter.DEADLINE if deadline is None else float(deadline)
+        name = "%s:%s" % (host, port)
+        with self.lock:
+            event = self.waits.get(name)
+            owner = event is None
+            if owner:
+                event = threading.Event()
+                event.reachable = False
+                self.waits[name] = event
+                metrics = self.metrics.setdefault(name, {"waits": 0, "probes": 0, "failures": 0,
+                                                         "time_to_reachable": None})
+                metrics['waits'] += 1
+
+        start_time = time()
+        if not owner:
+            # Other task is already probing the host
+            event.wait(deadline)
+            if event.is_set() and event.reachable:
+                return
+            remaining = start_time + deadline - time()
+            if remaining <= 0:
+                self.fail(name, deadline)
+            # The owner gave up with a shorter deadline, keep waiting the remaining time
+            return self.wait(host, port, remaining)
+
+        delay = ConnectivityWaiter.INITIAL_DELAY
+        try:
+            while True:
+                metrics['probes'] += 1
+                if is_port_open(host, port):
+                    event.reachable = True
+                    metrics['time_to_reachable'] = time() - start_time
+                    return
+                remaining = start_time + deadline - time()
+                if remaining <= 0:
+                    metrics['failures'] += 1
+                    self.fail(name, deadline)
+                # Half of the delay is fixed and the other half random
+                sleep(min(remaining, delay / 2 + random.uniform(0, delay / 2)))
+                delay = min(delay * 2, ConnectivityWaiter.MAX_DELAY)
+        finally:
+            with self.lock:
+                del self.waits[name]
+            event.set()
+
+    @staticmethod
+    def fail(name, deadline):
+        """
+        Raise the error of a host not reachable
+
+        :param name: host:port
+        :type name: str
+
+        :param deadline: seconds waited
+        :type deadline: float
+
+        :raises Exception: always
+        """
+        raise Exception("%s not reachable after %s seconds" % (name, deadline))
+
+    def get_metrics(self):
+        """
+        Return the waiting metrics of each host
+
+        :return: number of waits, probes, failures and seconds until the last wait succeed by host:port
+        :rtype: dict(str, dict)
+        """
+        with self.lock:
+            return dict((name, dict(metrics)) for name, metrics in self.metrics.items())
@@ -1,161 +1,287 @@
-from globus_sdk import TransferData, AccessTokenAuthorizer, TransferClient
 import globus_sdk
-import os 
+import json
+import logging
+import os
+import threading
+from collections import deque
+from time import time
+from uuid import uuid4
 
-class GlobusManager:
+from dagon.staging import StagingResult
+
+
+class GlobusItem(object):
     """
-    **Manages the data transference between two nodes using globus**
+    **A path transferred by the** :class:`dagon.communication.data_transfer.GlobusManager`
 
-    :ivar _from: endpoint ID of the data source machine
-    :vartype _from: str
+    :ivar hops: source endpoint, destination endpoint, source path and destination path of each transfer,
+        two when the data goes through the intermediate endpoint
+    :vartype hops: list(tuple(str, str, str, str))
 
-    :ivar _to: endpoint ID of the data destiny machine
-    :vartype _to: str
+    :ivar recursive: True if the path is a directory
+    :vartype recursive: bool
 
-    """
+    :ivar result: result of the transfer, completed when the last hop ends
+    :vartype result: :class:`dagon.staging.StagingResult`
 
-    TRANSFER_TOKEN = "Ag82ObxMdj80Gxd2ex7oVJWJnPv4dWQ8ndkpblOz51n42G6g96i8Cjqx5zKDE4jM5E2OzrJgMYMlNYC7NmMbYfk6VP"
+    :ivar timeout: seconds since the item was requested until the transfer is considered failed, None for no
+        limit
+    :vartype timeout: float
 
-    def __init__(self, _from, _to, client_id, intermediate):
+    :ivar alone: True if the item is submitted in a transfer of its own, after a batch it was in failed
+    :vartype alone: bool
+    """
 
+    def __init__(self, hops, recursive, timeout=None):
         """
+        :param hops: source endpoint, destination endpoint, source path and destination path of each transfer
+        :type hops: list(tuple(str, str, str, str))
 
-        :param _from: endpoint ID of the data source machine
-        :type _from: str
+        :param recursive: True if the path is a directory
+        :type recursive: bool
 
-        :param _to:  endpoint ID of the data destiny machine
-        :type _to: str
+        :param timeout: seconds since the item was requested until the transfer is considered failed
+        :type timeout: float
         """
+        self.hops = deque(hops)
+        self.recursive = recursive
+        self.timeout = timeout
+        self.alone = False
+        self.result = StagingResult(hops[0][2], hops[-1][3], "globus")
+        self.task_id = None
+        self.queued_time = time()
+        self.start_time = time()
+        self.event = threading.Event()
+
+    def current(self):
+        """
+        :return: source endpoint, destination endpoint, source path and destination path of the current hop
+        :rtype: tuple(str, str, str, str)
+        """
+        return self.hops[0]
 
-        self._from = _from
-        self._to = _to
-        self.intermediate = intermediate
-
-        # Initialize the Globus Native App Client to transfer data
-        #print(client_id)
+    def finish(self, error=None):
+        """
+        Release the item
 
-        client = globus_sdk.NativeAppAuthClient(client_id)
-        client.oauth2_start_flow()
-        authorize_url = client.oauth2_get_authorize_url()
-        print(f"Please go to this URL and login:\n\n{authorize_url}\n")
+        :param error: reason of the failure, None if the data was transferred
+        :type error: str
+        """
+        self.result.error = error
+        self.result.elapsed = time() - self.start_time
+        self.event.set()
 
-        auth_code = input("Please enter the code you get after login here: ").strip()
-        token_response = client.oauth2_exchange_code_for_tokens(auth_code)
+    def done(self):
+        """
+        :return: True if the item was released
+        :rtype: bool
+        """
+        return self.event.is_set()
 
-        globus_auth_data = token_response.by_resource_server["auth.globus.org"]
-        globus_transfer_data = token_response.by_resource_server["transfer.api.globus.org"]
+    def wait(self, timeout=None):
+        """
+        Wait until the data is transferred
 
-        globus_auth_token = globus_auth_data["access_token"]
-        transfer_token = globus_transfer_data["access_token"]
+        :param timeout: seconds to wait
+        :type timeout: float
 
-        #print("AUTH GLOBUS TOKEN    ", globus_auth_token)
-        #print("TRANSFER TOKEN    ", transfer_token)
-        
-        authorizer = globus_sdk.AccessTokenAuthorizer(transfer_token)
-        self.transfer_client = globus_sdk.TransferClient(authorizer=authorizer)
-        # Crea un cliente de transferencia de Globus
-        #transfer_token = globus_sdk.RefreshTokenAuthorizer(globus_auth_token, client)
-        #self.transfer_client = globus_sdk.TransferClient(authorizer=transfer_token)
+        :return: result of the transfer, None if the timeout expires
+        :rtype: :class:`dagon.staging.StagingResult`
+        """
+        if not self.event.wait(timeout):
+            return None
+        return self.result
 
-    def copy_directory(self, ori, destiny, intermediate):
+    def get_result(self):
+        """
+        Wait until the data is transferred or the timeout of the item expires
 
+        :return: result of the transfer, with an error if the timeout expired
+        :rtype: :class:`dagon.staging.StagingResult`
         """
-        copy a directory using globus transfer
+        timeout = None
+        if self.timeout is not None:
+            timeout = max(0.0, self.start_time + self.timeout - time())
+        if self.wait(timeout) is None:
+            self.result.error = "Timeout waiting for the Globus transfer %s" % self.task_id
+        return self.result
 
-        :param ori: path where the data is in the source machine
-        :type ori: str
 
-        :param destiny: path where the data will be put on the destiny machine
-        :type destiny: str
+class GlobusManager(object):
+    """
+    **Manages the data transference between two nodes using globus**
 
-        :param tc: globus transfer client
-        :type tc: :class:`globus_sdk.TransferClient`
+    A single manager is kept per Globus client. The user logs in once, and the refresh token is stored to
+    not ask for it again. The items requested by all the tasks in a short window are submitted together, in
+    a single transfer per pair of endpoints, by a background thread. The thread polls the transfers and
+    releases each item as soon as its data is transferred, without waiting for the rest of the batch. When a
+    batch fails, the items it transferred are released and the others are submitted again, each one in its own
+    transfer, so only the item with the bad path fails. An error of the Globus service fails the items
+    involved, it never stops the thread.
 
-        :return: status of the transference
-        :rtype: str
-        """
+    :ivar client_id: ID of the Globus native app
+    :vartype client_id: str
+
+    :ivar intermediate: endpoint ID where the files go through, None to transfer them directly
+    :vartype intermediate: str
 
-        print("ori: ", self._from)
-        print("destiny: ", self._to)
+    :ivar transfer_client: client of the Globus Transfer service
+    :vartype transfer_client: :class:`globus_sdk.TransferClient`
+    """
 
-        task_data = globus_sdk.TransferData(
-            source_endpoint=self._from, destination_endpoint=self._to
-        )
+    # Seconds waiting for more items before submitting a batch
+    BATCH_DELAY = 1
 
-        #transference_data = TransferData(tc, self._from,
-        #                                 self._to,
-        #                                 label="SDK example",
-        #                                 sync_level="checksum")
+    # Seconds between the polls of the transfers submitted
+    POLL_INTERVAL = 5
 
-        task_data.add_item(ori, destiny, recursive=True)
+    # Statuses of a Globus task that has ended
+    FINAL_STATUSES = ["SUCCEEDED", "FAILED"]
 
-        transfer_result = self.transfer_client.submit_transfer(task_data)
-        #transfer_result = tc.submit_transfer(transference_data)
-        while not self.transfer_client.task_wait(transfer_result["task_id"], timeout=1):
-            task = self.transfer_client.get_task(transfer_result["task_id"])
+    # Seconds a task waits for its transfers
+    TIMEOUT = 24 * 3600
 
-            if task['nice_status'] == "NOT_A_DIRECTORY":
-                self.transfer_client.cancel_task(task["task_id"])
-                return task['nice_status']
-        return "OK"
+    instances = {}
+    instance_lock = threading.Lock()
 
-    def copy_file(self, ori, destiny, intermediate):
+    def __init__(self, client_id, intermediate=None, token_file=None, transfer_client=None, batch_delay=None,
+                 poll_interval=None, timeout=None):
         """
-        copy a file using globus
+        :param client_id: ID of the Globus native app
+        :type client_id: str
 
-        :param ori: path where the data is in the source machine
-        :type ori: str
+        :param intermediate: endpoint ID where the files go through, None to transfer them directly
+        :type intermediate: str
 
-        :param destiny: path where the data will be put on the destiny machine
-        :type destiny: str
+        :param token_file: file where the refresh token is stored. By default, ~/.dagon/globus_tokens.json
+        :type token_file: str
 
-        :param tc: globus transfer client
-        :type tc: :class:`globus_sdk.TransferClient`
+        :param transfer_client: client of the Globus Transfer service, by default it is created logging in
+        :type transfer_client: :class:`globus_sdk.TransferClient`
 
-        :return: status of the transference
-        :rtype: str
-        """
+        :param batch_delay: seconds waiting for more items before submitting a batch
+        :type batch_delay: float
 
-        # transference_data = TransferData(tc, self._from,
-        #                                  self._to,
-        #                                  label="SDK example",
-        #                                  sync_level="checksum")
+        :param poll_interval: seconds between the polls of the transfers submitted
+        :type poll_interval: float
 
-        #copy the data from the source endpoint to the Globus intermediate endpoint
+        :param timeout: seconds a task waits for its transfers, 0 for no limit
+        :type timeout: float
+        """
+        self.client_id = client_id
+        self.intermediate = intermediate or None
+        self.token_file = os.path.expanduser(token_file or os.path.join("~", ".dagon", "globus_tokens.json"))
+        self.batch_delay = float(batch_delay) if batch_delay is not None else GlobusManager.BATCH_DELAY
+        self.poll_interval = float(poll_interval) if poll_interval is not None else GlobusManager.POLL_INTERVAL
+        self.timeout = float(timeout) if timeout not in [None, ""] else GlobusManager.TIMEOUT
+        if self.timeout <= 0:
+            self.timeout = None
+        self.logger = logging.getLogger()
+        self.transfer_client = transfer_client
+        if self.transfer_client is None:
+            self.transfer_client = globus_sdk.TransferClient(authorizer=self.get_authorizer())
+        self.condition = threading.Condition()
+        self.pending = []
+        self.active = {}
+        self.markers = {}
+        self.submitted = 0
+        self.thread = threading.Thread(target=self.loop, name="dagon-globus")
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def get_instance(client_id, intermediate=None, token_file=None, batch_delay=None, poll_interval=None,
+                     timeout=None):
+        """
+        Returns the process-wide manager of a Globus client
 
-        task_data = globus_sdk.TransferData(
-            source_endpoint=self._from, destination_endpoint=self.intermediate
-        )
-        
-        task_data.add_item(ori, intermediate, recursive=False)
-        transfer_result = self.transfer_client.submit_transfer(task_data)
-        
-        #print(f"Transferencia iniciada. ID de tarea: {transfer_result['task_id']}")
+        :param client_id: ID of the Globus native app
+        :type client_id: str
 
-        while not self.transfer_client.task_wait(transfer_result["task_id"], timeout=1):
-            continue # wait until transfer ends
+        :param intermediate: endpoint ID where the files go through, None to transfer them directly
+        :type intermediate: str
 
-        #copy the data from the source endpoint to the Globus intermediate endpoint
+        :param token_file: file where the refresh token is stored
+        :type token_file: str
 
-        task_data = globus_sdk.TransferData(
-            source_endpoint=self.intermediate, destination_endpoint=self._to
-        )
+        :param batch_delay: seconds waiting for more items before submitting a batch
+        :type batch_delay: float
 
-        task_data.add_item(intermediate, destiny, recursive=False)
-        transfer_result = self.transfer_client.submit_transfer(task_data)
-        
-        #print(f"Transferencia iniciada. ID de tarea: {transfer_result['task_id']}")
+        :param poll_interval: seconds between the polls of the transfers submitted
+        :type poll_interval: float
 
-        while not self.transfer_client.task_wait(transfer_result["task_id"], timeout=1):
-            continue # wait until transfer ends
+        :param timeout: seconds a task waits for its transfers, 0 for no limit
+        :type timeout: float
 
+        :return: the manager
+        :rtype: :class:`dagon.communication.data_transfer.GlobusManager`
+        """
+        with GlobusManager.instance_lock:
+            key = (client_id, intermediate or None)
+            if key not in GlobusManager.instances:
+                GlobusManager.instances[key] = GlobusManager(client_id, intermediate, token_file,
+                                                             batch_delay=batch_delay, poll_interval=poll_interval,
+                                                             timeout=timeout)
+            return GlobusManager.instances[key]
+
+    def get_authorizer(self):
+        """
+        Returns an authorizer refreshing the access token. The user has to log in only when there is no
+        refresh token stored
 
-        return "OK"
+        :return: the authorizer
+        :rtype: :class:`globus_sdk.RefreshTokenAuthorizer`
+        """
+        client = globus_sdk.NativeAppAuthClient(self.client_id)
+        tokens = None
+        if os.path.exists(self.token_file):
+            with open(self.token_file) as f:
+                tokens = json.load(f)
+
+        if tokens is None:
+            client.oauth2_start_flow(globus_sdk.TransferClient.scopes.all, refresh_tokens=True)
+            authorize_url = client.oauth2_get_authorize_url()
+            print(f"Please go to this URL and login:\n\n{authorize_url}\n")
+
+            auth_code = input("Please enter the code you get after login here: ").strip()
+            token_response = client.oauth2_exchange_code_for_tokens(auth_code)
+            tokens = token_response.by_resource_server["transfer.api.globus.org"]
+            self.save_tokens(tokens)
+
+        return globus_sdk.RefreshTokenAuthorizer(tokens["refresh_token"], client,
+                                                 access_token=tokens.get("access_token"),
+                                                 expires_at=tokens.get("expires_at_seconds"),
+                                                 on_refresh=self.on_refresh)
+
+    def on_refresh(self, token_response):
+        """
+        Store the tokens obtained when the access token is refreshed
+        """
+        self.save_tokens(token_response.by_resource_server["transfer.api.globus.org"])
 
-    def copy_data(self, ori, destiny, intermediate):
+    def save_tokens(self, tokens):
+        """
+        Store the transfer tokens, readable only by the user
+
+        :param tokens: tokens of the transfer resource server
+        :type tokens: dict(str, object)
+        """
+        os.makedirs(os.path.dirname(self.token_file), exist_ok=True)
+        fd = os.open(self.token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"refresh_token": tokens["refresh_token"], "access_token": tokens.get("access_token"),
+                       "expires_at_seconds": tokens.get("expires_at_seconds")}, f)
 
+    def submit(self, _from, _to, ori, destiny, intermediate_path=None):
         """
-        copy data using globus
+        Request a transfer, returning without waiting for it. Files go through the intermediate endpoint, if
+        there is one, and directories are transferred directly
+
+        :param _from: endpoint ID of the data source machine
+        :type _from: str
+
+        :param _to: endpoint ID of the data destiny machine
+        :type _to: str
 
         :param ori: path where the data is in the source machine
         :type ori: str
@@ -163,19 +289,217 @@ class GlobusManager:
         :param destiny: path where the data will be put on the destiny machine
         :type destiny: str
 
-        :raises Exception: a problem occurred during the transference
-        """
+        :param intermediate_path: path of the file on the intermediate endpoint, it must not be used by other
+            transfer. By default, the name of the file with a unique prefix
+        :type intermediate_path: str
 
-        #authorizer = AccessTokenAuthorizer(GlobusManager.TRANSFER_TOKEN)
-        #tc = TransferClient(authorizer=authorizer)
+        :return: item to wait for
+        :rtype: :class:`dagon.communication.data_transfer.GlobusItem`
+        """
+        recursive = os.path.isdir(ori)
+        if recursive or self.intermediate is None:
+            hops = [(_from, _to, ori, destiny)]
+        else:
+            # The items are released by their destination path, it can't be shared by files with the same name
+            intermediate_path = intermediate_path or uuid4().hex + "-" + os.path.basename(ori)
+            hops = [(_from, self.intermediate, ori, intermediate_path),
+                    (self.intermediate, _to, intermediate_path, destiny)]
+        item = GlobusItem(hops, recursive, self.timeout)
+        self.enqueue(item)
+        return item
+
+    def enqueue(self, item):
+        """
+        Add an item to the next batch
+        """
+        with self.condition:
+            item.queued_time = time()
+            item.task_id = None
+            self.pending.append(item)
+            self.condition.notify()
 
-        if os.path.isdir(ori):  # if the path is a directory
-            res = self.copy_directory(ori, destiny, intermediate)
+    def loop(self):
+        """
+        Body of the thread submitting the batches and polling the transfers
+        """
+        last_poll = 0
+        while True:
+            batch = []
+            try:
+                with self.condition:
+                    now = time()
+                    timeouts = []
+                    if len(self.pending):
+                        timeouts.append(self.pending[0].queued_time + self.batch_delay - now)
+                    if len(self.active):
+                        timeouts.append(last_poll + self.poll_interval - now)
+                    if not len(timeouts):
+                        self.condition.wait()
+                    elif min(timeouts) > 0:
+                        self.condition.wait(min(timeouts))
+                    now = time()
+                    if len(self.pending) and now >= self.pending[0].queued_time + self.batch_delay:
+                        batch, self.pending = self.pending, []
+
+                if len(batch):
+                    self.submit_batch(batch)
+                if len(self.active) and time() >= last_poll + self.poll_interval:
+                    last_poll = time()
+                    for task_id in list(self.active.keys()):
+                        self.poll(task_id)
+            except Exception as e:
+                # The items of the batch not submitted can't be waited forever
+                self.logger.error("Globus manager: %s", e)
+                for item in batch:
+                    if item.task_id is None and not item.done():
+                        item.finish("Couldn't submit the transfer: %s" % e)
+                last_poll = time()
+
+    def submit_batch(self, batch):
+        """
+        Submit the items in a transfer per pair of endpoints
+        """
+        groups = {}
+        for item in batch:
+            source, destination, _, _ = item.current()
+            groups.setdefault((source, destination, id(item) if item.alone else None), []).append(item)
+
+        for (source, destination, _), items in groups.items():
+            try:
+                task_data = globus_sdk.TransferData(source_endpoint=source, destination_endpoint=destination,
+                                                    label="DAGonStar stage-in")
+                for item in items:
+                    _, _, ori, destiny = item.current()
+                    task_data.add_item(ori, destiny, recursive=item.recursive)
+                task_id = self.transfer_client.submit_transfer(task_data)["task_id"]
+            except Exception as e:
+                for item in items:
+                    item.finish("Couldn't submit the transfer: %s" % e)
+                continue
+            self.submitted += 1
+            self.logger.debug("Globus transfer %s submitted with %d items from %s to %s", task_id, len(items),
+                              source, destination)
+            for item in items:
+                item.task_id = task_id
+            self.active[task_id] = items
+            self.markers[task_id] = None
+
+    def poll(self, task_id):
+        """
+        Release the items of a transfer whose data is transferred, or all of them if it ended. An error of the
+        Globus service is retried in the next poll, any other error fails the remaining items
+        """
+        items = self.active[task_id]
+        try:
+            task = self.transfer_client.get_task(task_id)
+            if task["status"] != "SUCCEEDED":
+                # Release the files already transferred, also the ones of a failed transfer
+                self.release_transferred(task_id)
+        except globus_sdk.GlobusError as e:
+            # The transfer is polled again later
+            self.logger.warning("Couldn't poll the Globus transfer %s: %s", task_id, e)
+            return
+        except Exception as e:
+            self.logger.error("Couldn't poll the Globus transfer %s: %s", task_id, e)
+            self.release(task_id, str(e))
+            return
+
+        if task.get("nice_status") == "NOT_A_DIRECTORY":
+            try:
+                self.transfer_client.cancel_task(task_id)
+            except Exception as e:
+                self.logger.warning("Couldn't cancel the Globus transfer %s: %s", task_id, e)
+            self.retry(task_id, "NOT_A_DIRECTORY")
+        elif task["status"] == "SUCCEEDED":
+            self.release(task_id, None)
+        elif task["status"] == "FAILED":
+            self.retry(task_id, task.get("nice_status") or "FAILED")
+
+    def release_transferred(self, task_id):
+        """
+        Release the files of a transfer whose data is transferred, reading only the new records
+        """
+        items = self.active[task_id]
+        transferred = set()
+        marker = self.markers[task_id]
+        while True:
+            if marker is not None:
+                response = self.transfer_client.task_successful_transfers(task_id, marker=marker)
+            else:
+                response = self.transfer_client.task_successful_transfers(task_id)
+            transferred.update(record["destination_path"] for record in response["DATA"])
+            if not response.get("next_marker"):
+                break
+            marker = self.markers[task_id] = response["next_marker"]
+        for item in [item for item in items if not item.recursive and item.current()[3] in transferred]:
+            items.remove(item)
+            self.next_hop(item)
+
+    def release(self, task_id, error):
+        """
+        Release the remaining items of a transfer that ended
+        """
+        for item in self.active.pop(task_id):
+            if error is None:
+                self.next_hop(item)
+            else:
+                item.finish("Globus transfer %s failed: %s" % (task_id, error))
+        self.markers.pop(task_id, None)
+
+    def retry(self, task_id, error):
+        """
+        Handle a transfer that failed. Globus doesn't tell which item failed, so the items not transferred are
+        submitted again, each one in its own transfer, and only an item that was alone in its transfer fails
+        """
+        items = self.active[task_id]
+        if len(items) <= 1 or all(item.alone for item in items):
+            self.release(task_id, error)
+            return
+        self.logger.warning("Globus transfer %s failed: %s, submitting its %d items on their own", task_id, error,
+                            len(items))
+        self.active.pop(task_id)
+        self.markers.pop(task_id, None)
+        for item in items:
+            item.alone = True
+            self.enqueue(item)
+
+    def next_hop(self, item):
+        """
+        Release an item whose current hop ended, or submit its next hop in the next batch
+        """
+        item.hops.popleft()
+        if len(item.hops):
+            self.enqueue(item)
         else:
-            res = self.copy_file(ori, destiny, intermediate)
+            item.finish()
+
+    def wait(self, items, timeout=None):
+        """
+        Wait until the items are transferred
+
+        :param items: items requested
+        :type items: list(:class:`dagon.communication.data_transfer.GlobusItem`)
 
-        if res != "OK":
-            raise Exception(res)
+        :param timeout: seconds to wait for each one
+        :type timeout: float
+
+        :return: result of each item, with an error if the timeout expired
+        :rtype: list(:class:`dagon.staging.StagingResult`)
+        """
+        results = []
+        for item in items:
+            if item.wait(timeout) is None:
+                item.result.error = "Timeout waiting for the Globus transfer %s" % item.task_id
+            results.append(item.result)
+        return results
+
+    def get_metrics(self):
+        """
+        :return: transfers submitted, items waiting to be submitted and transfers running
+        :rtype: dict(str, int)
+        """
+        with self.condition:
+            return {"submitted": self.submitted, "pending": len(self.pending), "active": len(self.active)}
 
 
 class SKYCDS:
@@ -1,8 +1,292 @@
+import threading
+from contextlib import contextmanager
+
 import paramiko
 from fabric.api import local
 from paramiko import SSHClient
 
-from dagon.communication import is_port_open
+from dagon.communication import ConnectivityWaiter
+
+
+class SSHConnection(object):
+    """
+    **SSH connection shared by all the tasks executed on the same host with the same user and key**
+
+    The channels of the connection are multiplexed between the tasks, but no more than the MaxSessions
+    allowed by the server are opened at the same time. The SFTP session is opened once and reused.
+
+    :ivar username: ssh username
+    :vartype username: str
+
+    :ivar host: IP of the remote machine
+    :vartype host: str
+
+    :ivar keypath: path to the private key
+    :vartype keypath: str
+
+    :ivar max_sessions: maximum number of channels opened at the same time
+    :vartype max_sessions: int
+    """
+
+    def __init__(self, username, host, keypath, max_sessions=10, keepalive=30, connect_timeout=None):
+        """
+        :param username: ssh username
+        :type username: str
+
+        :param host: IP of the remote machine
+        :type host: str
+
+        :param keypath: path to the private key
+        :type keypath: str
+
+        :param max_sessions: maximum number of channels opened at the same time
+        :type max_sessions: int
+
+        :param keepalive: seconds between keepalive packets, 0 to disable them
+        :type keepalive: int
+
+        :param connect_timeout: seconds waiting for the SSH port to be reachable
+        :type connect_timeout: float
+        """
+        self.username = username
+        self.host = host
+        self.keypath = keypath
+        self.max_sessions = max(1, max_sessions)
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.client = None
+        self.sftp = None
+        self.in_use = 0
+        self.lock = threading.Lock()
+        self.sftp_lock = threading.Lock()
+        self.sessions = threading.Condition()
+
+    def connect(self):
+        """
+        Open the connection with the remote machine
+
+        :return: ssh connection
+        :rtype: :class:`paramiko.SSHClient`
+        """
+        ssh = SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ConnectivityWaiter.get_instance().wait(self.host, 22, self.connect_timeout)
+        if self.keypath is None:
+            ssh.connect(self.host, username=self.username)
+        else:
+            ssh.connect(self.host, username=self.username, key_filename=self.keypath)
+        if self.keepalive:
+            ssh.get_transport().set_keepalive(self.keepalive)
+        return ssh
+
+    def is_active(self):
+        """
+        Health check of the connection
+
+        :return: True if the connection is open
+        :rtype: bool
+        """
+        if self.client is None:
+            return False
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def get_client(self):
+        """
+        Returns the connection, opening it again if it is broken
+
+        :return: ssh connection
+        :rtype: :class:`paramiko.SSHClient`
+        """
+        with self.lock:
+            if not self.is_active():
+                if self.client is not None:
+                    self.client.close()
+                if self.sftp is not None:
+                    # the SFTP session is lost with the connection
+                    self.sftp = None
+                    with self.sessions:
+                        self.in_use -= 1
+                        self.sessions.notify()
+                self.client = self.connect()
+            return self.client
+
+    def get_sftp(self):
+        """
+        Returns the SFTP session of the connection, it takes one of the sessions allowed by the server
+
+        :return: SFTP session
+        :rtype: :class:`paramiko.SFTPClient`
+        """
+        client = self.get_client()
+        with self.lock:
+            if self.sftp is None:
+                self.sftp = client.open_sftp()
+                with self.sessions:
+                    self.in_use += 1
+            return self.sftp
+
+    @contextmanager
+    def session(self):
+        """
+        Hold one of the sessions allowed by the server while a channel is used
+        """
+        with self.sessions:
+            while self.in_use >= self.max_sessions:
+                self.sessions.wait()
+            self.in_use += 1
+        try:
+            yield
+        finally:
+            with self.sessions:
+                self.in_use -= 1
+                self.sessions.notify()
+
+    def refused_session(self):
+        """
+        The server refused a new channel, so its MaxSessions is lower than expected. The limit is
+        reduced to the number of sessions open
+        """
+        with self.sessions:
+            self.max_sessions = max(1, self.in_use - 1)
+
+    def exec_command(self, command):
+        """
+        Open a channel and execute a command, waiting until a session is available
+
+        :param command: command to execute on the remote machine
+        :type command: str
+
+        :return: exit code, standard output and standard error
+        :rtype: tuple(int, str, str)
+        """
+        while True:
+            with self.session():
+                try:
+                    _, stdout, stderr = self.get_client().exec_command(command)
+                except paramiko.ChannelException:
+                    if self.in_use <= 1:
+                        raise
+                    self.refused_session()
+                    continue
+                # Both streams are drained at the same time, the command blocks when one of them fills the
+                # channel window
+                errors = []
+                reader = threading.Thread(target=SSHConnection.read_stream, args=(stderr, errors))
+                reader.daemon = True
+                reader.start()
+                out = stdout.read()
+                reader.join()
+                code = stdout.channel.recv_exit_status()
+                return code, out.decode("utf-8", "replace"), b"".join(errors).decode("utf-8", "replace")
+
+    @staticmethod
+    def read_stream(stream, chunks):
+        """
+        Body of the thread reading the standard error of a command while its output is read
+        """
+        chunks.append(stream.read())
+
+    def close(self):
+        """
+        Close the connection
+        """
+        with self.lock:
+            if self.client is not None:
+                self.client.close()
+            self.client = None
+            self.sftp = None
+
+
+class SSHConnectionPool(object):
+    """
+    **Process-wide pool of SSH connections keyed by (user, host, key)**
+    """
+
+    # OpenSSH default MaxSessions
+    MAX_SESSIONS = 10
+
+    # Seconds between keepalive packets
+    KEEPALIVE = 30
+
+    # Seconds waiting for the SSH port of a host, None for the waiter default
+    CONNECT_TIMEOUT = None
+
+    instance = None
+    instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_instance():
+        """
+        Returns the process-wide pool
+
+        :return: the pool
+        :rtype: :class:`dagon.communication.ssh.SSHConnectionPool`
+        """
+        with SSHConnectionPool.instance_lock:
+            if SSHConnectionPool.instance is None:
+                SSHConnectionPool.instance = SSHConnectionPool()
+            return SSHConnectionPool.instance
+
+    @staticmethod
+    def configure(max_sessions=None, keepalive=None, connect_timeout=None):
+        """
+        Change the parameters of the new connections
+
+        :param max_sessions: maximum number of channels opened at the same time on a connection
+        :type max_sessions: int
+
+        :param keepalive: seconds between keepalive packets, 0 to disable them
+        :type keepalive: int
+
+        :param connect_timeout: seconds waiting for the SSH port of a host to be reachable
+        :type connect_timeout: float
+        """
+        if max_sessions is not None:
+            SSHConnectionPool.MAX_SESSIONS = int(max_sessions)
+        if keepalive is not None:
+            SSHConnectionPool.KEEPALIVE = int(keepalive)
+        if connect_timeout is not None:
+            SSHConnectionPool.CONNECT_TIMEOUT = float(connect_timeout)
+
+    def get(self, username, host, keypath):
+        """
+        Returns the connection with a remote machine, it is opened the first time it is used
+
+        :param username: ssh username
+        :type username: str
+
+        :param host: IP of the remote machine
+        :type host: str
+
+        :param keypath: path to the private key
+        :type keypath: str
+
+        :return: shared connection
+        :rtype: :class:`dagon.communication.ssh.SSHConnection`
+        """
+        key = (username, host, keypath)
+        with self.lock:
+            if key not in self.connections:
+                self.connections[key] = SSHConnection(username, host, keypath,
+                                                      max_sessions=SSHConnectionPool.MAX_SESSIONS,
+                                                      keepalive=SSHConnectionPool.KEEPALIVE,
+                                                      connect_timeout=SSHConnectionPool.CONNECT_TIMEOUT)
+            return self.connections[key]
+
+    def close_all(self):
+        """
+        Close all the connections of the pool
+        """
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections = {}
+        for connection in connections:
+            connection.close()
 
 
 # To manage SSH connections
@@ -41,6 +325,7 @@ class SSHManager:
         self.username = username
         self.host = host
         self.keypath = keypath
+        self.pooled = SSHConnectionPool.get_instance().get(username, host, keypath)
         self.connection = self.get_ssh_connection()
 
     def get_connection(self):
@@ -49,7 +334,7 @@ class SSHManager:
 
         :return: connection
         """
-        return self.connection
+        return self.pooled.get_client()
 
     def create_file(self, filepath, content):
         """
@@ -62,27 +347,20 @@ class SSHManager:
         :type filepath: str
         """
 
-        sftp = self.get_connection().open_sftp()
-        f = sftp.open(filepath, 'w')
-        f.write(content)
-        f.close()
+        sftp = self.pooled.get_sftp()
+        with self.pooled.sftp_lock:
+            f = sftp.open(filepath, 'w')
+            f.write(content)
+            f.close()
 
     def get_ssh_connection(self):
         """
-        returns a new ssh connection with the remote machine
+        returns the ssh connection with the remote machine, shared with the other tasks executed on it
 
         :return: ssh connection
         """
 
-        ssh = SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        while not is_port_open(self.host, 22):
-            continue
-        if self.keypath is None:
-            ssh.connect(self.host, username=self.username)
-        else:
-            ssh.connect(self.host, username=self.username, key_filename=self.keypath)
-        return ssh
+        return self.pooled.get_client()
 
     def execute_command(self, command):
         """
@@ -95,13 +373,10 @@ class SSHManager:
         :rtype: dict(str, object)
         """
 
-        _, stdout, stderr = self.connection.exec_command(command)
-        code = stdout.channel.recv_exit_status()
-        stdout = "\n".join(stdout.readlines())
-        stderr = "\n".join(stderr.readlines())
+        code, stdout, stderr = self.pooled.exec_command(command)
         if len(stderr):
             return {"code": 1, "message": stderr}
         elif code > 0:
             return {"code": 1, "message": stdout}
         else:
-            return {"code": 0, "output": stdout}
\ No newline at end of file
+            return {"code": 0, "output": stdout}
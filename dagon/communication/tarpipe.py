@@ -0,0 +1,330 @@
+import shutil
+import tempfile
+import threading
+from subprocess import Popen, PIPE, DEVNULL
+from time import time
+
+from paramiko import SSHException
+
+from dagon.staging import StagingResult
+
+
+class BandwidthMonitor(object):
+    """
+    **Keeps the bandwidth measured by the transfers with each host**
+
+    The bandwidth is a moving average of the bytes per second sent on the wire by the last transfers.
+    """
+
+    # Weight of the last transfer in the average
+    ALPHA = 0.5
+
+    # Transfers shorter than this are not taken into account
+    MIN_ELAPSED = 0.1
+
+    instance = None
+    instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bandwidth = {}
+
+    @staticmethod
+    def get_instance():
+        """
+        Returns the process-wide monitor
+
+        :return: the monitor
+        :rtype: :class:`dagon.communication.tarpipe.BandwidthMonitor`
+        """
+        with BandwidthMonitor.instance_lock:
+            if BandwidthMonitor.instance is None:
+                BandwidthMonitor.instance = BandwidthMonitor()
+            return BandwidthMonitor.instance
+
+    def record(self, host, nbytes, elapsed):
+        """
+        Add a transfer to the bandwidth of a host
+
+        :param host: IP of the remote host
+        :type host: str
+
+        :param nbytes: bytes sent on the wire
+        :type nbytes: int
+
+        :param elapsed: seconds spent
+        :type elapsed: float
+        """
+        if elapsed < BandwidthMonitor.MIN_ELAPSED or nbytes <= 0:
+            return
+        with self.lock:
+            current = nbytes / elapsed
+            previous = self.bandwidth.get(host)
+            if previous is not None:
+                current = BandwidthMonitor.ALPHA * current + (1 - BandwidthMonitor.ALPHA) * previous
+            self.bandwidth[host] = current
+
+    def get(self, host):
+        """
+        :param host: IP of the remote host
+        :type host: str
+
+        :return: bytes per second, None if nothing was transferred with the host
+        :rtype: float
+        """
+        with self.lock:
+            return self.bandwidth.get(host)
+
+
+class TarPipe(object):
+    """
+    **Streams a tar archive over a single SSH channel**
+
+    Many small files are sent in a single stream instead of a request per file. The stream is compressed
+    with zstd or lz4 when the bandwidth measured with the host is lower than the speed of the compressor
+    and the compressor is installed on both sides.
+
+    :ivar connection: pooled connection with the remote host
+    :vartype connection: :class:`dagon.communication.ssh.SSHConnection`
+
+    :ivar compression: zstd, lz4, none or auto to choose it by the bandwidth
+    :vartype compression: str
+    """
+
+    # Compressor, compress and decompress commands and the bandwidth (bytes/s) under which it pays off
+    COMPRESSORS = [("zstd", "zstd -1 -q -c -T0", "zstd -q -dc", 100 * 1024 ** 2),
+                   ("lz4", "lz4 -q -c", "lz4 -q -dc", 500 * 1024 ** 2)]
+
+    # Bytes read from the stream each time
+    BUFFER_SIZE = 1024 ** 2
+
+    remote_compressors = {}
+    remote_lock = threading.Lock()
+
+    def __init__(self, connection, compression="auto"):
+        """
+        :param connection: pooled connection with the remote host
+        :type connection: :class:`dagon.communication.ssh.SSHConnection`
+
+        :param compression: zstd, lz4, none or auto to choose it by the bandwidth
+        :type compression: str
+        """
+        self.connection = connection
+        self.compression = compression
+
+    @staticmethod
+    def get_remote_compressors(connection):
+        """
+        Returns the compressors installed on a remote host, they are checked once per host
+
+        :param connection: pooled connection with the remote host
+        :type connection: :class:`dagon.communication.ssh.SSHConnection`
+
+        :return: names of the compressors
+        :rtype: set(str)
+        """
+        with TarPipe.remote_lock:
+            if connection.host not in TarPipe.remote_compressors:
+                names = [c[0] for c in TarPipe.COMPRESSORS]
+                _, out, _ = connection.exec_command("for c in %s; do command -v $c >/dev/null && echo $c; done"
+                                                    % " ".join(names))
+                TarPipe.remote_compressors[connection.host] = set(out.split())
+            return TarPipe.remote_compressors[connection.host]
+
+    @staticmethod
+    def choose_compression(host, available, compression="auto"):
+        """
+        Choose the compressor of a stream
+
+        :param host: IP of the remote host, used to get the bandwidth measured
+        :type host: str
+
+        :param available: compressors installed on both sides
+        :type available: set(str)
+
+        :param compression: zstd, lz4, none or auto to choose it by the bandwidth
+        :type compression: str
+
+        :return: name, compress and decompress commands, None to not compress
+        :rtype: tuple(str, str, str)
+        """
+        if compression == "none":
+            return None
+        bandwidth = BandwidthMonitor.get_instance().get(host)
+        for name, compress, decompress, threshold in TarPipe.COMPRESSORS:
+            if name not in available:
+                continue
+            if compression == name:
+                return name, compress, decompress
+            # Until the bandwidth is measured, the fastest compressor is used
+            if compression == "auto" and (bandwidth is None and name == "lz4" or
+                                          bandwidth is not None and bandwidth < threshold):
+                return name, compress, decompress
+        return None
+
+    @staticmethod
+    def split(path):
+        """
+        Split a path in its directory and its last element, which can be a glob pattern
+
+        :return: directory and last element
+        :rtype: tuple(str, str)
+        """
+        path = path.rstrip("/")
+        pos = path.rfind("/")
+        if pos == -1:
+            return ".", path
+        return path[:pos] if pos > 0 else "/", path[pos + 1:]
+
+    @staticmethod
+    def pack_command(src, compressor=None):
+        """
+        :param src: path of the data, its last element can be a glob pattern expanded by the shell
+        :type src: str
+
+        :param compressor: compressor chosen
+        :type compressor: tuple(str, str, str)
+
+        :return: command writing the archive on the standard output
+        :rtype: str
+        """
+        directory, name = TarPipe.split(src)
+        command = "cd '" + directory + "' && tar -cf - " + name
+        if compressor is not None:
+            command += " | " + compressor[1]
+        return command
+
+    @staticmethod
+    def unpack_command(dst, compressor=None):
+        """
+        :param dst: path of the data on the destination, the archive is extracted in its directory
+        :type dst: str
+
+        :param compressor: compressor chosen
+        :type compressor: tuple(str, str, str)
+
+        :return: command reading the archive from the standard input
+        :rtype: str
+        """
+        directory, _ = TarPipe.split(dst)
+        command = "mkdir -p '" + directory + "' && cd '" + directory + "' && "
+        if compressor is not None:
+            command += compressor[2] + " | "
+        return command + "tar -xf -"
+
+    def get_compressor(self):
+        """
+        :return: compressor of the stream with this host
+        :rtype: tuple(str, str, str)
+        """
+        local = set(c[0] for c in TarPipe.COMPRESSORS if shutil.which(c[0]) is not None)
+        if self.compression == "none" or not len(local):
+            return None
+        available = local & TarPipe.get_remote_compressors(self.connection)
+        return TarPipe.choose_compression(self.connection.host, available, self.compression)
+
+    def upload(self, src, dst):
+        """
+        Send local data to the remote host
+
+        :param src: local path, its last element can be a glob pattern
+        :type src: str
+
+        :param dst: remote path
+        :type dst: str
+
+        :return: result of the transfer
+        :rtype: list(:class:`dagon.staging.StagingResult`)
+        """
+        compressor = self.get_compressor()
+        return self.stream(src, dst, compressor, TarPipe.pack_command(src, compressor),
+                           TarPipe.unpack_command(dst, compressor), upload=True)
+
+    def download(self, src, dst):
+        """
+        Receive data from the remote host
+
+        :param src: remote path, its last element can be a glob pattern
+        :type src: str
+
+        :param dst: local path
+        :type dst: str
+
+        :return: result of the transfer
+        :rtype: list(:class:`dagon.staging.StagingResult`)
+        """
+        compressor = self.get_compressor()
+        return self.stream(src, dst, compressor, TarPipe.unpack_command(dst, compressor),
+                           TarPipe.pack_command(src, compressor), upload=False)
+
+    @staticmethod
+    def read_stderr(channel, chunks):
+        """
+        Body of the thread reading the standard error of the remote command, so it never blocks writing it
+        """
+        for data in iter(lambda: channel.recv_stderr(TarPipe.BUFFER_SIZE), b""):
+            chunks.append(data)
+
+    def stream(self, src, dst, compressor, local_command, remote_command, upload):
+        """
+        Copy the archive between a local process and a channel executing the remote command. The standard
+        error of the local process goes to a temporary file and the one of the remote command is read by a
+        thread, so none of them blocks the stream when it writes too much
+        """
+        method = "tar" if compressor is None else "tar+" + compressor[0]
+        result = StagingResult(src, dst, method)
+        start_time = time()
+        local_code, remote_code, remote_error = None, None, []
+        with tempfile.TemporaryFile() as local_error:
+            process = Popen(["/bin/bash", "-o", "pipefail", "-c", local_command], stdin=DEVNULL if upload else PIPE,
+                            stdout=PIPE if upload else DEVNULL, stderr=local_error)
+            try:
+                with self.connection.session():
+                    channel = self.connection.get_client().get_transport().open_session()
+                    reader = threading.Thread(target=TarPipe.read_stderr, args=(channel, remote_error))
+                    reader.daemon = True
+                    try:
+                        channel.exec_command(remote_command)
+                        reader.start()
+                        if upload:
+                            for data in iter(lambda: process.stdout.read1(TarPipe.BUFFER_SIZE), b""):
+                                channel.sendall(data)
+                                result.bytes += len(data)
+                            channel.shutdown_write()
+                        else:
+                            for data in iter(lambda: channel.recv(TarPipe.BUFFER_SIZE), b""):
+                                process.stdin.write(data)
+                                result.bytes += len(data)
+                            process.stdin.close()
+                        remote_code = channel.recv_exit_status()
+                    finally:
+                        channel.close()
+                        if reader.is_alive():
+                            reader.join()
+                local_code = process.wait()
+            except (IOError, OSError, EOFError, SSHException) as e:
+                result.error = str(e) or type(e).__name__
+            finally:
+                # The local process doesn't outlive a broken stream
+                if process.poll() is None:
+                    process.kill()
+                process.wait()
+                for pipe in [process.stdin, process.stdout]:
+                    if pipe is not None and not pipe.closed:
+                        try:
+                            pipe.close()
+                        except (IOError, OSError):
+                            pass
+            local_error.seek(0)
+            errors = (local_error.read() + b"".join(remote_error)).decode("utf-8", "replace").strip()
+        result.elapsed = time() - start_time
+        result.size = result.bytes
+
+        if result.error is not None:
+            if len(errors):
+                result.error += "\n" + errors
+        elif local_code or remote_code:
+            result.error = errors or "tar pipe failed with code %d" % (local_code or remote_code)
+        else:
+            BandwidthMonitor.get_instance().record(self.connection.host, result.bytes, result.elapsed)
+        return [result]
@@ -0,0 +1,415 @@
+import glob
+import hashlib
+import json
+import os
+import posixpath
+import shutil
+import tempfile
+import threading
+from collections import deque
+from time import time
+
+from dagon.communication.tarpipe import BandwidthMonitor
+from dagon.staging import StagingResult
+
+
+class SFTPTransferEngine(object):
+    """
+    **Transfers files over several SFTP channels of a pooled SSH connection**
+
+    The files are split in ranges of :attr:`CHUNK_SIZE` bytes transferred by :attr:`channels` workers,
+    each one with its own SFTP channel. The ranges transferred are written in a journal, so a failed
+    transfer is resumed from the missing ranges. The files are verified with SHA-256 at the end.
+
+    The journals are keyed on the source and on the destination relative to the scratch directory of the
+    destination task, so the next run of the workflow, with a new scratch directory, resumes the transfer:
+    the file partially transferred is moved to the new destination. The journals not used for
+    :attr:`JOURNAL_TTL` seconds are removed.
+
+    :ivar connection: pooled connection with the remote host
+    :vartype connection: :class:`dagon.communication.ssh.SSHConnection`
+
+    :ivar channels: number of channels used at the same time
+    :vartype channels: int
+    """
+
+    # Bytes of each range of a file
+    CHUNK_SIZE = 64 * 1024 ** 2
+
+    # Bytes read or written by each request
+    BUFFER_SIZE = 1024 ** 2
+
+    # SSH window of the channels, big enough to keep high latency links busy
+    WINDOW_SIZE = 64 * 1024 ** 2
+
+    # Maximum SSH packet
+    MAX_PACKET_SIZE = 256 * 1024
+
+    # Attempts for each range
+    RETRIES = 3
+
+    # Seconds a journal is kept without being used
+    JOURNAL_TTL = 7 * 24 * 3600
+
+    def __init__(self, connection, channels=4, chunk_size=None, verify=True, dst_root=None):
+        """
+        :param connection: pooled connection with the remote host
+        :type connection: :class:`dagon.communication.ssh.SSHConnection`
+
+        :param channels: number of channels used at the same time
+        :type channels: int
+
+        :param chunk_size: bytes of each range of a file
+        :type chunk_size: int
+
+        :param verify: True to compare the checksums of the files transferred
+        :type verify: bool
+
+        :param dst_root: scratch directory of the destination task
+        :type dst_root: str
+        """
+        self.connection = connection
+        # One session of the connection is kept by the shared SFTP channel
+        self.channels = max(1, min(int(channels), connection.max_sessions - 1))
+        self.chunk_size = int(chunk_size) if chunk_size is not None else SFTPTransferEngine.CHUNK_SIZE
+        self.verify = verify
+        self.dst_root = dst_root.rstrip("/") if dst_root is not None else None
+        self.journal_dir = os.path.join(tempfile.gettempdir(), "dagon-transfers")
+        self.lock = threading.Lock()
+
+    def tune(self):
+        """
+        Enlarge the window and packet sizes of the channels opened from now on the connection
+        """
+        transport = self.connection.get_client().get_transport()
+        transport.default_window_size = max(transport.default_window_size, SFTPTransferEngine.WINDOW_SIZE)
+        transport.default_max_packet_size = max(transport.default_max_packet_size,
+                                                SFTPTransferEngine.MAX_PACKET_SIZE)
+
+    def execute(self, command):
+        """
+        Execute a command on the remote host
+
+        :param command: command to execute
+        :type command: str
+
+        :return: standard output
+        :rtype: str
+
+        :raises Exception: the command failed
+        """
+        code, out, err = self.connection.exec_command(command)
+        if code:
+            raise Exception(err if len(err) else out)
+        return out
+
+    def upload(self, src, dst):
+        """
+        Upload the local files matching a pattern. When several files match, the destination is a directory
+
+        :param src: local path, it can be a glob pattern
+        :type src: str
+
+        :param dst: remote path
+        :type dst: str
+
+        :return: result of each file transferred
+        :rtype: list(:class:`dagon.staging.StagingResult`)
+        """
+        matches = sorted(glob.glob(src))
+        if not len(matches):
+            return [StagingResult(src, dst, "sftp", error="No such file or directory")]
+
+        files = []
+        directories = set()
+        for match in matches:
+            target = dst if len(matches) == 1 else dst + "/" + os.path.basename(match)
+            if os.path.isdir(match):
+                for root, _, names in os.walk(match):
+                    remote_root = posixpath.normpath(target + "/" + os.path.relpath(root, match))
+                    directories.add(remote_root)
+                    for name in names:
+                        path = os.path.join(root, name)
+                        files.append((path, remote_root + "/" + name, os.path.getsize(path)))
+            else:
+                directories.add(os.path.dirname(target))
+                files.append((match, target, os.path.getsize(match)))
+
+        # All the directories are created in a single exchange
+        self.execute("mkdir -p " + " ".join("'%s'" % d for d in sorted(directories) if len(d)))
+        return self.transfer(files, upload=True)
+
+    def download(self, src, dst):
+        """
+        Download the remote files matching a pattern. When several files match, the destination is a directory
+
+        :param src: remote path, it can be a glob pattern
+        :type src: str
+
+        :param dst: local path
+        :type dst: str
+
+        :return: result of each file transferred
+        :rtype: list(:class:`dagon.staging.StagingResult`)
+        """
+        try:
+            # Size, starting point and path of each file, the pattern is expanded by the remote shell
+            out = self.execute("find " + src + " -type f -printf '%s\\t%H\\t%p\\n'")
+        except Exception as e:
+            return [StagingResult(src, dst, "sftp", error=str(e).strip())]
+
+        entries = [line.strip("\n").split("\t") for line in out.splitlines() if len(line.strip())]
+        tops = set(entry[1] for entry in entries)
+        files = []
+        for size, top, path in entries:
+            target = dst if len(tops) == 1 else dst + "/" + os.path.basename(top.rstrip("/"))
+            if path != top:
+                target = target + "/" + os.path.relpath(path, top)
+            files.append((path, target, int(size)))
+        if not len(files):
+            return [StagingResult(src, dst, "sftp", error="No such file or directory")]
+        for _, target, _ in files:
+            os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+        return self.transfer(files, upload=False)
+
+    def get_journal(self, src, dst):
+        """
+        :return: path of the journal of a file transfer
+        :rtype: str
+        """
+        if self.dst_root is not None and dst.startswith(self.dst_root + "/"):
+            dst = posixpath.relpath(dst, self.dst_root)
+        key = "%s|%s|%s|%s" % (self.connection.host, self.connection.username, src, dst)
+        return os.path.join(self.journal_dir, hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+    def prune_journals(self):
+        """
+        Remove the journals not used for :attr:`JOURNAL_TTL` seconds
+        """
+        limit = time() - SFTPTransferEngine.JOURNAL_TTL
+        for name in os.listdir(self.journal_dir):
+            journal = os.path.join(self.journal_dir, name)
+            try:
+                if os.path.getmtime(journal) < limit:
+                    os.remove(journal)
+            except OSError:
+                pass
+
+    def load_journal(self, journal, size):
+        """
+        Returns the ranges already transferred of a file
+
+        :param journal: path of the journal
+        :type journal: str
+
+        :param size: size of the file
+        :type size: int
+
+        :return: offsets of the ranges transferred (None if the transfer has to start again) and destination
+            of the file partially transferred
+        :rtype: tuple(set(int), str)
+        """
+        try:
+            with open(journal) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None, None
+        if data.get("size") != size or data.get("chunk_size") != self.chunk_size:
+            return None, None
+        return set(data.get("done", [])), data.get("dst")
+
+    def save_journal(self, transfer):
+        """
+        Write the ranges transferred of a file
+        """
+        with open(transfer['journal'] + ".tmp", "w") as f:
+            json.dump({"size": transfer['size'], "chunk_size": self.chunk_size, "dst": transfer['dst'],
+                       "done": sorted(transfer['done'])}, f)
+        os.replace(transfer['journal'] + ".tmp", transfer['journal'])
+
+    def prepare(self, transfer, upload):
+        """
+        Create the destination file with its final size, unless the transfer is resumed. A file partially
+        transferred to other destination by a previous run is moved to the new one
+        """
+        done, previous = self.load_journal(transfer['journal'], transfer['size'])
+        moved = done is not None and previous is not None and previous != transfer['dst']
+        if upload:
+            sftp = self.connection.get_sftp()
+            with self.connection.sftp_lock:
+                if moved:
+                    try:
+                        sftp.stat(transfer['dst'])
+                    except IOError:
+                        try:
+                            sftp.rename(previous, transfer['dst'])
+                        except IOError:
+                            pass
+                if done is not None:
+                    try:
+                        if sftp.stat(transfer['dst']).st_size == transfer['size']:
+                            transfer['done'] = done
+                            return
+                    except IOError:
+                        pass
+                with sftp.open(transfer['dst'], "w") as f:
+                    f.truncate(transfer['size'])
+        else:
+            if moved and not os.path.exists(transfer['dst']) and os.path.isfile(previous):
+                shutil.move(previous, transfer['dst'])
+            if done is not None and os.path.exists(transfer['dst']) and \
+                    os.path.getsize(transfer['dst']) == transfer['size']:
+                transfer['done'] = done
+                return
+            with open(transfer['dst'], "wb") as f:
+                f.truncate(transfer['size'])
+        transfer['done'] = set()
+        self.save_journal(transfer)
+
+    def transfer(self, files, upload):
+        """
+        Transfer a list of files in ranges over several channels
+
+        :param files: source path, destination path and size of each file
+        :type files: list(tuple(str, str, int))
+
+        :param upload: True from the local host to the remote one
+        :type upload: bool
+
+        :return: result of each file transferred
+        :rtype: list(:class:`dagon.staging.StagingResult`)
+        """
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self.prune_journals()
+        self.tune()
+        start_time = time()
+        transfers = []
+        ranges = deque()
+        for src, dst, size in files:
+            transfer = {"src": src, "dst": dst, "size": size, "journal": self.get_journal(src, dst),
+                        "result": StagingResult(src, dst, "sftp", size=size), "pending": 0}
+            transfers.append(transfer)
+            try:
+                self.prepare(transfer, upload)
+            except (IOError, OSError) as e:
+                transfer['result'].error = str(e)
+                continue
+            for offset in range(0, size, self.chunk_size):
+                if offset in transfer['done']:
+                    continue
+                transfer['pending'] += 1
+                ranges.append((transfer, offset, min(self.chunk_size, size - offset)))
+
+        workers = [threading.Thread(target=self.worker, args=(ranges, upload, start_time))
+                   for _ in range(min(self.channels, len(ranges)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        if self.verify:
+            self.verify_checksums([t for t in transfers if t['result'].error is None], upload)
+        BandwidthMonitor.get_instance().record(self.connection.host, sum(t['result'].bytes for t in transfers),
+                                               time() - start_time)
+        for transfer in transfers:
+            result = transfer['result']
+            if result.error is None:
+                result.bytes_avoided = result.size - result.bytes
+                os.remove(transfer['journal'])
+            if result.elapsed == 0:
+                result.elapsed = time() - start_time
+        return [transfer['result'] for transfer in transfers]
+
+    def worker(self, ranges, upload, start_time):
+        """
+        Body of the threads transferring ranges, each one with its own SFTP channel
+        """
+        with self.connection.session():
+            sftp = None
+            while True:
+                with self.lock:
+                    if not len(ranges):
+                        break
+                    transfer, offset, length = ranges.popleft()
+                if transfer['result'].error is not None:
+                    continue
+                error = None
+                for _ in range(SFTPTransferEngine.RETRIES):
+                    try:
+                        if sftp is None:
+                            # The connection is opened again if it was broken
+                            sftp = self.connection.get_client().open_sftp()
+                        if upload:
+                            self.upload_range(sftp, transfer, offset, length)
+                        else:
+                            self.download_range(sftp, transfer, offset, length)
+                        error = None
+                        break
+                    except (IOError, OSError, EOFError) as e:
+                        error = str(e)
+                        sftp = None
+                with self.lock:
+                    transfer['pending'] -= 1
+                    if error is not None:
+                        transfer['result'].error = error
+                    else:
+                        transfer['result'].bytes += length
+                        transfer['done'].add(offset)
+                        self.save_journal(transfer)
+                    if transfer['pending'] == 0:
+                        transfer['result'].elapsed = time() - start_time
+            if sftp is not None:
+                sftp.close()
+
+    def upload_range(self, sftp, transfer, offset, length):
+        with open(transfer['src'], "rb") as local, sftp.open(transfer['dst'], "r+") as remote:
+            remote.set_pipelined(True)
+            local.seek(offset)
+            remote.seek(offset)
+            while length > 0:
+                data = local.read(min(SFTPTransferEngine.BUFFER_SIZE, length))
+                if not len(data):
+                    raise IOError("%s changed while it was transferred" % transfer['src'])
+                remote.write(data)
+                length -= len(data)
+
+    def download_range(self, sftp, transfer, offset, length):
+        requests = [(o, min(SFTPTransferEngine.BUFFER_SIZE, offset + length - o))
+                    for o in range(offset, offset + length, SFTPTransferEngine.BUFFER_SIZE)]
+        fd = os.open(transfer['dst'], os.O_WRONLY)
+        try:
+            with sftp.open(transfer['src'], "rb") as remote:
+                # The requests are pipelined
+                for (o, _), data in zip(requests, remote.readv(requests)):
+                    os.pwrite(fd, data, o)
+        finally:
+            os.close(fd)
+
+    def verify_checksums(self, transfers, upload):
+        """
+        Compare the SHA-256 of the local and remote copies, the remote ones are computed in a single exchange
+        """
+        if not len(transfers):
+            return
+        remote_paths = [t['dst'] if upload else t['src'] for t in transfers]
+        try:
+            out = self.execute("sha256sum " + " ".join("'%s'" % p for p in remote_paths))
+        except Exception as e:
+            for transfer in transfers:
+                transfer['result'].error = "Couldn't verify the checksum: %s" % str(e).strip()
+            return
+        remote_sums = {}
+        for line in out.splitlines():
+            if len(line.strip()):
+                checksum, path = line.strip().split(None, 1)
+                remote_sums[path] = checksum
+        for transfer, remote_path in zip(transfers, remote_paths):
+            sha = hashlib.sha256()
+            with open(transfer['src'] if upload else transfer['dst'], "rb") as f:
+                for block in iter(lambda: f.read(SFTPTransferEngine.BUFFER_SIZE), b""):
+                    sha.update(block)
+            if remote_sums.get(remote_path) != sha.hexdigest():
+                transfer['result'].error = "Checksum mismatch"
+                # The next attempt starts again
+                transfer['done'] = set()
+                self.save_journal(transfer)
@@ -6,6 +6,8 @@ import threading
 import copy 
 from requests.exceptions import ConnectionError
 from dagon.config import read_config
+from dagon.hostinfo import HostInfoCache
+from dagon.graph import validate, CycleError
 
 from time import time, sleep
 
@@ -27,14 +29,18 @@ class DAG_TPS(object):
             fileConfig(config_file)
 
         self.workflows = []
+        self.workflows_by_name = {}
         self.name = name
         self.logger = logging.getLogger()
         self.workflow_id = 0
         self.tasks = []
-        self.T_tasks_needed = []
-        self.T_tasks_needy = []
+        self.topology = None
         self.is_api_available = False
         self.running = False
+        try:
+            self.host_info = HostInfoCache(self.cfg['context']['ttl'])
+        except KeyError:
+            self.host_info = HostInfoCache()
 
 
 
@@ -52,7 +58,10 @@ class DAG_TPS(object):
         :type workflow: :class:`dagon.workflow`
         """
         self.workflows.append(workflow)
+        self.workflows_by_name.setdefault(workflow.name, workflow)
         workflow.set_dag_tps(self)
+        # the workflows share the context discovered on each host
+        workflow.set_host_info_cache(self.host_info)
         #if self.is_api_available:
         #    self.api.add_task(self.workflow_id, task)
 
@@ -70,10 +79,10 @@ class DAG_TPS(object):
         :rtype: :class:`dagon.task.Task` instance if it is found, None in other case
         """
 
-        # Check if the workflow is the current one
-        for wf in self.workflows:
-            if workflow_name == wf.name:
-                wf.find_task_by_name(wf.name,task_name)
+        # Check if the workflow is part of the meta-workflow
+        wf = self.workflows_by_name.get(workflow_name)
+        if wf is not None:
+            return wf.find_task_by_name(wf.name, task_name)
         return None
 
     def find_workflow_task(self,task_name):
@@ -152,29 +161,28 @@ class DAG_TPS(object):
         :param workflow: list of declared workflows
         :type workflow: list(class: dagon.workflow,...n)
 
-        Raise an Exception when a cylce is founded
+        :return: topological order and critical path of the meta-workflow
+        :rtype: :class:`dagon.graph.Topology`
+
+        :raises CycleError: when a cycle is found, with the tasks forming the cycle
 
         self.tasks is fill with all the task of each workflow
         """
+        tasks = []
         for workflow in self.workflows:
             for task in workflow.tasks:
-                for prev in task.prevs:
-                    if workflow.find_task_by_name(workflow.name,prev) is None: #if is a task from another workflow -  'do you need someone?'
-                        needed = False; needy = False
-                        self.T_tasks_needed.append(prev) #dependency task is added to the transversal ones
-                        #if the actual task is founded in the transversal, there exist a cycle.
-                        if task in self.T_tasks_needed or task.nexts in self.T_tasks_needed: needed=True #are you or your decendents needed?
-                        if prev in self.T_tasks_needy: needy=True #who you need is also needed?
-                        if needy and needed:
-                            logging.error('A cycle has been found')
-                            raise Exception("A cycle has been found from %s(%s) to %s(%s)" % (prev.name, prev.workflow.name,task.name,task.workflow.name))
-                        else:
-                            self.T_tasks_needy.append(task) #add the task and decendets to the needys array
-                            for t in task.nexts:
-                                self.T_tasks_needy.append(t)
+                tasks.append(task)
                 temp = task.remove_from_workflow() #the command is changed, deleating the workflow reference
                 self.tasks.append(temp)
 
+        # The transversal points are the predecessors from other workflows
+        try:
+            self.topology = validate(tasks)
+        except CycleError:
+            logging.error('A cycle has been found')
+            raise
+        return self.topology
+
 
 """
 TPPs were depercated. Were used for analytics but are not useful anymore
@@ -20,6 +20,9 @@ class DockerTask(Batch):
 
     """
 
+    # The elements of a parallel task are executed as tasks with their own container
+    FAN_OUT = False
+
     def __init__(self, name, command, image=None, container_id=None, working_dir=None, globusendpoint=None, remove=True, volume=None,transversal_workflow=None):
 
         """
@@ -57,6 +60,15 @@ class DockerTask(Batch):
         else:
             return super(DockerTask, cls).__new__(cls)
 
+    def get_slot_keys(self):
+        """
+        Returns the execution slots held by the task while it is executed
+
+        :return: list of slot keys (kind of slot, host)
+        :rtype: list(tuple(str, str))
+        """
+        return [("docker", None)]
+
     def include_command(self, body):
         """
         Include the command to execute in the script body
@@ -234,7 +246,7 @@ class DockerRemoteTask(RemoteTask, DockerTask):
         """
 
         RemoteTask.on_execute(self, launcher_script, script_name)
-        return self.ssh_connection.execute_command("bash " + self.working_dir + "/.dagon/" + script_name)
+        return self.execute_remote("bash " + self.working_dir + "/.dagon/" + script_name)
 
     def on_garbage(self):
         """
@@ -0,0 +1,373 @@
+import os
+import signal
+import selectors
+import threading
+from subprocess import Popen, PIPE, DEVNULL
+from time import time
+
+
+class ProcessHandle(object):
+    """
+    **Represents a command executed by the** :class:`dagon.executor.ProcessReaper`
+
+    :ivar command: command executed
+    :vartype command: str
+
+    :ivar process: process executing the command
+    :vartype process: :class:`subprocess.Popen`
+
+    :ivar result: execution result, None until the process ends
+    :vartype result: dict(str, object)
+    """
+
+    def __init__(self, command, process, timeout=None, stdout_path=None, stderr_path=None):
+        """
+        :param command: command executed
+        :type command: str
+
+        :param process: process executing the command
+        :type process: :class:`subprocess.Popen`
+
+        :param timeout: seconds before the process is killed
+        :type timeout: float
+
+        :param stdout_path: file where the standard output is streamed
+        :type stdout_path: str
+
+        :param stderr_path: file where the standard error is streamed
+        :type stderr_path: str
+        """
+        self.command = command
+        self.process = process
+        self.reaper = None
+        self.start_time = time()
+        self.deadline = self.start_time + timeout if timeout is not None else None
+        self.stdout = []
+        self.stderr = []
+        self.files = {}
+        if stdout_path is not None:
+            self.files['stdout'] = open(stdout_path, "ab")
+        if stderr_path is not None:
+            self.files['stderr'] = open(stderr_path, "ab")
+        self.open_streams = 2
+        self.pidfd = None
+        self.exited = False
+        self.status = None
+        self.rusage = None
+        self.drain_deadline = None
+        self.cancelled = False
+        self.timed_out = False
+        self.killed = False
+        self.kill_time = None
+        self.result = None
+        self.callbacks = []
+        self.callback_lock = threading.Lock()
+        self.event = threading.Event()
+
+    def on_data(self, stream, data):
+        """
+        Keep and stream a chunk of the output
+
+        :param stream: stdout or stderr
+        :type stream: str
+
+        :param data: chunk read
+        :type data: bytes
+        """
+        if self.result is not None:
+            # Written by a child left in background once the command ended
+            return
+        getattr(self, stream).append(data)
+        if stream in self.files:
+            self.files[stream].write(data)
+            self.files[stream].flush()
+
+    def finish(self, status, rusage):
+        """
+        Build the result once the process ended and call the completion callbacks
+
+        :param status: exit status returned by wait4
+        :type status: int
+
+        :param rusage: resource usage returned by wait4
+        :type rusage: :class:`resource.struct_rusage`
+        """
+        for f in self.files.values():
+            f.close()
+        if status is None:
+            # The process was reaped by someone else
+            exit_code = self.process.returncode if self.process.returncode is not None else 0
+        elif os.WIFEXITED(status):
+            exit_code = os.WEXITSTATUS(status)
+        else:
+            exit_code = -os.WTERMSIG(status)
+        self.process.returncode = exit_code
+
+        out = b"".join(self.stdout).decode("utf-8", "replace")
+        err = b"".join(self.stderr).decode("utf-8", "replace")
+        code, message = 0, ""
+        if exit_code != 0:
+            code = 1
+            message = err if len(err) else out
+            if self.timed_out:
+                message = "Timeout executing %s\n%s" % (self.command, message)
+            elif self.cancelled:
+                message = "Cancelled %s\n%s" % (self.command, message)
+        self.result = {"code": code, "message": message, "output": out, "error": err,
+                       "exit_code": exit_code, "elapsed": time() - self.start_time, "rusage": None}
+        if rusage is not None:
+            self.result['rusage'] = {"utime": rusage.ru_utime, "stime": rusage.ru_stime, "maxrss": rusage.ru_maxrss}
+        with self.callback_lock:
+            self.event.set()
+            callbacks = list(self.callbacks)
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                pass
+
+    def add_done_callback(self, callback):
+        """
+        Add a function to be called when the process ends. It is called from the reaper thread
+
+        :param callback: function called with the handle
+        :type callback: callable(:class:`dagon.executor.ProcessHandle`)
+        """
+        with self.callback_lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def cancel(self):
+        """
+        Terminate the process and its children
+        """
+        self.cancelled = True
+        self.signal(signal.SIGTERM)
+
+    def signal(self, sig):
+        """
+        Send a signal to the process group of the command
+
+        :param sig: signal to be sent
+        :type sig: int
+        """
+        if self.result is not None:
+            return
+        if self.kill_time is None and not self.killed:
+            self.kill_time = time() + ProcessReaper.KILL_GRACE
+            if self.reaper is not None:
+                # the reaper has to wake up to kill the process when the grace period expires
+                self.reaper.wake()
+        try:
+            os.killpg(self.process.pid, sig)
+        except OSError:
+            pass
+
+    def kill(self):
+        """
+        Kill the process group once the grace period after SIGTERM expired
+        """
+        self.killed = True
+        self.kill_time = None
+        self.signal(signal.SIGKILL)
+
+    def done(self):
+        """
+        :return: True if the process ended
+        :rtype: bool
+        """
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the process ends
+
+        :param timeout: seconds to wait
+        :type timeout: float
+
+        :return: execution result with the output (str), code (int), message (str), exit code (int),
+            elapsed time (float) and resource usage (dict), None if the timeout expires
+        :rtype: dict(str, object)
+        """
+        self.event.wait(timeout)
+        return self.result
+
+
+class ProcessReaper(object):
+    """
+    **Executes local commands without a thread per command**
+
+    A single thread reads the output of all the running processes, streaming it to their files, enforces
+    the timeouts and reaps the processes when they end, collecting their exit code and resource usage.
+    A command ends when its process exits, notified by a pidfd (or polled with wait4 when pidfds are not
+    available), not when its output is closed: the children it leaves in background keep the pipes open.
+    Their output is read for a short grace period and then discarded until they close it.
+    """
+
+    # Seconds between SIGTERM and SIGKILL for cancelled or timed out processes
+    KILL_GRACE = 5
+
+    # Seconds the output is read once the process exited
+    DRAIN_GRACE = 0.5
+
+    # Seconds between wait4 polls of the processes without a pidfd
+    POLL_INTERVAL = 0.05
+
+    instance = None
+    instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.handles = []
+        self.wake_read, self.wake_write = os.pipe()
+        self.selector.register(self.wake_read, selectors.EVENT_READ, None)
+        self.thread = threading.Thread(target=self.loop, name="dagon-reaper")
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def get_instance():
+        """
+        Returns the process-wide reaper
+
+        :return: the reaper
+        :rtype: :class:`dagon.executor.ProcessReaper`
+        """
+        with ProcessReaper.instance_lock:
+            if ProcessReaper.instance is None:
+                ProcessReaper.instance = ProcessReaper()
+            return ProcessReaper.instance
+
+    def submit(self, command, timeout=None, stdout_path=None, stderr_path=None, cwd=None):
+        """
+        Start a command in bash and return immediately
+
+        :param command: command to be executed
+        :type command: str
+
+        :param timeout: seconds before the process is killed
+        :type timeout: float
+
+        :param stdout_path: file where the standard output is streamed
+        :type stdout_path: str
+
+        :param stderr_path: file where the standard error is streamed
+        :type stderr_path: str
+
+        :param cwd: working directory of the process
+        :type cwd: str
+
+        :return: handle of the process
+        :rtype: :class:`dagon.executor.ProcessHandle`
+        """
+        process = Popen(["/bin/bash", "-c", command], stdin=DEVNULL, stdout=PIPE, stderr=PIPE, close_fds=True,
+                        cwd=cwd, start_new_session=True)
+        handle = ProcessHandle(command, process, timeout=timeout, stdout_path=stdout_path, stderr_path=stderr_path)
+        handle.reaper = self
+        try:
+            handle.pidfd = os.pidfd_open(process.pid)
+        except (AttributeError, OSError):
+            # Not supported by the platform, the process is polled
+            handle.pidfd = None
+        with self.lock:
+            self.handles.append(handle)
+            self.selector.register(process.stdout, selectors.EVENT_READ, (handle, "stdout"))
+            self.selector.register(process.stderr, selectors.EVENT_READ, (handle, "stderr"))
+            if handle.pidfd is not None:
+                self.selector.register(handle.pidfd, selectors.EVENT_READ, (handle, "exit"))
+        self.wake()
+        return handle
+
+    def wake(self):
+        """
+        Wake up the reaper thread to take into account new processes or deadlines
+        """
+        os.write(self.wake_write, b"x")
+
+    def loop(self):
+        """
+        Body of the reaper thread
+        """
+        while True:
+            with self.lock:
+                running = [h for h in self.handles if h.result is None]
+            polling = any(h.pidfd is None and not h.exited for h in running)
+            deadlines = [h.deadline for h in running if h.deadline is not None and not h.timed_out]
+            deadlines += [h.kill_time for h in running if h.kill_time is not None]
+            deadlines += [h.drain_deadline for h in running if h.drain_deadline is not None]
+            timeout = ProcessReaper.POLL_INTERVAL if polling else None
+            if len(deadlines):
+                next_deadline = max(0, min(deadlines) - time())
+                timeout = next_deadline if timeout is None else min(timeout, next_deadline)
+
+            for key, _ in self.selector.select(timeout):
+                if key.data is None:
+                    os.read(self.wake_read, 4096)
+                    continue
+                handle, stream = key.data
+                if stream == "exit":
+                    self.reap(handle)
+                    continue
+                data = os.read(key.fd, 65536)
+                if len(data):
+                    handle.on_data(stream, data)
+                else:
+                    self.close_stream(handle, key.fileobj)
+
+            now = time()
+            with self.lock:
+                handles = list(self.handles)
+            for handle in handles:
+                if handle.result is None:
+                    if handle.deadline is not None and now >= handle.deadline and not handle.timed_out:
+                        handle.timed_out = True
+                        handle.signal(signal.SIGTERM)
+                    elif handle.kill_time is not None and now >= handle.kill_time:
+                        handle.kill()
+                    if not handle.exited and handle.pidfd is None:
+                        self.reap(handle)
+                    if handle.exited and (handle.open_streams == 0 or now >= handle.drain_deadline):
+                        handle.finish(handle.status, handle.rusage)
+                if handle.result is not None and handle.open_streams == 0:
+                    with self.lock:
+                        self.handles.remove(handle)
+
+    def close_stream(self, handle, stream):
+        """
+        Stop reading an output of a process once it reaches the end of file
+
+        :param handle: handle of the process
+        :type handle: :class:`dagon.executor.ProcessHandle`
+
+        :param stream: pipe closed
+        :type stream: file
+        """
+        with self.lock:
+            self.selector.unregister(stream)
+        stream.close()
+        handle.open_streams -= 1
+
+    def reap(self, handle):
+        """
+        Collect the exit status of a process, if it ended. Its output is read until the end of file or
+        until the drain grace period expires
+
+        :param handle: handle of the process
+        :type handle: :class:`dagon.executor.ProcessHandle`
+        """
+        try:
+            pid, status, rusage = os.wait4(handle.process.pid, os.WNOHANG)
+        except ChildProcessError:
+            pid, status, rusage = handle.process.pid, None, None
+        if pid == 0:
+            return
+        handle.exited = True
+        handle.status, handle.rusage = status, rusage
+        handle.drain_deadline = time() + ProcessReaper.DRAIN_GRACE
+        if handle.pidfd is not None:
+            with self.lock:
+                self.selector.unregister(handle.pidfd)
+            os.close(handle.pidfd)
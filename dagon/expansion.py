@@ -0,0 +1,113 @@
+import threading
+from collections import deque
+
+
+class Expansion(object):
+    """
+    **Children added to a running workflow by a task in map or parallel mode**
+
+    The children are inserted in the graph of the workflow while it is executed, they depend on the task
+    expanded and the tasks depending on it (the gather) also depend on all of them. At most ``limit``
+    children are executed at the same time: the ready queue scheduler admits them as their siblings end and
+    the threads of the one thread per task scheduler wait for a free place.
+
+    :ivar parent: task expanded
+    :vartype parent: :class:`dagon.task.Task`
+
+    :ivar children: tasks added
+    :vartype children: list(:class:`dagon.task.Task`)
+
+    :ivar gathers: tasks waiting for all the children
+    :vartype gathers: list(:class:`dagon.task.Task`)
+
+    :ivar limit: maximum number of children executed at the same time, None for no limit
+    :vartype limit: int
+    """
+
+    def __init__(self, parent, children, gathers, limit=None):
+        """
+        :param parent: task expanded
+        :type parent: :class:`dagon.task.Task`
+
+        :param children: tasks added
+        :type children: list(:class:`dagon.task.Task`)
+
+        :param gathers: tasks waiting for all the children
+        :type gathers: list(:class:`dagon.task.Task`)
+
+        :param limit: maximum number of children executed at the same time, None for no limit
+        :type limit: int
+        """
+        self.parent = parent
+        self.children = children
+        self.gathers = gathers
+        self.limit = max(1, int(limit)) if limit else None
+        self.condition = threading.Condition()
+        self.running = 0
+        self.waiting = deque()
+        self.metrics = {"children": len(children), "deferred": 0, "max_running": 0}
+
+    def has_room(self):
+        """
+        :return: True if other child can be executed. The lock has to be held
+        :rtype: bool
+        """
+        return self.limit is None or self.running < self.limit
+
+    def start(self):
+        """
+        Account a child starting its execution. The lock has to be held
+        """
+        self.running += 1
+        self.metrics['max_running'] = max(self.metrics['max_running'], self.running)
+
+    def admit(self, task, start):
+        """
+        Start a child ready to be executed, or keep it until other child ends. It doesn't block
+
+        :param task: child ready
+        :type task: :class:`dagon.task.Task`
+
+        :param start: function starting the child
+        :type start: callable(:class:`dagon.task.Task`)
+        """
+        with self.condition:
+            if not self.has_room():
+                self.metrics['deferred'] += 1
+                self.waiting.append((task, start))
+                return
+            self.start()
+        start(task)
+
+    def acquire(self):
+        """
+        Wait until a child can be executed
+        """
+        with self.condition:
+            if not self.has_room():
+                self.metrics['deferred'] += 1
+            while not self.has_room():
+                self.condition.wait()
+            self.start()
+
+    def release(self):
+        """
+        Account a child ended, starting the next one kept by :meth:`dagon.expansion.Expansion.admit`
+        """
+        with self.condition:
+            self.running -= 1
+            waiting = self.waiting.popleft() if len(self.waiting) else None
+            if waiting is not None:
+                self.start()
+            self.condition.notify()
+        if waiting is not None:
+            task, start = waiting
+            start(task)
+
+    def get_metrics(self):
+        """
+        :return: children added, children that waited for a place and maximum number running at the same time
+        :rtype: dict(str, int)
+        """
+        with self.condition:
+            return dict(self.metrics)
@@ -1,75 +1,244 @@
-
 from requests.exceptions import ConnectionError
 from requests.exceptions import MissingSchema
 import logging
 from ftplib import FTP
 import os
 import ftplib
-import sys
+import posixpath
+import threading
+from collections import deque
+from time import time
+
+from dagon.staging import StagingResult
+
+
 # Perform the communication with the TPS manager
 class FTP_API:
-    def __init__(self, url, username="guess",password="guess"):
+    """
+    **Downloads the working directories published by other DAGonStar instances through FTP**
+
+    The tree is listed with MLSD when the server supports it, and the files are downloaded in parallel by
+    a pool of connections. The files partially downloaded are resumed with REST. The working directory
+    of the process is never changed.
+    """
+
+    # Bytes read by each call of the download callback
+    BLOCK_SIZE = 1024 ** 2
+
+    def __init__(self, url, username="guess", password="guess", connections=4):
+        """
+        :param url: host of the FTP server
+        :type url: str
+
+        :param username: FTP user
+        :type username: str
+
+        :param password: FTP password
+        :type password: str
+
+        :param connections: number of files downloaded at the same time
+        :type connections: int
+        """
         self.base_url = url
         self.username = username
         self.password = password
-        self.checkConnection()
+        self.connections = max(1, int(connections))
         self.logger = logging.getLogger()
-
+        self.lock = threading.Lock()
+        self.checkConnection()
 
     # check if the service URL is valid or a service is available
     def checkConnection(self):
         """
         check if the service URL is valid or a service is available
 
+        :raises ConnectionError: when it's not possible to connect to the URL provided
+        """
+        self.ftp = self.connect()
+
+    def connect(self):
+        """
+        Open a new control connection with the server
+
+        :return: connection logged in binary mode
+        :rtype: :class:`ftplib.FTP`
+
         :raises ConnectionError: when it's not possible to connect to the URL provided
         """
         try:
-            self.ftp=FTP(self.base_url)
-            self.ftp.login(self.username,self.password)
-        except ConnectionError as e:
+            ftp = FTP(self.base_url)
+            ftp.login(self.username, self.password)
+            ftp.voidcmd("TYPE I")
+            return ftp
+        except (ConnectionError, OSError, ftplib.Error):
             raise ConnectionError("It is not possible connect to the URL %s" % self.base_url)
         except MissingSchema:
             raise ConnectionError("Bad URL %s" % self.base_url)
 
-    def downloadFiles(self,source,destination):
-    #path & destination are str of the form "/dir/folder/something/"
-    #path should be the abs path to the root FOLDER of the file tree to download
+    def close(self):
+        """
+        Close the control connection
+        """
+        try:
+            self.ftp.quit()
+        except (OSError, ftplib.Error):
+            self.ftp.close()
+
+    def list_tree(self, source):
+        """
+        List the files of a remote tree
+
+        :param source: remote path of the root folder
+        :type source: str
+
+        :return: remote path, path relative to the root and size (None if unknown) of each file
+        :rtype: list(tuple(str, str, int))
+        """
+        files = []
+        folders = deque([""])
+        while len(folders):
+            relative = folders.popleft()
+            path = posixpath.join(source, relative) if len(relative) else source
+            for name, is_dir, size in self.list_folder(path):
+                if is_dir:
+                    folders.append(posixpath.join(relative, name))
+                else:
+                    files.append((posixpath.join(path, name), posixpath.join(relative, name), size))
+        return files
+
+    def list_folder(self, path):
+        """
+        List the entries of a remote folder, with MLSD if the server supports it
+
+        :param path: remote path of the folder
+        :type path: str
+
+        :return: name, True if it is a folder and size of each entry
+        :rtype: list(tuple(str, bool, int))
+        """
         try:
-            self.ftp.cwd(source)
-            #clone path to destination
-            self.logger.error("destination : "+destination)
-
-            os.makedirs(destination, exist_ok=True)
-            os.chdir(destination) #workflow schema
-
-        except OSError:
-            #folder already exists at destination
-            self.logger.error("folder exist")
-            pass
-        except ftplib.error_perm:
-            #invalid entry (ensure input form: "/dir/folder/something/")
-            print ("error: could not change to "+source)
-            sys.exit("ending session")
-
-        #list children:
-        filelist=self.ftp.nlst()
-
-        for file in filelist:
+            entries = []
+            for name, facts in self.ftp.mlsd(path, facts=["type", "size"]):
+                kind = facts.get("type", "file")
+                if kind in ["cdir", "pdir"]:
+                    continue
+                size = int(facts["size"]) if "size" in facts else None
+                entries.append((name, kind == "dir", size))
+            return entries
+        except ftplib.error_perm as e:
+            if not str(e).startswith("500") and not str(e).startswith("502"):
+                raise
+
+        # MLSD not supported: a folder has no size
+        entries = []
+        names = self.ftp.nlst(path)
+        # The listing switches to ASCII mode, where SIZE is not allowed
+        self.ftp.voidcmd("TYPE I")
+        for entry in names:
+            name = posixpath.basename(entry.rstrip("/"))
+            if name in [".", ".."]:
+                continue
             try:
-                #this will check if file is folder:
-                self.ftp.cwd(file+"/")
-                self.ftp.cwd("..")
-                #if so, explore it:
-                self.downloadFiles(file+"/",destination+"/"+file+"/")
+                entries.append((name, False, self.ftp.size(posixpath.join(path, name))))
             except ftplib.error_perm:
+                entries.append((name, True, None))
+        return entries
+
+    def downloadFiles(self, source, destination):
+        """
+        Download a remote tree
+
+        :param source: remote path of the root folder
+        :type source: str
+
+        :param destination: local path where the tree is copied
+        :type destination: str
+
+        :return: result of each file downloaded
+        :rtype: list(:class:`dagon.staging.StagingResult`)
+
+        :raises Exception: the remote folder can not be listed
+        """
+        try:
+            files = self.list_tree(source)
+        except ftplib.error_perm as e:
+            raise Exception("Could not list %s: %s" % (source, e))
+
+        pending = deque()
+        results = []
+        for remote, relative, size in files:
+            local = os.path.join(destination, relative)
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            result = StagingResult(remote, local, "ftp", size=size or 0)
+            results.append(result)
+            pending.append(result)
+
+        workers = [threading.Thread(target=self.worker, args=(pending,))
+                   for _ in range(min(self.connections, len(pending)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        failed = [result for result in results if not result.is_ok()]
+        self.logger.debug("Downloaded %d files from %s:%s (%d bytes, %d failed)", len(results), self.base_url,
+                          source, sum(result.bytes for result in results), len(failed))
+        return results
+
+    def worker(self, pending):
+        """
+        Body of the threads downloading files, each one with its own connection
+        """
+        ftp = None
+        while True:
+            with self.lock:
+                if not len(pending):
+                    break
+                result = pending.popleft()
+            start_time = time()
+            try:
+                if ftp is None:
+                    ftp = self.connect()
+                self.download(ftp, result)
+            except (OSError, EOFError, ftplib.Error, ConnectionError) as e:
+                result.error = str(e)
+                # The connection may be broken
+                if ftp is not None:
+                    ftp.close()
+                ftp = None
+            result.elapsed = time() - start_time
+        if ftp is not None:
+            try:
+                ftp.quit()
+            except (OSError, ftplib.Error):
+                ftp.close()
+
+    def download(self, ftp, result):
+        """
+        Download a file, resuming it if it was partially downloaded
 
-                #not a folder with accessible content
-                #download & return
-                os.chdir(destination)
-                #possibly need a permission exception catch:
-                self.ftp.retrbinary("RETR "+file, open(os.path.join(destination,file),"wb").write)
-                print (file + " downloaded")
-        self.ftp.cwd("..")
+        :param ftp: connection of the worker
+        :type ftp: :class:`ftplib.FTP`
 
-        return
+        :param result: result of the file, with the remote path (src), local path (dst) and size
+        :type result: :class:`dagon.staging.StagingResult`
+        """
+        if not result.size:
+            try:
+                result.size = ftp.size(result.src) or 0
+            except ftplib.error_perm:
+                result.size = 0
+        offset = os.path.getsize(result.dst) if os.path.exists(result.dst) else 0
+        if offset > result.size:
+            offset = 0
+        if offset and offset == result.size:
+            # Already downloaded
+            result.bytes_avoided = offset
+            return
 
+        with open(result.dst, "ab" if offset else "wb") as f:
+            def write(data):
+                f.write(data)
+                result.bytes += len(data)
+            ftp.retrbinary("RETR " + result.src, write, blocksize=FTP_API.BLOCK_SIZE, rest=offset or None)
+        result.bytes_avoided = offset
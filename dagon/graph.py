@@ -0,0 +1,171 @@
+from collections import deque
+
+
+class CycleError(Exception):
+    """
+    **Raised when the dependencies between tasks contain a cycle**
+
+    :ivar cycle: tasks forming the cycle, in dependency order
+    :vartype cycle: list(:class:`dagon.task.Task`)
+
+    :ivar blocked: tasks that can not be executed because of the cycle (cycle members included)
+    :vartype blocked: list(:class:`dagon.task.Task`)
+    """
+
+    def __init__(self, cycle, blocked):
+        """
+        :param cycle: tasks forming the cycle, in dependency order
+        :type cycle: list(:class:`dagon.task.Task`)
+
+        :param blocked: tasks that can not be executed because of the cycle
+        :type blocked: list(:class:`dagon.task.Task`)
+        """
+        self.cycle = cycle
+        self.blocked = blocked
+        names = [task_name(task) for task in cycle + cycle[:1]]
+        Exception.__init__(self, "A cycle has been found: %s" % " -> ".join(names))
+
+
+class Topology(object):
+    """
+    **Result of the validation of a graph of tasks**
+
+    :ivar order: tasks in topological order
+    :vartype order: list(:class:`dagon.task.Task`)
+
+    :ivar critical_path: longest chain of dependent tasks
+    :vartype critical_path: list(:class:`dagon.task.Task`)
+
+    :ivar critical_path_length: length of the critical path (number of tasks or sum of their weights)
+    :vartype critical_path_length: float
+    """
+
+    def __init__(self, order, critical_path, critical_path_length):
+        self.order = order
+        self.critical_path = critical_path
+        self.critical_path_length = critical_path_length
+
+    def as_json(self):
+        """
+        Return a json representation of the topology
+
+        :return: JSON representation
+        :rtype: dict(str, object)
+        """
+        return {"order": [task_name(task) for task in self.order],
+                "critical_path": [task_name(task) for task in self.critical_path],
+                "critical_path_length": self.critical_path_length}
+
+
+def task_name(task):
+    """
+    Returns the name of a task qualified with its workflow when it is available
+
+    :param task: task
+    :type task: :class:`dagon.task.Task`
+
+    :return: name of the task
+    :rtype: str
+    """
+    if task.workflow is not None:
+        return "%s(%s)" % (task.name, task.workflow.name)
+    return task.name
+
+
+def validate(tasks, weight=None):
+    """
+    Validate the dependencies between tasks (Kahn's algorithm), linear in the number of tasks and
+    dependencies. Dependencies on tasks not in the list are ignored
+
+    :param tasks: tasks of the graph
+    :type tasks: list(:class:`dagon.task.Task`)
+
+    :param weight: function returning the weight of a task on the critical path. By default, 1
+    :type weight: callable(:class:`dagon.task.Task`)
+
+    :return: topological order and critical path
+    :rtype: :class:`dagon.graph.Topology`
+
+    :raises CycleError: when a cycle is found
+    """
+    if weight is None:
+        weight = lambda task: 1
+
+    in_degree = {}
+    for task in tasks:
+        in_degree[task] = 0
+    successors = dict((task, []) for task in in_degree)
+
+    # The edges are taken from the predecessors, so the transversal ones are included
+    for task in in_degree:
+        for prev in task.prevs:
+            if prev in in_degree:
+                successors[prev].append(task)
+                in_degree[task] += 1
+
+    remaining = dict(in_degree)
+    ready = deque(task for task in in_degree if remaining[task] == 0)
+    order = []
+    distance = {}
+    parent = {}
+    while len(ready):
+        task = ready.popleft()
+        order.append(task)
+        distance[task] = distance.get(task, 0) + weight(task)
+        for next_task in successors[task]:
+            # Longest path to the successor
+            if distance[task] > distance.get(next_task, 0):
+                distance[next_task] = distance[task]
+                parent[next_task] = task
+            remaining[next_task] -= 1
+            if remaining[next_task] == 0:
+                ready.append(next_task)
+
+    if len(order) < len(in_degree):
+        blocked = [task for task in in_degree if remaining[task] > 0]
+        raise CycleError(find_cycle(blocked, remaining, in_degree), blocked)
+
+    # Rebuild the critical path from its last task
+    critical_path = []
+    if len(order):
+        task = max(order, key=lambda t: distance[t])
+        length = distance[task]
+        while task is not None:
+            critical_path.append(task)
+            task = parent.get(task)
+        critical_path.reverse()
+    else:
+        length = 0
+    return Topology(order, critical_path, length)
+
+
+def find_cycle(blocked, remaining, in_degree):
+    """
+    Find a cycle among the tasks blocked after the topological sort. Each blocked task has at least one
+    blocked predecessor, walking backwards through them always ends in a cycle
+
+    :param blocked: tasks not sorted
+    :type blocked: list(:class:`dagon.task.Task`)
+
+    :param remaining: number of unsorted predecessors of each task
+    :type remaining: dict(:class:`dagon.task.Task`, int)
+
+    :param in_degree: tasks of the graph
+    :type in_degree: dict(:class:`dagon.task.Task`, int)
+
+    :return: tasks forming the cycle, in dependency order
+    :rtype: list(:class:`dagon.task.Task`)
+    """
+    position = {}
+    path = []
+    task = blocked[0]
+    while task not in position:
+        position[task] = len(path)
+        path.append(task)
+        for prev in task.prevs:
+            if prev in in_degree and remaining[prev] > 0:
+                task = prev
+                break
+    cycle = path[position[task]:]
+    cycle.reverse()
+    return cycle
@@ -0,0 +1,98 @@
+import threading
+from time import time
+
+
+class HostInfoCache(object):
+    """
+    **Caches the context discovered on each host**
+
+    The context script (see :meth:`dagon.task.Task.get_how_im_script`) always returns the same information
+    for the same host, user and task type. The first task discovers it, the following ones reuse the info
+    and the temporal SSH key generated by the first one.
+
+    :ivar ttl: seconds before an entry expires, 0 disables the cache
+    :vartype ttl: float
+
+    :ivar entries: cached entries by (host, user, task type)
+    :vartype entries: dict(tuple, dict)
+    """
+
+    def __init__(self, ttl=600):
+        """
+        :param ttl: seconds before an entry expires, 0 disables the cache
+        :type ttl: float
+        """
+        self.ttl = float(ttl)
+        self.entries = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_lock(self, key):
+        """
+        Returns the lock serializing the discovery on a host, so only one task runs the context script
+
+        :param key: (host, user, task type)
+        :type key: tuple(str, str, str)
+
+        :return: lock of the key
+        :rtype: :class:`threading.Lock`
+        """
+        with self.lock:
+            if key not in self.locks:
+                self.locks[key] = threading.Lock()
+            return self.locks[key]
+
+    def get(self, key):
+        """
+        Returns the entry cached for a key if it is not expired
+
+        :param key: (host, user, task type)
+        :type key: tuple(str, str, str)
+
+        :return: entry with the info and the directory of the SSH key, None if it is not cached
+        :rtype: dict(str, object)
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time() - entry['time'] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, key, info, key_dir):
+        """
+        Cache the info discovered on a host
+
+        :param key: (host, user, task type)
+        :type key: tuple(str, str, str)
+
+        :param info: machine info returned by the context script
+        :type info: dict(str, object)
+
+        :param key_dir: directory where the context script generated the SSH key
+        :type key_dir: str
+        """
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            self.entries[key] = {"info": info, "key_dir": key_dir, "time": time()}
+
+    def invalidate(self, host=None):
+        """
+        Remove the cached entries
+
+        :param host: host whose entries are removed. By default, all the entries are removed
+        :type host: str
+        """
+        with self.lock:
+            if host is None:
+                self.entries = {}
+            else:
+                for key in [k for k in self.entries if k[0] == host]:
+                    del self.entries[key]
@@ -0,0 +1,294 @@
+import fnmatch
+import json
+import posixpath
+import threading
+
+
+class LineageIndex(object):
+    """
+    **Keeps the task producing each file and the tasks consuming it**
+
+    The files are the outputs redirected by the commands of the tasks and the paths referenced by other tasks
+    through workflow://, relative to the scratch directory of the producer. A path can be a directory or a
+    glob pattern, in that case it covers the files under it. The consumers not finished are counted on a tree
+    of the paths of each producer, so finishing a task only checks the files related to the ones it read.
+
+    :ivar files: producer, consumers and consumers finished of each file, by its reference
+    :vartype files: dict(str, dict(str, object))
+    """
+
+    # Characters making a path a glob pattern
+    GLOB_CHARS = "*?["
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.producers = {}
+        # Path tree of each producer, with the consumers not finished of each entry and of its subtree
+        self.trees = {}
+        self.nodes = {}
+        # Entries of each producer by path, glob patterns of each producer and entries read by each consumer
+        self.paths = {}
+        self.globs = {}
+        self.consumed = {}
+
+    @staticmethod
+    def normalize(path):
+        """
+        Returns a path relative to the scratch directory of the producer
+
+        :param path: path, it can start with a slash
+        :type path: str
+
+        :return: normalized path, "." for the whole scratch directory
+        :rtype: str
+        """
+        return posixpath.normpath(path.strip().lstrip("/") or ".")
+
+    @staticmethod
+    def get_task_name(task):
+        """
+        :return: name of the task with its workflow, as in a workflow:// reference
+        :rtype: str
+        """
+        return task.workflow.name + "/" + task.name
+
+    @staticmethod
+    def covers(path, other):
+        """
+        :return: True if the file or files of the first path include the second one
+        :rtype: bool
+        """
+        return path == "." or path == other or other.startswith(path + "/") or fnmatch.fnmatch(other, path)
+
+    @staticmethod
+    def is_glob(path):
+        """
+        :return: True if the path is a glob pattern
+        :rtype: bool
+        """
+        return any(c in path for c in LineageIndex.GLOB_CHARS)
+
+    def get_node(self, name, path):
+        """
+        Returns the node of a path in the tree of a producer, creating it if it doesn't exist. The lock has to
+        be held
+
+        :param name: name of the producer
+        :type name: str
+
+        :param path: normalized path
+        :type path: str
+
+        :return: node with its parent, children, entry key, consumers pending and consumers pending in its
+            subtree
+        :rtype: dict(str, object)
+        """
+        if name not in self.trees:
+            self.trees[name] = {"parent": None, "children": {}, "key": None, "pending": 0, "subtree": 0}
+        node = self.trees[name]
+        if path == ".":
+            return node
+        for part in path.split("/"):
+            if part not in node['children']:
+                node['children'][part] = {"parent": node, "children": {}, "key": None, "pending": 0, "subtree": 0}
+            node = node['children'][part]
+        return node
+
+    @staticmethod
+    def add_pending(node, delta):
+        """
+        Update the consumers pending of a node and of the subtrees including it. The lock has to be held
+        """
+        node['pending'] += delta
+        while node is not None:
+            node['subtree'] += delta
+            node = node['parent']
+
+    def get_entry(self, producer, path):
+        """
+        Returns the entry of a file, creating it if it doesn't exist. The lock has to be held
+
+        :return: producer, path, consumers and consumers finished
+        :rtype: dict(str, object)
+        """
+        name = LineageIndex.get_task_name(producer)
+        key = name + "/" + path
+        if key not in self.files:
+            self.files[key] = {"producer": name, "path": path, "declared": False,
+                               "consumers": [], "finished": [], "removed": False}
+            self.producers[key] = producer
+            node = self.get_node(name, path)
+            node['key'] = key
+            self.nodes[key] = node
+            self.paths.setdefault(name, {})[path] = key
+            if LineageIndex.is_glob(path):
+                self.globs.setdefault(name, []).append(key)
+        return self.files[key]
+
+    def add_output(self, producer, path):
+        """
+        Add a file written by a task. Absolute paths are outside its scratch directory and they are ignored
+
+        :param producer: task writing the file
+        :type producer: :class:`dagon.task.Task`
+
+        :param path: path of the file, relative to the scratch directory of the task
+        :type path: str
+        """
+        if path.startswith("/") or path.startswith("&") or not len(path.strip()):
+            return
+        with self.lock:
+            self.get_entry(producer, LineageIndex.normalize(path))["declared"] = True
+
+    def add_input(self, consumer, producer, path):
+        """
+        Add a file read by a task through a workflow:// reference
+
+        :param consumer: task reading the file
+        :type consumer: :class:`dagon.task.Task`
+
+        :param producer: task where the file is
+        :type producer: :class:`dagon.task.Task`
+
+        :param path: local path of the reference
+        :type path: str
+        """
+        with self.lock:
+            path = LineageIndex.normalize(path)
+            entry = self.get_entry(producer, path)
+            name = LineageIndex.get_task_name(consumer)
+            if name not in entry['consumers']:
+                entry['consumers'].append(name)
+                key = entry['producer'] + "/" + path
+                self.consumed.setdefault(name, []).append(key)
+                LineageIndex.add_pending(self.nodes[key], 1)
+
+    def get_files(self, producer, path):
+        """
+        Returns the files known under a directory of a task, the ones it writes and the ones referenced by its
+        consumers
+
+        :param producer: task where the directory is
+        :type producer: :class:`dagon.task.Task`
+
+        :param path: local path of the directory
+        :type path: str
+
+        :return: paths of the files, relative to the scratch directory of the task. Empty if the path is a
+            file or nothing is known under it
+        :rtype: list(str)
+        """
+        path = LineageIndex.normalize(path)
+        name = LineageIndex.get_task_name(producer)
+        with self.lock:
+            return sorted(other for other in self.paths.get(name, {})
+                          if other != path and LineageIndex.covers(path, other) and not LineageIndex.is_glob(other))
+
+    def finish(self, consumer):
+        """
+        Mark a task as finished, returning the files nobody else has to read
+
+        A file is returned once all the consumers of the file, of the directories including it and of the
+        files under it finished. Only files referenced by a consumer are returned, the final outputs are kept.
+        Only the files related to the ones read by the task are checked
+
+        :param consumer: task finished
+        :type consumer: :class:`dagon.task.Task`
+
+        :return: producer and path of each file that can be removed
+        :rtype: list(tuple(:class:`dagon.task.Task`, str))
+        """
+        name = LineageIndex.get_task_name(consumer)
+        removable = []
+        with self.lock:
+            candidates = []
+            for key in self.consumed.pop(name, []):
+                entry = self.files[key]
+                if name not in entry['finished']:
+                    entry['finished'].append(name)
+                    LineageIndex.add_pending(self.nodes[key], -1)
+                    candidates.extend(self.get_related(key))
+
+            checked = set()
+            for key in candidates:
+                if key in checked:
+                    continue
+                checked.add(key)
+                if self.is_removable(key):
+                    self.files[key]['removed'] = True
+                    removable.append((self.producers[key], self.files[key]['path']))
+        return removable
+
+    def get_related(self, key):
+        """
+        Returns the entries whose files include the ones of an entry or are included by them. The lock has to
+        be held
+
+        :return: keys of the entry, of the directories including it, of the files under it and, if it is a glob
+            pattern, of the files matching it
+        :rtype: list(str)
+        """
+        node = self.nodes[key]
+        related = [key]
+        parent = node['parent']
+        while parent is not None:
+            if parent['key'] is not None:
+                related.append(parent['key'])
+            parent = parent['parent']
+        pending = list(node['children'].values())
+        while len(pending):
+            child = pending.pop()
+            if child['key'] is not None:
+                related.append(child['key'])
+            pending.extend(child['children'].values())
+        entry = self.files[key]
+        if LineageIndex.is_glob(entry['path']):
+            related.extend(other for path, other in self.paths[entry['producer']].items()
+                           if fnmatch.fnmatch(path, entry['path']))
+        return related
+
+    def is_removable(self, key):
+        """
+        Returns True if the file of an entry is not removed and all the consumers of the file, of the directories
+        including it, of the files under it and of the glob patterns matching it finished. The lock has to be
+        held
+
+        :rtype: bool
+        """
+        entry = self.files[key]
+        if entry['removed'] or not len(entry['consumers']) or entry['path'] == "." or \
+                LineageIndex.is_glob(entry['path']):
+            return False
+        node = self.nodes[key]
+        if node['subtree']:
+            return False
+        parent = node['parent']
+        while parent is not None:
+            if parent['pending']:
+                return False
+            parent = parent['parent']
+        return not any(self.nodes[other]['pending'] and fnmatch.fnmatch(entry['path'], self.files[other]['path'])
+                       for other in self.globs.get(entry['producer'], []))
+
+    def as_json(self):
+        """
+        Return a json representation of the index
+
+        :return: producer, consumers and whether it was removed of each file
+        :rtype: dict(str, dict(str, object))
+        """
+        with self.lock:
+            return {key: {"producer": entry['producer'], "path": entry['path'], "declared": entry['declared'],
+                          "consumers": list(entry['consumers']), "removed": entry['removed']}
+                    for key, entry in self.files.items()}
+
+    def save(self, path):
+        """
+        Write the index in a JSON file
+
+        :param path: path of the file
+        :type path: str
+        """
+        with open(path, "w") as f:
+            json.dump(self.as_json(), f, indent=2)
@@ -0,0 +1,106 @@
+import dagon
+
+
+class WorkflowReference(object):
+    """
+    **Represents a workflow:// reference in the command of a task**
+
+    A reference has the form ``workflow://<workflow>/<task>/<local path>``, when the workflow name is
+    empty the reference points to a task of the same workflow.
+
+    :ivar arg: reference without the schema
+    :vartype arg: str
+
+    :ivar workflow_name: name of the referenced workflow, empty for the current one
+    :vartype workflow_name: str
+
+    :ivar task_name: name of the referenced task
+    :vartype task_name: str
+
+    :ivar local_path: path of the data in the scratch directory of the referenced task
+    :vartype local_path: str
+
+    :ivar elements: reference split by the slash
+    :vartype elements: list(str)
+    """
+
+    def __init__(self, arg):
+        """
+        :param arg: reference without the schema
+        :type arg: str
+        """
+        self.arg = arg
+
+        # Split each argument in elements by the slash
+        self.elements = arg.split("/")
+
+        # Extract the referenced task's workflow name
+        self.workflow_name = self.elements[0]
+
+        # The task name is the first element
+        self.task_name = self.elements[1] if len(self.elements) > 1 else ""
+
+        # Get the rest of the string as local path
+        self.local_path = arg[len(self.workflow_name + "/" + self.task_name):]
+
+    def get_workflow_name(self, default):
+        """
+        Returns the name of the referenced workflow
+
+        :param default: name of the current workflow
+        :type default: str
+
+        :return: workflow name
+        :rtype: str
+        """
+        if self.workflow_name is None or self.workflow_name == "":
+            return default
+        return self.workflow_name
+
+    def get_input_file(self):
+        """
+        Returns the text file read through the reference
+
+        :return: file name, None if the reference is not to a text file
+        :rtype: str
+        """
+        for element in self.elements[2:]:
+            if element.find(".txt") != -1:
+                return element
+        return None
+
+
+def parse_references(command):
+    """
+    Extract all the workflow:// references of a command
+
+    :param command: command of a task
+    :type command: str
+
+    :return: references in order of appearance
+    :rtype: list(:class:`dagon.references.WorkflowReference`)
+    """
+    references = []
+
+    # Index of the starting position
+    pos = 0
+
+    # Forever unless no anymore dagon.Workflow.SCHEMA are present
+    while True:
+        # Get the position of the next dagon.Workflow.SCHEMA
+        pos1 = command.find(dagon.Workflow.SCHEMA, pos)
+
+        # Check if there is no dagon.Workflow.SCHEMA
+        if pos1 == -1:
+            break
+
+        # Find the first occurrent of a whitespace (or if no occurrence means the end of the string)
+        pos2 = command.find(" ", pos1)
+        if pos2 == -1:
+            pos2 = len(command)
+
+        references.append(WorkflowReference(command[pos1 + len(dagon.Workflow.SCHEMA):pos2]))
+
+        # Go to the next element
+        pos = pos2
+    return references
@@ -1,4 +1,5 @@
 from os.path import abspath
+from uuid import uuid4
 
 from dagon.communication.ssh import SSHManager
 from dagon.cloud import CloudManager
@@ -21,8 +22,17 @@ class RemoteTask(Task):
 
     :ivar ssh_connection: SSH connection with the machine
     :vartype ssh_connection: :class:`dagon.communDataFlow-Demication.ssh.SSHManager`
+
+    :ivar bootstrap: commands sent with the next command executed on the machine
+    :vartype bootstrap: list(str)
+
+    :ivar round_trips: number of commands executed over SSH
+    :vartype round_trips: int
     """
 
+    # Scripts bigger than this are uploaded through SFTP instead of sent with the command
+    MAX_INLINE_SCRIPT = 65536
+
     def __init__(self, name, ssh_username, keypath, command, ip=None, working_dir=None, globusendpoint=None,transversal_workflow=None):
         """
 
@@ -54,10 +64,21 @@ class RemoteTask(Task):
         self.keypath = abspath(keypath) if keypath is not None else keypath
         self.ssh_username = ssh_username
         self.ssh_connection = None
+        self.bootstrap = []
+        self.round_trips = 0
         #print name, self.ip, self.ssh_username
         if self.ip is not None and self.ssh_username is not None:
             self.ssh_connection = SSHManager(self.ssh_username, self.ip, self.keypath)
 
+    def get_slot_keys(self):
+        """
+        Returns the execution slots held by the task while it is executed
+
+        :return: list of slot keys (kind of slot, host)
+        :rtype: list(tuple(str, str))
+        """
+        return [("ssh", self.ip)]
+
     def add_public_key(self, key):
         """
         Add a SSH public key on the remote machine
@@ -69,12 +90,13 @@ class RemoteTask(Task):
         :rtype: dict() with result of the execution
         """
         command = "echo " + key.strip() + "| cat >> ~/.ssh/authorized_keys"
-        result = self.ssh_connection.execute_command(command)
+        result = self.execute_remote(command)
         return result
 
     def on_execute(self, script, script_name):
         """
-        Execute an script on the remote machine
+        Upload an script to the remote machine. The script is sent with the next command executed by
+        :meth:`dagon.remote.RemoteTask.execute_remote`
 
         :param script: script content
         :type key: str
@@ -84,32 +106,158 @@ class RemoteTask(Task):
         """
         # The launcher script name
         script_name = self.working_dir + "/.dagon/" + script_name
-        # Create a temporary launcher script
-        self.ssh_connection.create_file(script_name, script)
+        if len(script) > RemoteTask.MAX_INLINE_SCRIPT:
+            # Too big to be sent as a command argument
+            self.round_trips += 1
+            self.ssh_connection.create_file(script_name, script)
+            return
+
+        # Write the script with a heredoc whose delimiter is not in the script
+        delimiter = "DAGON_EOF"
+        while delimiter in script:
+            delimiter = "DAGON_EOF_" + uuid4().hex
+        if not script.endswith("\n"):
+            script += "\n"
+        self.bootstrap.append("cat > " + script_name + " <<'" + delimiter + "'\n" + script + delimiter)
+
+    def execute_remote(self, command):
+        """
+        Execute a command on the remote machine in a single exchange with the pending bootstrap commands
+        (creation of the scratch directory, copy of the context key and upload of the scripts)
+
+        :param command: command to be executed
+        :type command: str
+
+        :return: execution result
+        :rtype: dict() with the execution output (str) and code (int)
+        """
+        bootstrap = self.bootstrap
+        self.bootstrap = []
+        if len(bootstrap):
+            # Stop at the first bootstrap command failing
+            command = "\n".join(cmd + "\nif [ $? -ne 0 ]; then exit 1; fi" for cmd in bootstrap) + "\n" + command
+        self.round_trips += 1
+        result = self.ssh_connection.execute_command(command)
+        if result['code'] and len(bootstrap) and self.workflow is not None:
+            # The cached context may not be valid anymore
+            self.workflow.invalidate_host_info(self.ip)
+        return result
+
+    def get_round_trips(self):
+        """
+        Returns the number of commands executed over SSH by the task
+
+        :return: number of round trips
+        :rtype: int
+        """
+        return self.round_trips
+
+    def execute(self):
+        """
+        Execute the task on the remote machine, reporting the number of SSH round trips
+        """
+        try:
+            Task.execute(self)
+        finally:
+            self.workflow.logger.debug("%s: %d SSH round trips", self.name, self.round_trips)
+
+    def get_host_info_key(self):
+        """
+        Returns the key used to cache the context of the machine where the task is executed
+
+        :return: host, user and task type
+        :rtype: tuple(str, str, str)
+        """
+        return self.ip, self.ssh_username, type(self).__name__.lower()
+
+    def reuse_context_key(self, key_dir):
+        """
+        Copy the temporal SSH key generated by the context script of other task on the remote machine.
+        The copy is sent with the next command executed on the machine
+
+        :param key_dir: directory where the key was generated
+        :type key_dir: str
+        """
+        self.bootstrap.append("cp {0}/ssh_key {0}/ssh_key.pub {1}/.dagon/".format(key_dir, self.working_dir))
+
+    def keep_context_key(self, key_dir):
+        """
+        Copy the temporal SSH key generated by the context script to a directory of the remote machine reused
+        by the following tasks. It is copied right away, before other task reuses it
+
+        :param key_dir: directory where the key was generated
+        :type key_dir: str
+
+        :return: directory where the key is kept
+        :rtype: str
+
+        :raises Exception: the key could not be copied
+        """
+        keep_dir = self.get_context_key_dir()
+        result = self.execute_remote("mkdir -p -m 700 {0} && cp {1}/ssh_key {1}/ssh_key.pub {0}/"
+                                     .format(keep_dir, key_dir))
+        if result['code']:
+            raise Exception(result['message'])
+        return keep_dir
 
     # make dir
     def mkdir_working_dir(self, path):
         """
-        Make a directory on the remote machine
+        Make a directory on the remote machine. The directory is created with the next command executed
+        on the machine
 
         :param path: Path to the directory
         :type key: str
-
-        :raises Exception: a problem occurred while the creation of the directory
         """
-        #print self.ssh_connection
-        res = self.ssh_connection.execute_command( "mkdir -p " + self.working_dir + "/.dagon")
-        if res['code']:
-            self.workflow.logger.error("%s: Error creating scratch directory on server %s", self.name, res['message'])
-            raise Exception('Cannot create scratch directory on remote')
+        self.bootstrap.append("mkdir -p " + path)
 
     # remove scratch directory
     def on_garbage(self):
         """
-        Remove the scratch directory on the remote machine
+        Remove the scratch directory on the remote machine, in background by the scratch manager
+        """
+        Task.on_garbage(self)
+
+    def delete_scratch_dir(self):
+        """
+        Delete the scratch directory on the remote machine, called by the scratch manager
+
+        :return: bytes reclaimed
+        :rtype: int
+
+        :raises Exception: the directory could not be removed
+        """
+        result = self.ssh_connection.execute_command("du -sb '{0}' 2>/dev/null | cut -f1; rm -rf '{0}'"
+                                                     .format(self.working_dir))
+        if result['code']:
+            raise Exception(result['message'])
+        output = result['output'].strip()
+        return int(output) if output.isdigit() else 0
+
+    def get_scratch_usage(self):
+        """
+        Returns the bytes used by the scratch directory on the remote machine
+
+        :return: bytes used, 0 if they can't be computed
+        :rtype: int
+        """
+        result = self.ssh_connection.execute_command("du -sb '" + self.working_dir + "' 2>/dev/null | cut -f1")
+        if result['code']:
+            self.workflow.logger.debug("%s: Couldn't compute the usage of %s: %s", self.name, self.working_dir,
+                                       result['message'])
+            return 0
+        output = result['output'].strip()
+        return int(output) if output.isdigit() else 0
+
+    def remove_intermediate(self, file_path):
         """
-        self.ssh_connection.execute_command('mv {0} {1}'.format(self.working_dir,
-                                            self.working_dir + "-removed"))
+        Remove a file of the scratch directory on the remote machine once all the tasks reading it finished
+
+        :param file_path: path of the file, relative to the scratch directory
+        :type file_path: str
+        """
+        self.ssh_connection.execute_command("rm -rf '" + self.working_dir + "/" + file_path + "'")
+        self.workflow.logger.debug("%s: Removed intermediate %s", self.name, self.working_dir + "/" + file_path)
 
     def get_public_key(self):
         """
@@ -119,7 +267,7 @@ class RemoteTask(Task):
         :rtype: str with the public key
         """
         command = "cat " + self.working_dir + "/.dagon/ssh_key.pub"
-        result = self.ssh_connection.execute_command(command)
+        result = self.execute_remote(command)
         return result['output']
 
 
@@ -183,6 +331,15 @@ class CloudTask(RemoteTask):
         self.stop_instance = stop_instance
         self.instance_name = instance_name
 
+    def get_slot_keys(self):
+        """
+        Returns the execution slots held by the task while it is executed
+
+        :return: list of slot keys (kind of slot, host)
+        :rtype: list(tuple(str, str))
+        """
+        return [("cloud", None)]
+
     def on_execute(self, script, script_name):
         """
         Execute a script on the cloud instance
@@ -198,7 +355,7 @@ class CloudTask(RemoteTask):
         """
 
         RemoteTask.on_execute(self, script, script_name)
-        return self.ssh_connection.execute_command("bash " + self.working_dir + "/.dagon/" + script_name)
+        return self.execute_remote("bash " + self.working_dir + "/.dagon/" + script_name)
 
     def execute(self):
         """
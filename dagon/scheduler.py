@@ -0,0 +1,291 @@
+import threading
+from queue import Queue
+
+import dagon
+
+
+class ReadyQueueScheduler(object):
+    """
+    **Event-driven scheduler for the tasks of a workflow**
+
+    Instead of starting one thread per task, each task keeps a counter of the predecessors still to be
+    completed. A task whose counter reaches zero is put in the ready queue and a bounded pool of workers
+    takes it from there. When a task ends, its successors are released immediately.
+
+    :ivar workflow: workflow to be executed
+    :vartype workflow: :class:`dagon.Workflow`
+
+    :ivar max_workers: number of worker threads
+    :vartype max_workers: int
+
+    :ivar ready: queue of the tasks ready to be executed
+    :vartype ready: :class:`queue.Queue`
+
+    :ivar in_degree: number of unresolved predecessors of each task
+    :vartype in_degree: dict(:class:`dagon.task.Task`, int)
+    """
+
+    # Seconds between two queries of the dagon service for transversal dependencies
+    POLL_INTERVAL = 1
+
+    def __init__(self, workflow, max_workers=10):
+        """
+        :param workflow: workflow to be executed
+        :type workflow: :class:`dagon.Workflow`
+
+        :param max_workers: number of worker threads
+        :type max_workers: int
+        """
+        self.workflow = workflow
+        self.max_workers = max(1, max_workers)
+        self.ready = Queue()
+        self.in_degree = {}
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.released = set()
+        self.completed = set()
+        self.remote_edges = []
+        self.workers = []
+
+    def run(self):
+        """
+        Execute all the tasks of the workflow and wait until all of them end
+        """
+        tasks = list(self.workflow.tasks)
+        if not len(tasks):
+            return
+
+        self.pending = len(tasks)
+        for task in tasks:
+            self.in_degree[task] = len(set(task.prevs))
+            task.set_status(dagon.Status.WAITING)
+
+        # Track the dependencies on tasks executed by other workflows
+        for task in tasks:
+            for prev in set(task.prevs):
+                if prev not in self.in_degree:
+                    self.watch_external(task, prev)
+
+        for task in tasks:
+            if self.in_degree[task] == 0:
+                self.enqueue(task)
+
+        for i in range(min(self.max_workers, len(tasks))):
+            worker = threading.Thread(target=self.worker, name="%s-worker-%d" % (self.workflow.name, i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+        if len(self.remote_edges):
+            watcher = threading.Thread(target=self.watch_remote, name="%s-watcher" % self.workflow.name)
+            watcher.daemon = True
+            watcher.start()
+
+        self.done.wait()
+
+        # Stop the workers
+        for _ in self.workers:
+            self.ready.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def insert(self, expansion):
+        """
+        Add the tasks of an expansion to the graph being executed. Only the tasks added and the tasks waiting
+        for them are updated
+
+        :param expansion: tasks added by a task being executed
+        :type expansion: :class:`dagon.expansion.Expansion`
+        """
+        ready = []
+        external = []
+        with self.lock:
+            self.pending += len(expansion.children)
+            for child in expansion.children:
+                prevs = set(child.prevs)
+                external += [(child, prev) for prev in prevs if prev not in self.in_degree]
+                self.in_degree[child] = len([prev for prev in prevs if prev not in self.completed])
+                child.set_status(dagon.Status.WAITING)
+            for gather in expansion.gathers:
+                if gather in self.in_degree:
+                    self.in_degree[gather] += len(expansion.children)
+            ready = [child for child in expansion.children if self.in_degree[child] == 0]
+
+        for child, prev in external:
+            self.watch_external(child, prev)
+        for child in ready:
+            self.enqueue(child)
+
+    def enqueue(self, task):
+        """
+        Put a task whose dependencies are resolved in the ready queue. The tasks added by an expansion wait
+        there until less of them are running than its limit
+
+        :param task: task ready
+        :type task: :class:`dagon.task.Task`
+        """
+        if task.expansion is not None:
+            task.expansion.admit(task, self.put)
+        else:
+            self.put(task)
+
+    def put(self, task):
+        """
+        Put a task in the ready queue
+
+        :param task: task ready
+        :type task: :class:`dagon.task.Task`
+        """
+        task.mark_ready()
+        self.ready.put(task)
+
+    def watch_external(self, task, prev):
+        """
+        Track a dependency on a task that is not executed by this workflow
+
+        :param task: task waiting for the dependency
+        :type task: :class:`dagon.task.Task`
+
+        :param prev: task from other workflow
+        :type prev: :class:`dagon.task.Task`
+        """
+        if self.workflow.is_api_available and prev.transversal_workflow is not None:
+            # asynchronous execution, the status is only known by the dagon service
+            with self.lock:
+                self.remote_edges.append((task, prev))
+        else:
+            # the task is executed by a workflow of the same meta-workflow
+            prev.add_status_listener(lambda t, status: self.on_external_status(task, t, status))
+            self.on_external_status(task, prev, prev.status)
+
+    def on_external_status(self, task, prev, status):
+        """
+        Release a dependency on a task from other workflow when it ends
+
+        :param task: task waiting for the dependency
+        :type task: :class:`dagon.task.Task`
+
+        :param prev: task from other workflow
+        :type prev: :class:`dagon.task.Task`
+
+        :param status: new status of the task from other workflow
+        :type status: :class:`dagon.Status`
+        """
+        if status == dagon.Status.FINISHED or status == dagon.Status.FAILED:
+            self.release(task, prev)
+
+    def watch_remote(self):
+        """
+        Query the dagon service for the transversal dependencies until all of them end
+        """
+        while not self.done.is_set():
+            with self.lock:
+                edges = list(self.remote_edges)
+            if not len(edges):
+                return
+            for task, prev in edges:
+                try:
+                    transversal_task = self.workflow.api.get_task(prev.transversal_workflow, prev.name)['task']
+                    if transversal_task['status'] != dagon.Status.FINISHED.value and \
+                            transversal_task['status'] != dagon.Status.FAILED.value:
+                        continue
+                except Exception as e:
+                    prev.set_status(dagon.Status.FAILED)
+                    self.workflow.logger.warning('Worflow dependence not found, Error: ' + str(e))
+                with self.lock:
+                    self.remote_edges.remove((task, prev))
+                self.release(task, prev)
+            self.done.wait(self.POLL_INTERVAL)
+
+    def release(self, task, prev):
+        """
+        Resolve the dependency of a task on one of its predecessors. The task is put in the ready queue
+        when all its dependencies are resolved
+
+        :param task: task waiting for the dependency
+        :type task: :class:`dagon.task.Task`
+
+        :param prev: predecessor ended
+        :type prev: :class:`dagon.task.Task`
+        """
+        with self.lock:
+            if (task, prev) in self.released:
+                return
+            self.released.add((task, prev))
+            self.in_degree[task] -= 1
+            is_ready = self.in_degree[task] == 0
+        if is_ready:
+            self.enqueue(task)
+
+    def worker(self):
+        """
+        Take the tasks from the ready queue and execute them
+        """
+        while True:
+            task = self.ready.get()
+            if task is None:
+                break
+            try:
+                self.execute(task)
+            finally:
+                # The references are removed once the task ended, not before its dependents staged
+                task.remove_reference_workflow()
+                self.on_complete(task)
+
+    def execute(self, task):
+        """
+        Execute a task whose dependencies are resolved, keeping the status transitions of the task
+
+        :param task: task to be executed
+        :type task: :class:`dagon.task.Task`
+        """
+        # Check if one of the previous tasks crashed
+        for prev in task.prevs:
+            if prev.status == dagon.Status.FAILED:
+                task.set_status(dagon.Status.FAILED)
+                return
+
+        task.set_status(dagon.Status.RUNNING)
+        self.workflow.logger.debug("%s: Executing...", task.name)
+        try:
+            with task.slot_manager.hold(task):
+                task.execute()
+        except Exception as e:
+            self.workflow.logger.error("%s: Except: %s", task.name, str(e))
+            task.set_status(dagon.Status.FAILED)
+            return
+        task.set_status(dagon.Status.FINISHED)
+
+    def on_submitted(self, task):
+        """
+        Release the successors of a task that can be submitted before it ends, depending on its job
+
+        :param task: task whose job was submitted
+        :type task: :class:`dagon.task.Task`
+        """
+        for next_task in list(task.nexts):
+            if next_task in self.in_degree and next_task.chains_to(task):
+                self.release(next_task, task)
+
+    def on_complete(self, task):
+        """
+        Completion callback, release the successors of the task
+
+        :param task: task ended
+        :type task: :class:`dagon.task.Task`
+        """
+        with self.lock:
+            self.completed.add(task)
+        if task.expansion is not None:
+            task.expansion.release()
+
+        for next_task in list(task.nexts):
+            if next_task in self.in_degree:
+                self.release(next_task, task)
+
+        with self.lock:
+            self.pending -= 1
+            finished = self.pending == 0
+        if finished:
+            self.done.set()
@@ -0,0 +1,241 @@
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import dagon
+
+
+def get_tree_size(path):
+    """
+    Returns the bytes used by a local tree, without following the symbolic links
+
+    :param path: path of the tree
+    :type path: str
+
+    :return: bytes used
+    :rtype: int
+    """
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def remove_tree(path):
+    """
+    Remove a local tree
+
+    :param path: path of the tree
+    :type path: str
+
+    :return: bytes reclaimed
+    :rtype: int
+    """
+    if not os.path.lexists(path):
+        return 0
+    size = get_tree_size(path)
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+    return size
+
+
+class ScratchManager(object):
+    """
+    **Removes the scratch directories of the tasks once nobody references them**
+
+    The directories are deleted by a pool of threads, so the tasks don't wait for it. The directories of the
+    tasks in the retention set are kept. When the workflow has a quota, the new tasks wait while the
+    scratch directories use more bytes than the quota and there is something running or being deleted that
+    can free them.
+
+    :ivar retain: names of the tasks whose scratch directory is kept
+    :vartype retain: set(str)
+
+    :ivar quota: bytes the scratch directories can use, None for no limit
+    :vartype quota: int
+    """
+
+    def __init__(self, threads=2, retain=None, quota=None):
+        """
+        :param threads: number of directories deleted at the same time
+        :type threads: int
+
+        :param retain: names of the tasks whose scratch directory is kept
+        :type retain: list(str)
+
+        :param quota: bytes the scratch directories can use, None or 0 for no limit
+        :type quota: int
+        """
+        self.pool = ThreadPoolExecutor(max_workers=max(1, int(threads)), thread_name_prefix="dagon-scratch")
+        self.retain = set(retain or [])
+        self.quota = int(quota) if quota and int(quota) > 0 else None
+        self.condition = threading.Condition()
+        self.usage = {}
+        self.deferred = []
+        self.running = 0
+        self.pending = 0
+        self.metrics = {"released": 0, "deleted": 0, "retained": 0, "failed": 0, "bytes_reclaimed": 0,
+                        "throttled": 0, "throttle_time": 0.0}
+
+    @staticmethod
+    def from_config(cfg):
+        """
+        Create the manager from the scratch section of the configuration
+
+        :param cfg: configuration of the workflow
+        :type cfg: dict(str, dict)
+
+        :return: the manager
+        :rtype: :class:`dagon.scratch.ScratchManager`
+        """
+        scratch = cfg.get('scratch') or {}
+        retain = [name.strip() for name in scratch.get('retain', "").split(",") if len(name.strip())]
+        return ScratchManager(scratch.get('threads', 2), retain, scratch.get('quota'))
+
+    def set_retention(self, names):
+        """
+        Keep the scratch directory of some tasks
+
+        :param names: names of the tasks
+        :type names: list(str)
+        """
+        with self.condition:
+            self.retain = set(names)
+
+    def wait_for_quota(self, task):
+        """
+        Wait until the scratch directories use less bytes than the quota. The task doesn't wait when nothing
+        can free space, to not block the workflow
+
+        :param task: task about to be executed
+        :type task: :class:`dagon.task.Task`
+        """
+        start_time = time()
+        throttled = False
+        with self.condition:
+            while self.quota is not None and self.get_used() >= self.quota and (self.running or self.pending):
+                if not throttled:
+                    throttled = True
+                    self.metrics['throttled'] += 1
+                    task.workflow.logger.debug("%s: Waiting, the scratch directories use %d bytes of %d",
+                                               task.name, self.get_used(), self.quota)
+                self.condition.wait()
+            self.running += 1
+            if throttled:
+                self.metrics['throttle_time'] += time() - start_time
+
+    def add_usage(self, task):
+        """
+        Account the bytes used by the scratch directory of a task once it is executed
+
+        :param task: task executed
+        :type task: :class:`dagon.task.Task`
+        """
+        usage = 0
+        if self.quota is not None:
+            try:
+                usage = task.get_scratch_usage()
+            except Exception as e:
+                # Called once the task ended, it must not hide the error of the task
+                task.workflow.logger.debug("%s: Couldn't compute the scratch usage: %s", task.name, e)
+        with self.condition:
+            self.running -= 1
+            if task.remove_scratch_dir is True:
+                self.usage[task] = usage
+            self.condition.notify_all()
+
+    def get_used(self):
+        """
+        :return: bytes used by the scratch directories not removed yet
+        :rtype: int
+        """
+        return sum(self.usage.values())
+
+    def release(self, task):
+        """
+        Remove the scratch directory of a task nobody references. The deletion waits until the tasks depending
+        on it ended, some of them may have not added their references yet
+
+        :param task: task to be garbage collected
+        :type task: :class:`dagon.task.Task`
+        """
+        with self.condition:
+            self.metrics['released'] += 1
+            if task.name in self.retain:
+                self.metrics['retained'] += 1
+                self.usage.pop(task, None)
+                self.condition.notify_all()
+                task.workflow.logger.debug("%s: Keeping the scratch directory %s", task.name, task.working_dir)
+                return
+            self.deferred.append(task)
+        self.collect()
+
+    def collect(self):
+        """
+        Start the deletion of the directories whose dependent tasks ended
+        """
+        ended = [dagon.Status.FINISHED, dagon.Status.FAILED]
+        with self.condition:
+            ready = [task for task in self.deferred if all(n.status in ended for n in task.nexts)]
+            for task in ready:
+                self.deferred.remove(task)
+                self.pending += 1
+        for task in ready:
+            self.pool.submit(self.delete, task)
+
+    def delete(self, task):
+        """
+        Body of the deletion threads
+        """
+        try:
+            reclaimed = task.delete_scratch_dir()
+            with self.condition:
+                self.metrics['deleted'] += 1
+                self.metrics['bytes_reclaimed'] += reclaimed
+            task.workflow.logger.debug("%s: Removed %s (%d bytes)", task.name, task.working_dir, reclaimed)
+        except Exception as e:
+            with self.condition:
+                self.metrics['failed'] += 1
+            task.workflow.logger.warning("%s: Couldn't remove %s: %s", task.name, task.working_dir, e)
+        finally:
+            with self.condition:
+                self.pending -= 1
+                self.usage.pop(task, None)
+                self.condition.notify_all()
+
+    def drain(self, timeout=None):
+        """
+        Wait until the deletions started end
+
+        :param timeout: seconds to wait
+        :type timeout: float
+        """
+        self.collect()
+        deadline = time() + timeout if timeout is not None else None
+        with self.condition:
+            while self.pending:
+                remaining = deadline - time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+    def get_metrics(self):
+        """
+        :return: directories released, deleted, retained and failed, bytes reclaimed, tasks throttled and time
+            waiting, directories pending and bytes used
+        :rtype: dict(str, object)
+        """
+        with self.condition:
+            metrics = dict(self.metrics)
+            metrics['pending'] = self.pending + len(self.deferred)
+            metrics['used'] = self.get_used()
+            return metrics
+
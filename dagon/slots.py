@@ -0,0 +1,184 @@
+import threading
+from contextlib import contextmanager
+from time import time
+
+
+class Slot(object):
+    """
+    **Counting semaphore with queue-depth metrics**
+
+    :ivar limit: maximum number of holders at the same time
+    :vartype limit: int
+
+    :ivar in_use: number of current holders
+    :vartype in_use: int
+
+    :ivar waiting: number of tasks waiting for the slot (queue depth)
+    :vartype waiting: int
+    """
+
+    def __init__(self, limit):
+        """
+        :param limit: maximum number of holders at the same time
+        :type limit: int
+        """
+        self.limit = max(1, int(limit))
+        self.in_use = 0
+        self.waiting = 0
+        self.peak_in_use = 0
+        self.peak_waiting = 0
+        self.acquired = 0
+        self.wait_time = 0.0
+        self.condition = threading.Condition()
+
+    def set_limit(self, limit):
+        """
+        Change the maximum number of holders, waking up the waiting tasks if needed
+
+        :param limit: maximum number of holders at the same time
+        :type limit: int
+        """
+        with self.condition:
+            self.limit = max(1, int(limit))
+            self.condition.notify_all()
+
+    def acquire(self):
+        """
+        Take the slot, waiting until it is available
+        """
+        start_time = time()
+        with self.condition:
+            self.waiting += 1
+            self.peak_waiting = max(self.peak_waiting, self.waiting)
+            while self.in_use >= self.limit:
+                self.condition.wait()
+            self.waiting -= 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.acquired += 1
+            self.wait_time += time() - start_time
+
+    def release(self):
+        """
+        Leave the slot
+        """
+        with self.condition:
+            self.in_use -= 1
+            self.condition.notify()
+
+    def as_json(self):
+        """
+        Return the metrics of the slot
+
+        :return: JSON representation
+        :rtype: dict(str, object)
+        """
+        with self.condition:
+            return {"limit": self.limit, "in_use": self.in_use, "waiting": self.waiting,
+                    "peak_in_use": self.peak_in_use, "peak_waiting": self.peak_waiting,
+                    "acquired": self.acquired, "wait_time": self.wait_time}
+
+
+class SlotManager(object):
+    """
+    **Bounds the number of tasks executed at the same time**
+
+    A task holds the workflow slot and one slot for each of the keys returned by
+    :meth:`dagon.task.Task.get_slot_keys`, e.g. ``("batch", None)`` for local batch tasks,
+    ``("slurm", None)`` for submissions in flight and ``("ssh", host)`` for sessions on a remote host.
+
+    :ivar limits: maximum number of holders for each kind of slot
+    :vartype limits: dict(str, int)
+
+    :ivar slots: slots created so far
+    :vartype slots: dict(tuple, :class:`dagon.slots.Slot`)
+    """
+
+    WORKFLOW = ("workflow", None)
+
+    def __init__(self, max_threads=10, limits=None):
+        """
+        :param max_threads: maximum number of tasks executed at the same time
+        :type max_threads: int
+
+        :param limits: maximum number of holders for each kind of slot (batch, slurm, ssh, docker, cloud)
+        :type limits: dict(str, int)
+        """
+        self.max_threads = max_threads
+        self.limits = {}
+        self.slots = {}
+        self.lock = threading.Lock()
+        if limits is not None:
+            for kind in limits:
+                self.limits[kind] = int(limits[kind])
+
+    def set_limit(self, kind, limit):
+        """
+        Change the maximum number of holders for a kind of slot
+
+        :param kind: kind of slot (batch, slurm, ssh, docker, cloud)
+        :type kind: str
+
+        :param limit: maximum number of holders (per host for the ssh slots)
+        :type limit: int
+        """
+        with self.lock:
+            self.limits[kind] = int(limit)
+            slots = [slot for key, slot in self.slots.items() if key[0] == kind]
+        for slot in slots:
+            slot.set_limit(limit)
+
+    def get_slot(self, key):
+        """
+        Return the slot for a key, creating it if needed
+
+        :param key: kind of slot and host
+        :type key: tuple(str, str)
+
+        :return: the slot
+        :rtype: :class:`dagon.slots.Slot`
+        """
+        with self.lock:
+            if key not in self.slots:
+                if key == SlotManager.WORKFLOW:
+                    limit = self.max_threads
+                else:
+                    limit = self.limits.get(key[0], self.max_threads)
+                self.slots[key] = Slot(limit)
+            return self.slots[key]
+
+    @contextmanager
+    def hold(self, task):
+        """
+        Hold the slots needed by a task while it is executed
+
+        :param task: task to be executed
+        :type task: :class:`dagon.task.Task`
+        """
+        # Always take the slots in the same order to avoid deadlocks
+        keys = [SlotManager.WORKFLOW] + sorted(set(task.get_slot_keys()), key=lambda k: (k[0], str(k[1])))
+        slots = [self.get_slot(key) for key in keys]
+        acquired = []
+        try:
+            for slot in slots:
+                slot.acquire()
+                acquired.append(slot)
+            yield
+        finally:
+            for slot in reversed(acquired):
+                slot.release()
+
+    def get_metrics(self):
+        """
+        Return the metrics of all the slots
+
+        :return: metrics by slot name (kind or kind@host)
+        :rtype: dict(str, dict)
+        """
+        with self.lock:
+            slots = dict(self.slots)
+        metrics = {}
+        for key, slot in slots.items():
+            name = key[0] if key[1] is None else "%s@%s" % key
+            metrics[name] = slot.as_json()
+        return metrics
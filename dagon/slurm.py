@@ -0,0 +1,857 @@
+import threading
+from time import time
+from uuid import uuid4
+
+
+class SlurmJob(object):
+    """
+    **A job submitted by the** :class:`dagon.slurm.SlurmMonitor`
+
+    :ivar job_id: ID given by Slurm, None until it is submitted
+    :vartype job_id: str
+
+    :ivar state: last state of the job (SUBMITTING, PENDING, RUNNING, COMPLETED, FAILED...)
+    :vartype state: str
+
+    :ivar elements: state and exit code of each element of an array job, by index
+    :vartype elements: dict(int, tuple(str, int))
+
+    :ivar result: execution result, None until the job ends
+    :vartype result: dict(str, object)
+
+    :ivar submitted: set when the job has an ID or its submission failed
+    :vartype submitted: :class:`threading.Event`
+    """
+
+    def __init__(self, command, name=None):
+        """
+        :param command: sbatch command printing the job ID (--parsable)
+        :type command: str
+
+        :param name: name of the task submitting the job
+        :type name: str
+        """
+        self.command = command
+        self.name = name
+        self.job_id = None
+        self.state = "SUBMITTING"
+        self.exit_code = None
+        self.elements = {}
+        self.result = None
+        self.start_time = time()
+        self.callbacks = []
+        self.callback_lock = threading.Lock()
+        self.event = threading.Event()
+        self.submitted = threading.Event()
+
+    def finish(self, state, exit_code, message=""):
+        """
+        Build the result once the job ended and call the completion callbacks
+
+        :param state: final state of the job
+        :type state: str
+
+        :param exit_code: exit code of the job script
+        :type exit_code: int
+
+        :param message: error message
+        :type message: str
+        """
+        self.state = state
+        self.exit_code = exit_code
+        code = 0 if state == "COMPLETED" and exit_code == 0 else 1
+        if code and not len(message):
+            message = "Slurm job %s ended with state %s and exit code %s" % (self.job_id, state, exit_code)
+        self.result = {"code": code, "message": message, "output": "Submitted batch job %s\n" % self.job_id if self.job_id else "",
+                       "job_id": self.job_id, "state": state, "exit_code": exit_code,
+                       "elapsed": time() - self.start_time}
+        with self.callback_lock:
+            self.event.set()
+            self.submitted.set()
+            callbacks = list(self.callbacks)
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                pass
+
+    def add_done_callback(self, callback):
+        """
+        Add a function to be called when the job ends. It is called from the monitor thread
+
+        :param callback: function called with the job
+        :type callback: callable(:class:`dagon.slurm.SlurmJob`)
+        """
+        with self.callback_lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait_submitted(self, timeout=None):
+        """
+        Wait until the job is submitted or its submission fails
+
+        :param timeout: seconds to wait
+        :type timeout: float
+
+        :return: job ID, None if it was not submitted
+        :rtype: str
+        """
+        self.submitted.wait(timeout)
+        return self.job_id
+
+    def done(self):
+        """
+        :return: True if the job ended
+        :rtype: bool
+        """
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the job ends
+
+        :param timeout: seconds to wait
+        :type timeout: float
+
+        :return: execution result with the code (int), message (str), job ID (str), state (str), exit code
+            (int) and elapsed time (float), None if the timeout expires
+        :rtype: dict(str, object)
+        """
+        self.event.wait(timeout)
+        return self.result
+
+
+class SlurmMonitor(object):
+    """
+    **Submits the Slurm jobs and tracks their state without a process per job**
+
+    The jobs requested in a short window are submitted with a single command, and the state of all the jobs
+    submitted is queried with one squeue per interval. The jobs that left the queue are looked up with one
+    sacct (or scontrol when the accounting is not available) to get their final state and exit code. There is
+    a monitor per Slurm controller reached, the local one or a remote one through SSH.
+    """
+
+    # Seconds between the polls of the jobs submitted
+    POLL_INTERVAL = 10
+
+    # Seconds waiting for more jobs before submitting them
+    SUBMIT_DELAY = 0.2
+
+    # Elements of an array job when the controller doesn't report its MaxArraySize
+    MAX_ARRAY_SIZE = 1001
+
+    # States of a job that has ended
+    FINAL_STATES = ["COMPLETED", "FAILED", "CANCELLED", "TIMEOUT", "NODE_FAIL", "OUT_OF_MEMORY", "PREEMPTED",
+                    "BOOT_FAIL", "DEADLINE", "REVOKED"]
+
+    instances = {}
+    instance_lock = threading.Lock()
+
+    def __init__(self, execute, poll_interval=None):
+        """
+        :param execute: function executing a command where Slurm is, returning the exit code, output and error
+        :type execute: callable(str) -> tuple(int, str, str)
+
+        :param poll_interval: seconds between the polls of the jobs submitted
+        :type poll_interval: float
+        """
+        self.execute = execute
+        self.poll_interval = float(poll_interval) if poll_interval is not None else SlurmMonitor.POLL_INTERVAL
+        self.condition = threading.Condition()
+        self.pending = []
+        self.jobs = {}
+        self.metrics = {"submitted": 0, "submissions": 0, "polls": 0, "completed": 0, "failed": 0}
+        self.max_array_size = None
+        self.thread = None
+        self.start()
+
+    def start(self):
+        """
+        Start the thread submitting and polling the jobs, unless it is running
+        """
+        with self.condition:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.loop, name="dagon-slurm")
+            self.thread.daemon = True
+            self.thread.start()
+
+    @staticmethod
+    def get_instance(key, execute, poll_interval=None):
+        """
+        Returns the monitor of a Slurm controller
+
+        :param key: identifies the controller, e.g. None for the local one or the host and user for a remote one
+        :type key: tuple
+
+        :param execute: function executing a command where Slurm is, returning the exit code, output and error
+        :type execute: callable(str) -> tuple(int, str, str)
+
+        :param poll_interval: seconds between the polls of the jobs submitted
+        :type poll_interval: float
+
+        :return: the monitor
+        :rtype: :class:`dagon.slurm.SlurmMonitor`
+        """
+        with SlurmMonitor.instance_lock:
+            if key not in SlurmMonitor.instances:
+                SlurmMonitor.instances[key] = SlurmMonitor(execute, poll_interval)
+            return SlurmMonitor.instances[key]
+
+    def submit(self, command, name=None):
+        """
+        Submit a job, returning without waiting for it
+
+        :param command: sbatch command printing the job ID (--parsable)
+        :type command: str
+
+        :param name: name of the task submitting the job
+        :type name: str
+
+        :return: the job
+        :rtype: :class:`dagon.slurm.SlurmJob`
+        """
+        job = SlurmJob(command, name)
+        with self.condition:
+            self.pending.append(job)
+            self.condition.notify()
+        # The jobs would wait forever if the thread died
+        self.start()
+        return job
+
+    def loop(self):
+        """
+        Body of the thread submitting and polling the jobs
+        """
+        last_poll = time()
+        while True:
+            with self.condition:
+                while not len(self.pending) and not len(self.jobs):
+                    self.condition.wait()
+                timeouts = []
+                if len(self.pending):
+                    timeouts.append(self.pending[0].start_time + SlurmMonitor.SUBMIT_DELAY - time())
+                if len(self.jobs):
+                    timeouts.append(last_poll + self.poll_interval - time())
+                timeout = min(timeouts)
+                if timeout > 0:
+                    self.condition.wait(timeout)
+                batch = []
+                if len(self.pending) and time() >= self.pending[0].start_time + SlurmMonitor.SUBMIT_DELAY:
+                    batch, self.pending = self.pending, []
+
+            if len(batch):
+                try:
+                    self.submit_jobs(batch)
+                except Exception as e:
+                    # The jobs without an ID were not submitted, the others are polled
+                    for job in batch:
+                        if job.job_id is None and not job.done():
+                            job.finish("FAILED", None, "Couldn't submit the Slurm job: %s" % e)
+            if len(self.jobs) and time() >= last_poll + self.poll_interval:
+                last_poll = time()
+                try:
+                    self.poll()
+                except Exception:
+                    # The jobs are polled again in the next interval
+                    pass
+
+    def submit_jobs(self, jobs):
+        """
+        Submit the jobs with a single command, one output line per job with its ID or the error
+        """
+        command = "\n".join("echo \"$(" + job.command + " 2>&1 | tr '\\n' ' ')\"" for job in jobs)
+        code, output, error = self.execute(command)
+        lines = output.splitlines()
+        self.metrics['submissions'] += 1
+        for i, job in enumerate(jobs):
+            line = lines[i].strip() if i < len(lines) else error.strip()
+            job_id = line.split(";")[0]
+            if not job_id.isdigit():
+                job.finish("FAILED", None, "Couldn't submit the Slurm job: " + (line or "no output"))
+                continue
+            job.job_id = job_id
+            job.state = "PENDING"
+            self.metrics['submitted'] += 1
+            with self.condition:
+                self.jobs[job_id] = job
+            job.submitted.set()
+
+    def poll(self):
+        """
+        Query the state of all the jobs submitted, finishing the ones that ended
+        """
+        with self.condition:
+            ids = list(self.jobs.keys())
+        if not len(ids):
+            return
+        self.metrics['polls'] += 1
+
+        # The jobs in the queue, the elements of the arrays are listed as <job ID>_<index>
+        code, output, _ = self.execute("squeue -h -o '%i %T' -j " + ",".join(ids))
+        queued = {}
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) == 2:
+                job_id, _, index = fields[0].partition("_")
+                queued[job_id] = fields[1]
+                if job_id in self.jobs and index.isdigit():
+                    self.jobs[job_id].elements[int(index)] = (fields[1], None)
+        for job_id, state in queued.items():
+            if job_id in self.jobs:
+                self.jobs[job_id].state = state
+
+        # The jobs out of the queue ended, their final state is asked to the accounting
+        missing = [job_id for job_id in ids if job_id not in queued]
+        if not len(missing):
+            return
+        states = self.get_final_states(missing)
+        for job_id in missing:
+            if job_id not in states or states[job_id][0] not in SlurmMonitor.FINAL_STATES:
+                continue
+            state, exit_code, elements = states[job_id]
+            with self.condition:
+                job = self.jobs.pop(job_id)
+            job.elements.update(elements)
+            self.metrics['completed' if state == "COMPLETED" and exit_code == 0 else 'failed'] += 1
+            job.finish(state, exit_code)
+
+    def get_final_states(self, ids):
+        """
+        Returns the state and exit code of jobs out of the queue, from sacct or from scontrol when the
+        accounting is not available. The state of an array is COMPLETED when all its elements completed
+
+        :param ids: job IDs
+        :type ids: list(str)
+
+        :return: state, exit code and the state and exit code of each element of the arrays, by job ID
+        :rtype: dict(str, tuple(str, int, dict(int, tuple(str, int))))
+        """
+        records = {}
+        code, output, _ = self.execute("sacct -n -P -X -o JobID,State,ExitCode -j " + ",".join(ids))
+        if code == 0:
+            for line in output.splitlines():
+                fields = line.strip().split("|")
+                if len(fields) == 3:
+                    job_id, _, index = fields[0].partition("_")
+                    if job_id in ids:
+                        records.setdefault(job_id, {})[index] = (fields[1].split()[0],
+                                                                 SlurmMonitor.parse_exit_code(fields[2]))
+
+        for job_id in [job_id for job_id in ids if job_id not in records]:
+            code, output, _ = self.execute("scontrol -o show job " + job_id)
+            if code:
+                continue
+            for line in output.splitlines():
+                fields = dict(field.split("=", 1) for field in line.split() if "=" in field)
+                if "JobState" in fields:
+                    index = fields.get("ArrayTaskId", "")
+                    records.setdefault(job_id, {})[index if index != "N/A" else ""] = \
+                        (fields["JobState"], SlurmMonitor.parse_exit_code(fields.get("ExitCode", "0:0")))
+
+        states = {}
+        for job_id, record in records.items():
+            elements = dict((int(index), value) for index, value in record.items() if index.isdigit())
+            if not len(elements):
+                states[job_id] = record.get("", ("UNKNOWN", None)) + ({},)
+            elif len(record) > len(elements) or \
+                    any(state not in SlurmMonitor.FINAL_STATES for state, _ in elements.values()):
+                # Some elements are still pending
+                states[job_id] = ("RUNNING", None, elements)
+            else:
+                failed = [(state, exit_code) for state, exit_code in elements.values()
+                          if state != "COMPLETED" or exit_code != 0]
+                states[job_id] = (failed[0][0] if failed[0][0] != "COMPLETED" else "FAILED", failed[0][1],
+                                  elements) if len(failed) else ("COMPLETED", 0, elements)
+        return states
+
+    def get_max_array_size(self):
+        """
+        Returns the maximum number of elements of an array job, the MaxArraySize of the controller. It is asked
+        once with scontrol
+
+        :return: array indexes must be lower than this size
+        :rtype: int
+        """
+        if self.max_array_size is None:
+            size = SlurmMonitor.MAX_ARRAY_SIZE
+            try:
+                code, output, _ = self.execute("scontrol show config")
+                for line in output.splitlines() if code == 0 else []:
+                    name, _, value = line.partition("=")
+                    if name.strip() == "MaxArraySize" and value.strip().isdigit():
+                        size = max(1, int(value.strip()))
+            except Exception:
+                pass
+            self.max_array_size = size
+        return self.max_array_size
+
+    @staticmethod
+    def parse_exit_code(text):
+        """
+        :param text: exit code reported by Slurm, e.g. 1:0
+        :type text: str
+
+        :return: exit code of the job script
+        :rtype: int
+        """
+        try:
+            return int(text.split(":")[0])
+        except ValueError:
+            return None
+
+    def get_metrics(self):
+        """
+        :return: jobs submitted, sbatch commands executed, polls and jobs completed, failed and running
+        :rtype: dict(str, int)
+        """
+        with self.condition:
+            metrics = dict(self.metrics)
+            metrics['active'] = len(self.jobs)
+            metrics['pending'] = len(self.pending)
+            return metrics
+
+
+class PackedTask(object):
+    """
+    **A task executed inside an allocation of the** :class:`dagon.slurm.PackManager`
+
+    :ivar task_id: ID of the task in the allocation
+    :vartype task_id: str
+
+    :ivar estimate: seconds the task is expected to run, used to choose an allocation with enough time
+    :vartype estimate: int
+
+    :ivar pack: allocation where the task is queued, None until it is assigned
+    :vartype pack: :class:`dagon.slurm.SlurmPack`
+
+    :ivar result: execution result, None until the task ends
+    :vartype result: dict(str, object)
+    """
+
+    def __init__(self, name, working_dir, script, estimate):
+        """
+        :param name: name of the task
+        :type name: str
+
+        :param working_dir: directory where the script is executed
+        :type working_dir: str
+
+        :param script: path of the script to be executed
+        :type script: str
+
+        :param estimate: seconds the task is expected to run
+        :type estimate: int
+        """
+        self.task_id = uuid4().hex[:12]
+        self.name = name
+        self.working_dir = working_dir
+        self.script = script
+        self.estimate = int(estimate)
+        self.pack = None
+        self.requeued = 0
+        self.result = None
+        self.start_time = time()
+        self.event = threading.Event()
+
+    def get_queue_script(self):
+        """
+        :return: script queued in the allocation, with the estimate read by the agent
+        :rtype: str
+        """
+        return "#! /bin/bash\n# estimate=%d\n# task=%s\ncd %s || exit 1\nbash %s\n" % (
+            self.estimate, self.name, self.working_dir, self.script)
+
+    def finish(self, exit_code, message=""):
+        """
+        Build the result once the task ended
+
+        :param exit_code: exit code of the script, None if it was not executed
+        :type exit_code: int
+
+        :param message: error message
+        :type message: str
+        """
+        code = 0 if exit_code == 0 else 1
+        if code and not len(message):
+            message = "%s ended with exit code %s in the Slurm job %s" % (self.name, exit_code,
+                                                                          self.pack.job.job_id if self.pack else None)
+        self.result = {"code": code, "message": message, "output": "", "exit_code": exit_code,
+                       "job_id": self.pack.job.job_id if self.pack else None, "elapsed": time() - self.start_time}
+        self.event.set()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the task ends
+
+        :param timeout: seconds to wait
+        :type timeout: float
+
+        :return: execution result with the code (int), message (str), exit code (int), job ID of the
+            allocation (str) and elapsed time (float), None if the timeout expires
+        :rtype: dict(str, object)
+        """
+        self.event.wait(timeout)
+        return self.result
+
+
+class SlurmPack(object):
+    """
+    **An allocation of the** :class:`dagon.slurm.PackManager` **running a pilot agent**
+
+    :ivar directory: directory of the allocation, where the tasks are queued and their exit codes written
+    :vartype directory: str
+
+    :ivar job: job of the allocation
+    :vartype job: :class:`dagon.slurm.SlurmJob`
+
+    :ivar tasks: tasks assigned and not ended, by ID
+    :vartype tasks: dict(str, :class:`dagon.slurm.PackedTask`)
+
+    :ivar closed: True if no more tasks are assigned to the allocation
+    :vartype closed: bool
+    """
+
+    def __init__(self, directory, size, walltime):
+        """
+        :param directory: directory of the allocation
+        :type directory: str
+
+        :param size: number of tasks executed at the same time
+        :type size: int
+
+        :param walltime: seconds the agent accepts tasks
+        :type walltime: int
+        """
+        self.directory = directory
+        self.size = size
+        self.walltime = walltime
+        self.job = None
+        self.tasks = {}
+        self.started = None
+        self.closed = False
+
+    def get_remaining(self):
+        """
+        :return: seconds the agent will keep accepting tasks, all the walltime while it is pending
+        :rtype: float
+        """
+        if self.started is None:
+            return self.walltime
+        return self.walltime - (time() - self.started)
+
+    def fits(self, task):
+        """
+        Returns True if the task can be assigned to the allocation: it ends before the walltime, even after the
+        tasks already assigned divided between its slots
+
+        :param task: task to be assigned
+        :type task: :class:`dagon.slurm.PackedTask`
+
+        :return: True if the task has room
+        :rtype: bool
+        """
+        if self.closed or (self.job is not None and self.job.done()):
+            return False
+        remaining = self.get_remaining()
+        load = sum(other.estimate for other in self.tasks.values())
+        return task.estimate <= remaining and float(load + task.estimate) / self.size <= remaining
+
+
+class PackManager(object):
+    """
+    **Executes many short tasks inside a few Slurm allocations**
+
+    Each allocation runs a pilot agent with one slot per Slurm task. The tasks are queued as scripts in the
+    directory of the allocation, the agent executes them with the launcher (``srun --exclusive`` by default)
+    as its slots get free and writes their exit codes. A task is only assigned to an allocation with time to
+    execute it according to its estimate; the agent rejects the tasks that would exceed the walltime and they
+    are queued in a new allocation. The agent ends when it has been idle for a while or its walltime is over.
+    The queue is written and the exit codes read with one command per interval for all the allocations.
+    """
+
+    # Seconds between the polls of the allocations
+    POLL_INTERVAL = 5
+
+    # Seconds waiting for more tasks before queuing them
+    SUBMIT_DELAY = 0.2
+
+    # Seconds of the Slurm time limit after the walltime of the agent, to end the tasks running
+    MARGIN = 60
+
+    # Times a task is moved to a new allocation before it fails
+    MAX_REQUEUE = 3
+
+    # Agent executing the tasks inside the allocation
+    AGENT = """#! /bin/bash
+# This is the DagOn pilot agent, it executes the tasks queued in its directory
+dir={directory}
+end=$(( $(date +%s) + {walltime} ))
+slots=${{SLURM_NTASKS:-{size}}}
+last=$(date +%s)
+date +%s > $dir/started
+while true; do
+    for f in $dir/queue/*.sh; do
+        [ -f "$f" ] || continue
+        id=$(basename $f .sh)
+        estimate=$(sed -n 's/^# estimate=//p' $f)
+        if [ $(( $(date +%s) + ${{estimate:-0}} )) -gt $end ]; then mv $f $dir/rejected/; continue; fi
+        while [ $(jobs -rp | wc -l) -ge $slots ]; do wait -n; done
+        mv $f $dir/running/$id.sh
+        ( {launcher} bash $dir/running/$id.sh > $dir/running/$id.out 2>&1
+          echo $? > $dir/done/$id.tmp && mv $dir/done/$id.tmp $dir/done/$id.code ) &
+    done
+    now=$(date +%s)
+    if [ $(jobs -rp | wc -l) -gt 0 ]; then last=$now; fi
+    if [ $(( now - last )) -ge {idle} ] || [ $now -ge $end ]; then break; fi
+    sleep 1
+done
+wait
+"""
+
+    instances = {}
+    instance_lock = threading.Lock()
+
+    def __init__(self, execute, monitor, directory, cfg=None, options=""):
+        """
+        :param execute: function executing a command where Slurm is, returning the exit code, output and error
+        :type execute: callable(str) -> tuple(int, str, str)
+
+        :param monitor: monitor submitting the allocations
+        :type monitor: :class:`dagon.slurm.SlurmMonitor`
+
+        :param directory: directory where the directories of the allocations are created
+        :type directory: str
+
+        :param cfg: pack section of the configuration: size (tasks per allocation), walltime (seconds),
+            idle (seconds), launcher and poll_interval
+        :type cfg: dict(str, str)
+
+        :param options: other sbatch options of the allocations, e.g. the partition
+        :type options: str
+        """
+        cfg = cfg or {}
+        self.execute = execute
+        self.monitor = monitor
+        self.directory = directory
+        self.options = options
+        self.size = max(1, int(cfg.get('size') or 8))
+        self.walltime = max(1, int(cfg.get('walltime') or 3600))
+        self.idle = int(cfg.get('idle') or 60)
+        self.launcher = cfg.get('launcher', "srun --exclusive -N1 -n1")
+        self.poll_interval = float(cfg.get('poll_interval') or PackManager.POLL_INTERVAL)
+        self.condition = threading.Condition()
+        self.queued = []
+        self.packs = []
+        self.metrics = {"allocations": 0, "packed": 0, "requeued": 0, "completed": 0, "failed": 0, "polls": 0}
+        self.thread = threading.Thread(target=self.loop, name="dagon-pack")
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def get_instance(key, execute, monitor, directory, cfg=None, options=""):
+        """
+        Returns the manager of the allocations of a Slurm controller with some options
+
+        :param key: identifies the controller and the options of the allocations
+        :type key: tuple
+
+        :return: the manager
+        :rtype: :class:`dagon.slurm.PackManager`
+        """
+        with PackManager.instance_lock:
+            if key not in PackManager.instances:
+                PackManager.instances[key] = PackManager(execute, monitor, directory, cfg, options)
+            return PackManager.instances[key]
+
+    def submit(self, name, working_dir, script, estimate):
+        """
+        Queue a task in an allocation, returning without waiting for it
+
+        :param name: name of the task
+        :type name: str
+
+        :param working_dir: directory where the script is executed
+        :type working_dir: str
+
+        :param script: path of the script to be executed
+        :type script: str
+
+        :param estimate: seconds the task is expected to run
+        :type estimate: int
+
+        :return: the task
+        :rtype: :class:`dagon.slurm.PackedTask`
+        """
+        task = PackedTask(name, working_dir, script, estimate)
+        if task.estimate > self.walltime:
+            task.finish(None, "%s is expected to run %d seconds, more than the walltime of the allocations" %
+                        (name, task.estimate))
+            return task
+        with self.condition:
+            self.queued.append(task)
+            self.condition.notify()
+        return task
+
+    def loop(self):
+        """
+        Body of the thread queuing the tasks and polling the allocations
+        """
+        last_poll = time()
+        while True:
+            with self.condition:
+                while not len(self.queued) and not len(self.packs):
+                    self.condition.wait()
+                timeouts = [last_poll + self.poll_interval - time()]
+                if len(self.queued):
+                    timeouts.append(self.queued[0].start_time + PackManager.SUBMIT_DELAY - time())
+                timeout = min(timeouts)
+                if timeout > 0:
+                    self.condition.wait(timeout)
+                queued = []
+                if len(self.queued) and time() >= self.queued[0].start_time + PackManager.SUBMIT_DELAY:
+                    queued, self.queued = self.queued, []
+
+            try:
+                if len(queued):
+                    self.dispatch(queued)
+                if len(self.packs) and time() >= last_poll + self.poll_interval:
+                    last_poll = time()
+                    self.poll()
+            except Exception as e:
+                # The tasks not queued are retried with the next ones
+                for task in queued:
+                    if task.result is None and (task.pack is None or task.pack not in self.packs):
+                        self.requeue(task, "Couldn't queue %s: %s" % (task.name, e))
+
+    def dispatch(self, tasks):
+        """
+        Assign the tasks to the allocations with time for them, submitting new allocations if needed, and
+        write their scripts in a single command
+        """
+        new_packs = []
+        command = []
+        for task in tasks:
+            pack = next((pack for pack in self.packs + new_packs if pack.fits(task)), None)
+            if pack is None:
+                pack = SlurmPack("%s/%s" % (self.directory, uuid4().hex[:12]), self.size, self.walltime)
+                new_packs.append(pack)
+                agent = PackManager.AGENT.format(directory=pack.directory, walltime=self.walltime, size=self.size,
+                                                 launcher=self.launcher, idle=self.idle)
+                command.append("mkdir -p " + " ".join(pack.directory + "/" + d for d in
+                                                      ["queue", "running", "done", "rejected"]))
+                command.append("cat > %s/agent.sh <<'DAGON_EOF'\n%sDAGON_EOF" % (pack.directory, agent))
+            task.pack = pack
+            pack.tasks[task.task_id] = task
+            command.append("cat > %s/queue/%s.tmp <<'DAGON_EOF'\n%sDAGON_EOF\nmv %s/queue/%s.tmp %s/queue/%s.sh" %
+                           (pack.directory, task.task_id, task.get_queue_script(), pack.directory, task.task_id,
+                            pack.directory, task.task_id))
+            self.metrics['packed'] += 1
+
+        code, output, error = self.execute("\n".join(command))
+        if code:
+            raise Exception(error or output)
+
+        minutes = (self.walltime + PackManager.MARGIN + 59) // 60
+        for pack in new_packs:
+            pack.job = self.monitor.submit("sbatch --parsable --ntasks=%d --time=%d %s -J dagon-pack -D %s -o %s "
+                                           "%s" % (self.size, minutes, self.options, pack.directory,
+                                                   pack.directory + "/agent.out", pack.directory + "/agent.sh"),
+                                           "dagon-pack")
+            self.metrics['allocations'] += 1
+        with self.condition:
+            self.packs += new_packs
+
+    def poll(self):
+        """
+        Read the exit codes of the tasks ended and the tasks rejected by the agents. The tasks still queued in
+        an allocation ended are moved to a new one, the ones that were running fail
+        """
+        with self.condition:
+            packs = list(self.packs)
+        ended = [pack for pack in packs if pack.job is not None and pack.job.done()]
+        self.metrics['polls'] += 1
+        command = []
+        for pack in packs:
+            d = pack.directory
+            command.append("[ -f %s/started ] && echo \"started %s\"" % (d, d))
+            command.append("for f in %s/done/*.code; do [ -f \"$f\" ] && echo \"done $f $(cat $f)\" && "
+                           "mv \"$f\" \"${f%%.code}.seen\"; done" % d)
+            command.append("for f in %s/rejected/*.sh; do [ -f \"$f\" ] && echo \"rejected $f\" && rm -f \"$f\"; "
+                           "done" % d)
+            if pack in ended:
+                command.append("for f in %s/queue/*.sh; do [ -f \"$f\" ] && echo \"rejected $f\" && rm -f \"$f\"; "
+                               "done" % d)
+        code, output, _ = self.execute("\n".join(command) + "\ntrue")
+        if code:
+            return
+
+        by_directory = {pack.directory: pack for pack in packs}
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            if fields[0] == "started":
+                pack = by_directory.get(fields[1])
+                if pack is not None and pack.started is None:
+                    pack.started = time()
+                continue
+            directory = fields[1].rsplit("/", 2)[0]
+            task_id = fields[1].rsplit("/", 1)[-1].split(".")[0]
+            pack = by_directory.get(directory)
+            task = pack.tasks.pop(task_id, None) if pack is not None else None
+            if task is None:
+                continue
+            if fields[0] == "done":
+                exit_code = int(fields[2]) if len(fields) > 2 and fields[2].lstrip("-").isdigit() else None
+                self.metrics['completed' if exit_code == 0 else 'failed'] += 1
+                task.finish(exit_code)
+            elif fields[0] == "rejected":
+                # Not enough time left in the allocation
+                pack.closed = True
+                self.requeue(task, "%s was not executed before the walltime of the allocations" % task.name)
+
+        for pack in ended:
+            for task in list(pack.tasks.values()):
+                self.metrics['failed'] += 1
+                task.finish(None, "%s was running when the allocation %s ended (%s)" %
+                            (task.name, pack.job.job_id, pack.job.result['message'] or pack.job.state))
+            pack.tasks = {}
+            with self.condition:
+                self.packs.remove(pack)
+
+    def requeue(self, task, message):
+        """
+        Queue a task again in other allocation, or fail it if it was requeued too many times
+
+        :param task: task not executed
+        :type task: :class:`dagon.slurm.PackedTask`
+
+        :param message: error message if it fails
+        :type message: str
+        """
+        if task.pack is not None:
+            task.pack.tasks.pop(task.task_id, None)
+        task.pack = None
+        task.requeued += 1
+        if task.requeued > PackManager.MAX_REQUEUE:
+            self.metrics['failed'] += 1
+            task.finish(None, message)
+            return
+        self.metrics['requeued'] += 1
+        with self.condition:
+            self.queued.append(task)
+            self.condition.notify()
+
+    def get_metrics(self):
+        """
+        :return: allocations submitted, tasks packed, requeued, completed and failed, polls and allocations
+            active
+        :rtype: dict(str, int)
+        """
+        with self.condition:
+            metrics = dict(self.metrics)
+            metrics['active'] = len(self.packs)
+            return metrics
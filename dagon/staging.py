@@ -0,0 +1,710 @@
+import errno
+import glob
+import hashlib
+import json
+import os
+import posixpath
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+
+# ioctl request cloning a file on filesystems with copy-on-write (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def expand(src, dst, walk=True):
+    """
+    Returns the files to be staged from a pattern, creating the destination directories. When several
+    files match, the destination is a directory
+
+    :param src: path of the source, it can be a glob pattern
+    :type src: str
+
+    :param dst: path of the destination
+    :type dst: str
+
+    :param walk: True to return the files inside the directories instead of the directories
+    :type walk: bool
+
+    :return: source and destination of each file, empty if nothing matches
+    :rtype: list(tuple(str, str))
+    """
+    matches = sorted(glob.glob(src))
+    pairs = []
+    if len(matches) == 1:
+        pairs.append((matches[0], dst))
+    else:
+        for match in matches:
+            pairs.append((match, os.path.join(dst, os.path.basename(match))))
+
+    # The directories are created before the files are staged in parallel
+    files = []
+    for src_path, dst_path in pairs:
+        if os.path.isdir(src_path) and walk:
+            for root, dirs, names in os.walk(src_path):
+                dst_root = os.path.join(dst_path, os.path.relpath(root, src_path))
+                os.makedirs(dst_root, exist_ok=True)
+                for name in names:
+                    files.append((os.path.join(root, name), os.path.join(dst_root, name)))
+        else:
+            parent = os.path.dirname(dst_path)
+            if len(parent):
+                os.makedirs(parent, exist_ok=True)
+            files.append((src_path, dst_path))
+    return files
+
+
+class StagingResult(object):
+    """
+    **Result of staging a file**
+
+    :ivar src: path of the source file
+    :vartype src: str
+
+    :ivar dst: path of the destination file
+    :vartype dst: str
+
+    :ivar method: method used (copy, sendfile, hardlink, reflink, symlink)
+    :vartype method: str
+
+    :ivar size: size of the file
+    :vartype size: int
+
+    :ivar bytes: bytes written on the destination
+    :vartype bytes: int
+
+    :ivar bytes_avoided: bytes not copied because the file was linked or cloned
+    :vartype bytes_avoided: int
+
+    :ivar elapsed: seconds spent staging the file
+    :vartype elapsed: float
+
+    :ivar error: error message, None if the file was staged
+    :vartype error: str
+    """
+
+    def __init__(self, src, dst, method, size=0, bytes=0, elapsed=0.0, error=None):
+        self.src = src
+        self.dst = dst
+        self.method = method
+        self.size = size
+        self.bytes = bytes
+        self.bytes_avoided = 0
+        self.elapsed = elapsed
+        self.error = error
+
+    def is_ok(self):
+        """
+        :return: True if the file was staged
+        :rtype: bool
+        """
+        return self.error is None
+
+    def as_json(self):
+        """
+        Return a json representation of the result
+
+        :return: JSON representation
+        :rtype: dict(str, object)
+        """
+        return {"src": self.src, "dst": self.dst, "method": self.method, "size": self.size,
+                "bytes": self.bytes, "bytes_avoided": self.bytes_avoided, "elapsed": self.elapsed,
+                "error": self.error}
+
+
+class StagingCache(object):
+    """
+    **Content-addressed store of the files staged on a host**
+
+    The files are identified by a fingerprint of their device, inode, size and modification time. The
+    first task staging a file clones it into the store, the following ones hard link the stored copy,
+    so staging the same file again does not copy it. The stored copies are read-only and the least
+    recently used are evicted when the store exceeds its maximum size.
+
+    :ivar root: directory of the store
+    :vartype root: str
+
+    :ivar max_size: maximum bytes in the store
+    :vartype max_size: int
+    """
+
+    def __init__(self, root, max_size=10 * 1024 ** 3):
+        """
+        :param root: directory of the store
+        :type root: str
+
+        :param max_size: maximum bytes in the store
+        :type max_size: int
+        """
+        self.root = root
+        self.max_size = int(max_size)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+        self.load()
+
+    def load(self):
+        """
+        Index the files already in the store, the least recently accessed first
+        """
+        entries = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                if name.endswith(".tmp"):
+                    os.remove(path)
+                    continue
+                st = os.stat(path)
+                entries.append((st.st_atime, name, st.st_size))
+        for _, key, size in sorted(entries):
+            self.entries[key] = size
+            self.size += size
+
+    @staticmethod
+    def fingerprint(path):
+        """
+        Returns the key of a file in the store
+
+        :param path: path to the file
+        :type path: str
+
+        :return: fingerprint of the device, inode, size and modification time
+        :rtype: str
+        """
+        st = os.stat(path)
+        key = "%d:%d:%d:%d" % (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get_path(self, key):
+        """
+        :param key: fingerprint of a file
+        :type key: str
+
+        :return: path of the file in the store
+        :rtype: str
+        """
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, src):
+        """
+        Returns the stored copy of a file, adding it to the store if it is not there
+
+        :param src: path to the file
+        :type src: str
+
+        :return: path of the stored copy and True if it was already in the store
+        :rtype: tuple(str, bool)
+        """
+        key = StagingCache.fingerprint(src)
+        path = self.get_path(key)
+        with self.lock:
+            if key in self.entries and os.path.exists(path):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.bytes_saved += self.entries[key]
+                return path, True
+
+        # Clone the file with a temporal name, so other tasks never see a partial copy
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%d.tmp" % (path, threading.get_ident())
+        StagingEngine.reflink(src, tmp)
+        os.chmod(tmp, 0o444)
+        os.replace(tmp, path)
+        size = os.path.getsize(path)
+
+        with self.lock:
+            self.misses += 1
+            if key not in self.entries:
+                self.entries[key] = size
+                self.size += size
+            self.entries.move_to_end(key)
+            self.evict(keep=key)
+        return path, False
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used files until the store fits in its maximum size. Must be called
+        holding the lock
+
+        :param keep: key that can not be evicted
+        :type keep: str
+        """
+        for key in list(self.entries):
+            if self.size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            size = self.entries.pop(key)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.remove(self.get_path(key))
+            except OSError:
+                pass
+
+    def as_json(self):
+        """
+        Return the metrics of the store
+
+        :return: JSON representation
+        :rtype: dict(str, object)
+        """
+        with self.lock:
+            return {"root": self.root, "files": len(self.entries), "size": self.size, "max_size": self.max_size,
+                    "hits": self.hits, "misses": self.misses, "bytes_saved": self.bytes_saved,
+                    "evictions": self.evictions}
+
+
+class StagingEngine(object):
+    """
+    **Stages data between directories visible from this process without generating shell commands**
+
+    The files are staged in a thread pool using one of the methods:
+
+    * ``copy``: copy the content and the metadata
+    * ``sendfile``: copy the content in the kernel with sendfile
+    * ``hardlink``: hard link, the content is copied when the source is on other filesystem
+    * ``reflink``: copy-on-write clone, the content is copied when it is not supported
+    * ``symlink``: symbolic link to the source
+    * ``link``: hard link on the same filesystem (symbolic link if it is not possible), copy across devices
+
+    When a :class:`dagon.staging.StagingCache` is given, the files are not copied but hard linked from the
+    store (``cached``).
+    """
+
+    METHODS = ["copy", "sendfile", "hardlink", "reflink", "symlink", "link"]
+
+    # Files staged at the same time when the configuration doesn't say it ([staging] threads)
+    THREADS = 8
+
+    instance = None
+    instance_lock = threading.Lock()
+
+    def __init__(self, threads=THREADS):
+        """
+        :param threads: number of files staged at the same time
+        :type threads: int
+        """
+        self.threads = max(1, int(threads))
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+
+    @staticmethod
+    def get_instance(threads=THREADS):
+        """
+        Returns the process-wide engine
+
+        :param threads: number of files staged at the same time, used the first time
+        :type threads: int
+
+        :return: the engine
+        :rtype: :class:`dagon.staging.StagingEngine`
+        """
+        with StagingEngine.instance_lock:
+            if StagingEngine.instance is None:
+                StagingEngine.instance = StagingEngine(threads)
+            return StagingEngine.instance
+
+    def stage(self, src, dst, method="copy", cache=None):
+        """
+        Stage the files matching a pattern. When several files match, the destination is a directory
+
+        :param src: path of the source, it can be a glob pattern
+        :type src: str
+
+        :param dst: path of the destination
+        :type dst: str
+
+        :param method: staging method (copy, sendfile, hardlink, reflink, symlink)
+        :type method: str
+
+        :param cache: store of the files staged on this host, not used to create links
+        :type cache: :class:`dagon.staging.StagingCache`
+
+        :return: result of each file staged
+        :rtype: list(:class:`dagon.staging.StagingResult`)
+        """
+        if method not in StagingEngine.METHODS:
+            raise Exception("Unknown staging method %s" % method)
+
+        files = expand(src, dst, walk=method != "symlink")
+        if not len(files):
+            return [StagingResult(src, dst, method, error="No such file or directory")]
+
+        if cache is not None and method != "symlink":
+            futures = [self.executor.submit(self.stage_cached, src_path, dst_path, cache)
+                       for src_path, dst_path in files]
+        else:
+            futures = [self.executor.submit(self.stage_file, src_path, dst_path, method)
+                       for src_path, dst_path in files]
+        return [future.result() for future in futures]
+
+    def stage_file(self, src, dst, method):
+        """
+        Stage a single file
+
+        :param src: path of the source file
+        :type src: str
+
+        :param dst: path of the destination file
+        :type dst: str
+
+        :param method: staging method
+        :type method: str
+
+        :return: result of the staging
+        :rtype: :class:`dagon.staging.StagingResult`
+        """
+        start_time = time()
+        result = StagingResult(src, dst, method)
+        try:
+            result.size = os.path.getsize(src)
+            if os.path.lexists(dst):
+                os.remove(dst)
+            result.method = getattr(self, method)(src, dst)
+            if result.method in ["copy", "sendfile"]:
+                result.bytes = result.size
+            result.bytes_avoided = result.size - result.bytes
+        except (OSError, IOError) as e:
+            result.error = str(e)
+        result.elapsed = time() - start_time
+        return result
+
+    def stage_cached(self, src, dst, cache):
+        """
+        Stage a single file hard linking its copy in the store
+
+        :param src: path of the source file
+        :type src: str
+
+        :param dst: path of the destination file
+        :type dst: str
+
+        :param cache: store of the files staged on this host
+        :type cache: :class:`dagon.staging.StagingCache`
+
+        :return: result of the staging
+        :rtype: :class:`dagon.staging.StagingResult`
+        """
+        start_time = time()
+        result = StagingResult(src, dst, "cached")
+        try:
+            result.size = os.path.getsize(src)
+            stored, hit = cache.get(src)
+            if not hit:
+                result.bytes = result.size
+            if os.path.lexists(dst):
+                if os.path.samefile(dst, stored):
+                    # Already staged
+                    result.bytes_avoided = result.size - result.bytes
+                    result.elapsed = time() - start_time
+                    return result
+                os.remove(dst)
+            if self.hardlink(stored, dst) != "hardlink":
+                # The store is on other filesystem
+                result.method = "sendfile"
+                result.bytes += result.size
+            result.bytes_avoided = max(0, result.size - result.bytes)
+        except (OSError, IOError) as e:
+            result.error = str(e)
+        result.elapsed = time() - start_time
+        return result
+
+    @staticmethod
+    def copy(src, dst):
+        shutil.copy2(src, dst)
+        return "copy"
+
+    @staticmethod
+    def sendfile(src, dst):
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        shutil.copymode(src, dst)
+        return "sendfile"
+
+    @staticmethod
+    def hardlink(src, dst):
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError as e:
+            # Other filesystem or links not supported
+            if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP]:
+                raise
+        return StagingEngine.sendfile(src, dst)
+
+    @staticmethod
+    def link(src, dst):
+        # The device boundary is detected before trying to link
+        if os.stat(src).st_dev != os.stat(os.path.dirname(os.path.abspath(dst))).st_dev:
+            return StagingEngine.sendfile(src, dst)
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError as e:
+            # Hard links not allowed or not supported
+            if e.errno not in [errno.EPERM, errno.EMLINK, errno.ENOTSUP]:
+                raise
+        return StagingEngine.symlink(src, dst)
+
+    @staticmethod
+    def reflink(src, dst):
+        if fcntl is not None:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                    cloned = True
+                except (OSError, IOError):
+                    cloned = False
+            if cloned:
+                shutil.copymode(src, dst)
+                return "reflink"
+        return StagingEngine.sendfile(src, dst)
+
+    @staticmethod
+    def symlink(src, dst):
+        os.symlink(os.path.abspath(src), dst)
+        return "symlink"
+
+
+class DeltaSync(object):
+    """
+    **Synchronizes files with the copy of a previous run, writing only the blocks that changed**
+
+    The copies are kept in a store that outlives the runs, by default under the scratch directory base,
+    because the scratch directories of the tasks have a new name in each run and are deleted when they are
+    released. A copy is identified by the workflow, the task and the destination path relative to the
+    working directory of the task, which are the same in each run. Next to each copy, the state of its
+    source is kept, so the files not changed since the last synchronization are skipped without being read.
+    The other files are compared with the copy block by block at the same offsets and only the blocks that
+    differ are written. Between local files the source is read anyway, so looking for shifted blocks with a
+    rolling checksum (as rsync does over the network) would only spend CPU. A copy with a different size is
+    replaced by a plain copy.
+
+    The copy is put in the destination with a reflink, or with a hard link when the filesystem can't clone
+    files. A copy still linked from the destination of a previous run is replaced instead of patched, so
+    that destination is not changed. The copies not used for :attr:`STORE_TTL` seconds are removed.
+    """
+
+    # Bytes compared each time
+    BLOCK_SIZE = 1024 ** 2
+
+    # Seconds a copy is kept without being used
+    STORE_TTL = 7 * 24 * 3600
+
+    def __init__(self, store, engine=None, dst_root=None, prefix=""):
+        """
+        :param store: directory where the copies of the previous runs are kept
+        :type store: str
+
+        :param engine: engine whose thread pool is used to synchronize several files at the same time
+        :type engine: :class:`dagon.staging.StagingEngine`
+
+        :param dst_root: working directory of the destination task, the copies are keyed on the destination
+            relative to it
+        :type dst_root: str
+
+        :param prefix: identifies the destination task in the keys of the copies, e.g. workflow and task names
+        :type prefix: str
+        """
+        self.store = store
+        self.engine = engine if engine is not None else StagingEngine.get_instance()
+        self.dst_root = dst_root.rstrip("/") if dst_root is not None else None
+        self.prefix = prefix
+
+    def sync(self, src, dst):
+        """
+        Synchronize the files matching a pattern. When several files match, the destination is a directory
+
+        :param src: path of the source, it can be a glob pattern
+        :type src: str
+
+        :param dst: path of the destination
+        :type dst: str
+
+        :return: result of each file synchronized
+        :rtype: list(:class:`dagon.staging.StagingResult`)
+        """
+        files = expand(src, dst)
+        if not len(files):
+            return [StagingResult(src, dst, "delta", error="No such file or directory")]
+        os.makedirs(self.store, exist_ok=True)
+        self.prune()
+        futures = [self.engine.executor.submit(self.sync_file, src_path, dst_path) for src_path, dst_path in files]
+        return [future.result() for future in futures]
+
+    def prune(self):
+        """
+        Remove the copies not used for :attr:`STORE_TTL` seconds
+        """
+        limit = time() - DeltaSync.STORE_TTL
+        for name in os.listdir(self.store):
+            path = os.path.join(self.store, name)
+            try:
+                if name.endswith(".json") and os.path.getmtime(path) < limit:
+                    os.remove(path)
+                    os.remove(path[:-len(".json")])
+            except OSError:
+                pass
+
+    def get_copy(self, dst):
+        """
+        :param dst: path of the destination file
+        :type dst: str
+
+        :return: path in the store of the copy of a destination file
+        :rtype: str
+        """
+        return os.path.join(self.store, DeltaSync.get_key(os.path.abspath(dst), self.dst_root, self.prefix))
+
+    @staticmethod
+    def get_key(dst, dst_root=None, prefix=""):
+        """
+        Returns the name of the copy of a destination in a store, the same in each run
+
+        :param dst: absolute path of the destination
+        :type dst: str
+
+        :param dst_root: working directory of the destination task
+        :type dst_root: str
+
+        :param prefix: identifies the destination task
+        :type prefix: str
+
+        :return: name of the copy
+        :rtype: str
+        """
+        if dst_root is not None and dst.startswith(dst_root.rstrip("/") + "/"):
+            dst = posixpath.relpath(dst, dst_root)
+        return hashlib.sha1((prefix + "\0" + dst).encode()).hexdigest()
+
+    def sync_file(self, src, dst):
+        """
+        Synchronize a single file
+
+        :param src: path of the source file
+        :type src: str
+
+        :param dst: path of the destination file
+        :type dst: str
+
+        :return: result of the synchronization
+        :rtype: :class:`dagon.staging.StagingResult`
+        """
+        start_time = time()
+        result = StagingResult(src, dst, "delta")
+        copy = self.get_copy(dst)
+        try:
+            st = os.stat(src)
+            result.size = st.st_size
+            state = {"src": [st.st_size, st.st_mtime_ns, st.st_ino]}
+            try:
+                with open(copy + ".json") as f:
+                    entry = json.load(f)
+            except (IOError, OSError, ValueError):
+                entry = None
+
+            copy_st = os.stat(copy) if os.path.isfile(copy) else None
+            if copy_st is not None and entry is not None and entry.get("src") == state["src"] and \
+                    entry.get("copy") == [copy_st.st_size, copy_st.st_mtime_ns]:
+                # Not changed since the last synchronization
+                result.method = "skip"
+            elif copy_st is None or copy_st.st_size != st.st_size or copy_st.st_nlink > 1:
+                # Nothing to compare with, or the copy is still linked from the destination of a previous run
+                StagingEngine.sendfile(src, copy + ".tmp")
+                os.replace(copy + ".tmp", copy)
+                result.method = "sendfile"
+                result.bytes = result.size
+            else:
+                result.bytes = DeltaSync.patch(src, copy)
+            result.bytes_avoided = result.size - result.bytes
+
+            copy_st = os.stat(copy)
+            state["copy"] = [copy_st.st_size, copy_st.st_mtime_ns]
+            with open(copy + ".json.tmp", "w") as f:
+                json.dump(state, f)
+            os.replace(copy + ".json.tmp", copy + ".json")
+            DeltaSync.place(copy, dst)
+        except (OSError, IOError) as e:
+            result.error = str(e)
+        result.elapsed = time() - start_time
+        return result
+
+    @staticmethod
+    def place(copy, dst):
+        """
+        Put the copy in the destination, cloning it, linking it or copying it when it is on other filesystem
+
+        :param copy: path of the copy in the store
+        :type copy: str
+
+        :param dst: path of the destination file
+        :type dst: str
+
+        :return: method used
+        :rtype: str
+        """
+        tmp = dst + ".dagon-delta"
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        if fcntl is not None:
+            with open(copy, "rb") as fsrc, open(tmp, "wb") as fdst:
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                    cloned = True
+                except (OSError, IOError):
+                    cloned = False
+            if cloned:
+                shutil.copymode(copy, tmp)
+                os.replace(tmp, dst)
+                return "reflink"
+            os.remove(tmp)
+        method = StagingEngine.hardlink(copy, tmp)
+        os.replace(tmp, dst)
+        return method
+
+    @staticmethod
+    def patch(src, dst):
+        """
+        Write in the previous copy the blocks of the source that differ from it. Both files have the same size
+
+        :param src: path of the source file
+        :type src: str
+
+        :param dst: path of the previous copy
+        :type dst: str
+
+        :return: bytes written
+        :rtype: int
+        """
+        written = 0
+        with open(src, "rb") as fsrc, open(dst, "r+b") as fdst:
+            offset = 0
+            for block in iter(lambda: fsrc.read(DeltaSync.BLOCK_SIZE), b""):
+                if fdst.read(len(block)) != block:
+                    fdst.seek(offset)
+                    fdst.write(block)
+                    written += len(block)
+                offset += len(block)
+                fdst.seek(offset)
+            fdst.truncate(offset)
+        shutil.copymode(src, dst)
+        return written
@@ -1,5 +1,8 @@
 import shutil
 import glob
+import socket
+import getpass
+from contextlib import contextmanager
 from json import loads
 from threading import Thread
 from threading import Semaphore
@@ -7,8 +10,11 @@ import os
 import subprocess
 from os import makedirs, path, chmod, system
 from time import time, sleep
+from uuid import uuid4
 from enum import Enum
 from dagon.ftp_publisher import FTP_API
+from dagon.references import parse_references
+from dagon.scratch import get_tree_size, remove_tree
 import dagon
 
 
@@ -109,6 +115,9 @@ class Task(Thread):#estende la classe thread
 
     """
 
+    # True if the task runs the parallel mode as a fan-out of its own command, one element per file
+    FAN_OUT = False
+
     def __init__(self, name, command, working_dir=None, transversal_workflow=None, globusendpoint=None):
         """
         :param name: name of the task
@@ -134,10 +143,22 @@ class Task(Thread):#estende la classe thread
         self.ip = None
         self.running = False
         self.workflow = None
+        self.status_listeners = []
+        self.slot_manager = None
+        self.overhead = {}
+        self.ready_time = None
         self.set_status(dagon.Status.READY)
         self.working_dir = working_dir
         self.dependency_dir = []
         self.command = command
+        self.references = None
+        self.stream_output = False
+        self.staging_results = []
+        self.pending_transfers = []
+        self.elements = []
+        self.fan_out_limit = None
+        self.map_items = None
+        self.expansion = None
         self.input_file = []
         self.output_file = []
         self.info = None
@@ -160,6 +181,86 @@ class Task(Thread):#estende la classe thread
     def set_mode(self, mode):
         self.mode = mode
 
+    def set_fan_out_limit(self, limit):
+        """
+        Set the maximum number of elements of the fan-out, or of tasks added by the expansion, executed at the
+        same time in parallel mode
+
+        :param limit: maximum number of elements or tasks running
+        :type limit: int
+        """
+        self.fan_out_limit = limit
+
+    def set_map(self, items=None, limit=None):
+        """
+        Execute the command once per item as tasks added to the workflow when this task is executed. Without
+        items, the command is executed once per file matched by its first workflow:// reference with a glob
+        pattern. The tasks depending on this one wait for all the tasks added
+
+        :param items: values replacing :attr:`dagon.Workflow.ITEM` in the command
+        :type items: list(str)
+
+        :param limit: maximum number of tasks added executed at the same time
+        :type limit: int
+        """
+        self.mode = "map"
+        self.map_items = items
+        self.fan_out_limit = limit
+
+    def is_expanded(self):
+        """
+        :return: True if the command is executed by tasks added to the workflow instead of by this task
+        :rtype: bool
+        """
+        return self.mode == "map" or (self.mode == "parallel" and not self.FAN_OUT)
+
+    def get_elements(self):
+        """
+        Returns the elements of the fan-out executed in parallel mode
+
+        :return: index, name, input file, command, state and exit code of each element
+        :rtype: list(dict(str, object))
+        """
+        return [dict(element) for element in self.elements]
+
+    def get_element_script(self, element):
+        """
+        Returns the script executing an element of the fan-out in its own directory, named as the task that
+        would have executed it
+
+        :param element: element of the fan-out
+        :type element: dict(str, object)
+
+        :return: script content
+        :rtype: str
+        """
+        directory = self.working_dir + "/" + element['name']
+        return "#! /bin/bash\nmkdir -p " + directory + " && cd " + directory + " || exit 1\n" + \
+               element['command'] + "\n"
+
+    def get_elements_result(self):
+        """
+        Returns the execution result of the fan-out
+
+        :return: execution result
+        :rtype: dict() with the execution output (str), code (int) and message (str)
+        """
+        failed = [element['name'] for element in self.elements if element['state'] != "COMPLETED"]
+        if len(failed):
+            return {"code": 1, "message": "%d of %d elements failed: %s" % (len(failed), len(self.elements),
+                                                                             ", ".join(failed)), "output": ""}
+        return {"code": 0, "message": "", "output": "%d elements completed" % len(self.elements)}
+
+    def execute_elements(self):
+        """
+        Execute the elements of the fan-out, implemented by the tasks supporting it (FAN_OUT). The other tasks
+        expand the parallel mode into one task per file and never have elements
+
+        :return: execution result
+        :rtype: dict() with the execution output (str), code (int) and message (str)
+        """
+        return {"code": 1, "message": "%s doesn't support the fan-out" % type(self).__name__, "output": ""}
+
     def get_mode(self):
         return self.mode
 
@@ -346,6 +447,17 @@ class Task(Thread):#estende la classe thread
             self.workflow.logger.debug("%s: %s", self.name, self.status)
             if self.workflow.is_api_available:
                 self.workflow.api.update_task_status(self.workflow.workflow_id, self.name, status.name)
+        for listener in list(self.status_listeners):
+            listener(self, status)
+
+    def add_status_listener(self, listener):
+        """
+        Add a function to be called each time the status of the task changes
+
+        :param listener: function called with the task and its new status
+        :type listener: callable(:class:`dagon.task.Task`, :class:`dagon.Status`)
+        """
+        self.status_listeners.append(listener)
 
     def execute_command(self, command):
         """"
@@ -393,7 +505,43 @@ class Task(Thread):#estende la classe thread
         Call garbage collector, removing the scratch directory, containers and instances related to the
         task
         """
-        shutil.move(self.working_dir, self.working_dir + "-removed")#move the scratch directory into a new directory with the add of removed at the end of the name
+        # The scratch directory is deleted in background by the scratch manager
+        self.workflow.scratch.release(self)
+
+    def delete_scratch_dir(self):
+        """
+        Delete the scratch directory, called by the scratch manager
+
+        :return: bytes reclaimed
+        :rtype: int
+        """
+        return remove_tree(self.working_dir)
+
+    def get_scratch_usage(self):
+        """
+        Returns the bytes used by the scratch directory
+
+        :return: bytes used
+        :rtype: int
+        """
+        return get_tree_size(self.working_dir)
+
+    def remove_intermediate(self, file_path):
+        """
+        Remove a file of the scratch directory once all the tasks reading it finished
+
+        :param file_path: path of the file, relative to the scratch directory
+        :type file_path: str
+        """
+        full_path = self.working_dir + "/" + file_path
+        try:
+            if os.path.isdir(full_path) and not os.path.islink(full_path):
+                shutil.rmtree(full_path)
+            else:
+                os.remove(full_path)
+            self.workflow.logger.debug("%s: Removed intermediate %s", self.name, full_path)
+        except OSError:
+            pass
 
     # Decremet the reference count and remove scratch directory if the reference count is equal to 0
     def decrement_reference_count(self):
@@ -407,10 +555,160 @@ class Task(Thread):#estende la classe thread
             # Call garbage collector (remove scratch directory, container, cloud instace, etc)
             self.on_garbage()
             # Perform some logging
-            self.workflow.logger.debug("Removed %s", self.working_dir)
+            self.workflow.logger.debug("Released %s", self.working_dir)
+
+    def set_slot_manager(self, slot_manager):
+        """
+        Set the manager of the execution slots used to bound the concurrency
+
+        :param slot_manager: :class:`dagon.slots.SlotManager` instance
+        :type slot_manager: :class:`dagon.slots.SlotManager`
+        """
+        self.slot_manager = slot_manager
+
+    def mark_ready(self):
+        """
+        Mark the moment when the dependencies of the task are resolved, the time until the task starts its
+        execution is accounted as scheduling overhead
+        """
+        self.ready_time = time()
+
+    def add_overhead(self, phase, seconds):
+        """
+        Add the time spent on a phase of the task execution when the workflow accounts the overhead
+
+        :param phase: phase of the execution (scheduling, context, staging, script, execution)
+        :type phase: str
+
+        :param seconds: time spent
+        :type seconds: float
+        """
+        if self.workflow is not None and self.workflow.overhead_accounting:
+            self.overhead[phase] = self.overhead.get(phase, 0.0) + seconds
+
+    def add_staging_results(self, results):
+        """
+        Keep the results of the files staged in by the native staging engine
+
+        :param results: result of each file staged
+        :type results: list(:class:`dagon.staging.StagingResult`)
+        """
+        self.staging_results.extend(results)
+
+    def add_pending_transfer(self, item):
+        """
+        Keep a Globus transfer the task has to wait for before its execution
+
+        :param item: item submitted to the Globus manager
+        :type item: :class:`dagon.communication.data_transfer.GlobusItem`
+        """
+        self.pending_transfers.append(item)
+
+    def wait_pending_transfers(self, stager):
+        """
+        Wait until the Globus transfers of the task end, or until their timeout ([globus] timeout) expires,
+        keeping their results
+
+        :param stager: stager of the task
+        :type stager: :class:`dagon.Stager`
 
-    def set_semaphore(self, sem):
-        self.semaphore = sem
+        :raises Exception: the data could not be transferred
+        """
+        items, self.pending_transfers = self.pending_transfers, []
+        if len(items):
+            stager.check_results(self, "Globus", [item.get_result() for item in items])
+
+    def get_staging_results(self):
+        """
+        Returns the results of the files staged in by the native staging engine
+
+        :return: result of each file staged
+        :rtype: list(:class:`dagon.staging.StagingResult`)
+        """
+        return self.staging_results
+
+    @contextmanager
+    def account(self, phase):
+        """
+        Account the time spent on the block as a phase of the task execution
+
+        :param phase: phase of the execution (scheduling, context, staging, script, execution)
+        :type phase: str
+        """
+        start_time = time()
+        try:
+            yield
+        finally:
+            self.add_overhead(phase, time() - start_time)
+
+    def chains_to(self, task):
+        """
+        Returns True if this task can be started before a task it depends on ends, because the dependency is
+        resolved by the system executing both of them
+
+        :param task: task this task depends on
+        :type task: :class:`dagon.task.Task`
+
+        :return: True if the task doesn't wait for the other one
+        :rtype: bool
+        """
+        return False
+
+    def is_submitted(self):
+        """
+        :return: True if the task was submitted to the system executing it and the tasks chained to it can start
+        :rtype: bool
+        """
+        return False
+
+    def get_slot_keys(self):
+        """
+        Returns the execution slots held by the task while it is executed
+
+        :return: list of slot keys (kind of slot, host)
+        :rtype: list(tuple(str, str))
+        """
+        return []
+
+    def index_references(self):
+        """
+        Parse the workflow:// references of the command, they are shared by the dependency resolution,
+        the command preprocessing and the reference counting
+        """
+        self.references = parse_references(self.command)
+
+    def get_references(self, command=None):
+        """
+        Returns the workflow:// references of a command
+
+        :param command: command to be parsed. By default, the command of the task
+        :type command: str
+
+        :return: references in order of appearance
+        :rtype: list(:class:`dagon.references.WorkflowReference`)
+        """
+        if command is not None and command != self.command:
+            return parse_references(command)
+        if self.references is None:
+            self.index_references()
+        return self.references
+
+    def find_referenced_task(self, workflow_name, task_name):
+        """
+        Search for a task referenced by the command in this workflow or in the meta-workflow
+
+        :param workflow_name: Name of the workflow
+        :type workflow_name: str
+
+        :param task_name: Name of the task
+        :type task_name: str
+
+        :return: task instance
+        :rtype: :class:`dagon.task.Task` instance if it is found, None in other case
+        """
+        if self.workflows is None or self.dag_tps is None:
+            return self.workflow.find_task_by_name(workflow_name, task_name)
+        return self.dag_tps.find_task_by_name(workflow_name, task_name)
 
     # Method overrided
     def pre_run(self):
@@ -497,56 +795,21 @@ class Task(Thread):#estende la classe thread
                 file_name = file_parts[-1]
                 if file_name not in self.output_file:
                     self.output_file.append(file_name)
+                # Keep the producer of the file
+                if len(arg.split()):
+                    self.workflow.lineage.add_output(self, arg.split()[0])
                 pos = pos3
             else:
                 break
 
-        pos = 0
-        # Forever unless no anymore dagon.Workflow.SCHEMA are present
-        while True:
-            # Get the position of the next dagon.Workflow.SCHEMA (find torna la posizione nel comando della d)
-            pos1 = self.command.find(dagon.Workflow.SCHEMA, pos)
-
-            # Check if there is no dagon.Workflow.SCHEMA
-            if pos1 == -1:
-                # Exit the forever cycle
-                break
-
-            # Find the first occurrent of a whitespace (or if no occurrence means the end of the string)
-            pos2 = self.command.find(" ", pos1)
-
-            #se non ha trovato lo spazio (ovvero in pos2 c'è -1 poichè il find ha resituito -1) allora verrà settata la lunghezza a tutto il comando
-            # Check if this is the last referenced argument
-            if pos2 == -1:
-                pos2 = len(self.command)
-
-            # Extract the parameter string (prende il comando presente dalla d alla fine del comando a partire da dagon)
-            arg = self.command[pos1:pos2]
-
-            # Remove the dagon.Workflow.SCHEMA label
-            arg = arg.replace(dagon.Workflow.SCHEMA, "")
-
-            # Split each argument in elements by the slash
-            elements = arg.split("/")
-
-            # Extract the referenced task's workflow name
-            workflow_name = elements[0]
-
-            # The task name is the first element
-            task_name = elements[1]
-            
-            # Set the default workflow name if needed
-            if workflow_name is None or workflow_name == "":
-                workflow_name = self.workflow.name
+        # For each workflow:// in the command
+        for reference in self.get_references():
+            # Get the referenced task's workflow name (the default one if needed) and task name
+            workflow_name = reference.get_workflow_name(self.workflow.name)
+            task_name = reference.task_name
 
             # Extract the reference task object
-            if self.workflows is None:
-                task = self.workflow.find_task_by_name(workflow_name, task_name)
-            else:
-                for wf in self.workflows:
-                    task = wf.find_task_by_name(workflow_name, task_name)
-                    if task is not None:
-                        break
+            task = self.find_referenced_task(workflow_name, task_name)
 
             # Check if the refernced task is consistent
             if task is not None:
@@ -558,19 +821,12 @@ class Task(Thread):#estende la classe thread
                     self.add_transversal_point(task)
                 # Add the reference from the task
                 task.increment_reference_count()
+                # Keep the consumer of the file
+                task.workflow.lineage.add_input(self, task, reference.local_path)
                 # Extract the name of the file on which this file depends
-                #pos_file1 = pos1
-                i = 2
-                while True:
-                    if i < len(elements):
-                        current_element = elements[i]
-                        find_txt = current_element.find(".txt")
-                        if find_txt != -1:
-                            self.input_file.append(current_element)#preso file di input
-                            break
-                        i += 1
-                    else:
-                        break
+                input_file = reference.get_input_file()
+                if input_file is not None:
+                    self.input_file.append(input_file)#preso file di input
 
             if task is None:  # if is None means that task is from another WF maybe in the dagon service
                 #self.workflow.logger.debug("Adding transversal point")
@@ -588,9 +844,6 @@ class Task(Thread):#estende la classe thread
                 else:
                     raise ConnectionError("Dagon service is not available")
 
-            # Go to the next element
-            pos = pos2
-
     # Pre process command
     def pre_process_command(self, command):
         """
@@ -609,19 +862,10 @@ class Task(Thread):#estende la classe thread
         header = "#! /bin/bash\n"
         header = header + "# This is the DagOn launcher script\n\n"
         header = header + "code=0\n"
-        # Add and execute the howim script
-
-        context_script = header + "cd " + self.working_dir + "/.dagon\n"
-        context_script += header + self.get_how_im_script() + "\n\n"
 
-        result = self.on_execute(context_script, "context.sh")  # execute context script
-
-
-        if result['code']:
-            raise Exception(result['message'])
-        self.set_info(loads(result['output']))
-
-        
+        # Get the context of the machine, executing the howim script only if it is not cached
+        with self.account("context"):
+            self.discover_context(header)
 
         ### start the creation of the launcher.sh script
         # Create the header
@@ -632,58 +876,29 @@ class Task(Thread):#estende la classe thread
 
         # Create the body
         body = command
+        self.elements = []
+        fan_out = None
+        references = self.get_references(command)
 
-        # Index of the starting position
-        pos = 0
-
-        # Forever unless no anymore dagon.Workflow.SCHEMA are present
-        while True:
-
-            # Get the position of the next dagon.Workflow.SCHEcdMA
-            pos1 = command.find(dagon.Workflow.SCHEMA, pos)
-
-            # Check if there is no dagon.Workflow.SCHEMA
-            if pos1 == -1:
-                # Exit the forever cycle
-                break
-
-            # Find the first occurrent of a whitespace (or if no occurrence means the end of the string)
-            pos2 = command.find(" ", pos1)
-
-            # Check if this is the last referenced argument
-            if pos2 == -1:
-                pos2 = len(command)
+        # The command is executed by the tasks added to the workflow, they stage their own data
+        if self.is_expanded():
+            body = "echo \"Expanded in %d tasks\"" % len(self.expand())
+            references = []
 
+        # For each workflow:// in the command
+        for reference in references:
             # Extract the parameter string
-            arg = command[pos1:pos2]
-
-            # Remove the dagon.Workflow.SCHEMA label
-            arg = arg.replace(dagon.Workflow.SCHEMA, "")
-
-            # Split each argument in elements by the slash
-            elements = arg.split("/")
-
-            # Extract the referenced task's workflow name
-            workflow_name = elements[0]
+            arg = reference.arg
 
-            # The task name is the first element
-            task_name = elements[1]
+            # Get the referenced task's workflow name (the default one if needed) and task name
+            workflow_name = reference.get_workflow_name(self.workflow.name)
+            task_name = reference.task_name
 
             # Get the rest of the string as local path
-            local_path = arg.replace(workflow_name + "/" + task_name, "")
-
-            # Set the default workflow name if needed
-            if workflow_name is None or workflow_name == "":
-                workflow_name = self.workflow.name
+            local_path = reference.local_path
 
             # Extract the reference task object
-            # task = self.workflow.find_task_by_name(workflow_name, task_name)
-            if self.workflows is None:
-                task = self.workflow.find_task_by_name(workflow_name, task_name)
-            else:
-                for wf in self.workflows:
-                    task = wf.find_task_by_name(workflow_name, task_name)
-                    if task is not None: break
+            task = self.find_referenced_task(workflow_name, task_name)
 
             if task is None:  # if is None means that task is from another WF maybe in the dagon service
                 if self.workflow.is_api_available:
@@ -699,8 +914,12 @@ class Task(Thread):#estende la classe thread
                             'working_dir']  # if not, we add an extra path
                         ftp = FTP_API(host_ip)
                         task_folder = transversal_task['working_dir'].split("/")[-1]  # the last one is the task folder
-                        ftp.downloadFiles(task_folder, task_path)
                         # we need to download the data from the ftp host
+                        results = ftp.downloadFiles(task_folder, task_path)
+                        ftp.close()
+                        failed = [result for result in results if not result.is_ok()]
+                        if len(failed):
+                            raise Exception("Couldn't download %s: %s" % (failed[0].src, failed[0].error))
 
                     task = DagonTask(TaskType[transversal_task['type'].upper()], transversal_task['name'],
                                      transversal_task['command'],
@@ -711,67 +930,39 @@ class Task(Thread):#estende la classe thread
                 # Evaluate the destiation path
                 dst_path = self.working_dir + "/.dagon/inputs/" + workflow_name + "/" + task_name
 
-                # Create the destination directory
-                header = header + "\n\n# Create the destination directory\n"
-                header = header + "mkdir -p " + dst_path + "/" + path.dirname(local_path) + "\n"
-                header = header + "if [ $? -ne 0 ]; then code=1; fi\n\n"
-                # Add the move data command
-                header = header + stager.stage_in(self, task, dst_path, local_path)
-
-                if self.mode == "parallel":
-                    files = glob.glob(task.get_scratch_dir() + "/" + local_path)
-                    taskType = TaskType[type(self).__name__.upper()]
-
-                    for file in files:
-                        filename, _ = path.splitext(path.basename(file))
-                        taskParallelName = "{}_{}".format(self.name, filename)
-                        cmd = body.replace(dagon.Workflow.SCHEMA + arg, " workflow:///" + self.name + "/" + path.basename(file))
-
-                        if type(self) == dagon.batch.Batch:
-                            parallel_task = DagonTask(taskType, taskParallelName, cmd, 
-                                                      transversal_workflow=self.transversal_workflow)
-                        
-                        if type(self) == dagon.batch.RemoteBatch:
-                            parallel_task = DagonTask(taskType, taskParallelName, cmd, ssh_username=self.ssh_username, 
-                                                      keypath=self.keypath, ip=self.ip)
-
-                        elif type(self) == dagon.batch.Slurm:
-                            parallel_task = DagonTask(taskType, taskParallelName, cmd, partition=self.partition, 
-                                                      ntasks=self.ntasks, memory=self.memory)
-
-                        elif type(self) == dagon.batch.RemoteSlurm:
-                            parallel_task = DagonTask(taskType, taskParallelName, cmd, partition=self.partition, 
-                                                      ntasks=self.ntasks, memory=self.memory,
-                                                      ssh_username=self.ssh_username, keypath=self.keypath, ip=self.ip)
-
-                        elif type(self) == dagon.remote.CloudTask:
-                            parallel_task = DagonTask(taskType, taskParallelName, cmd, provider=self.provider, 
-                                                      ssh_username=self.ssh_username, key_options=self.key_options, 
-                                                      instance_id=self.instance_id, instance_flavour=self.instance_flavour, 
-                                                      instance_name=self.instance_name, stop_instance=self.stop_instance)
-
-                        elif type(self) == dagon.docker_task.DockerTask:
-                            parallel_task = DagonTask(taskType, taskParallelName, cmd, image=self.image, 
-                                                      container_id=self.container_id, remove=self.remove, 
-                                                      volume=self.volume, transversal_workflow=self.transversal_workflow)
-
-                        elif type(self) == dagon.docker_task.DockerRemoteTask:
-                            parallel_task = DagonTask(taskType, taskParallelName, cmd, image=self.image, 
-                                                      container_id=self.container_id, ssh_username=self.ssh_username, 
-                                                      keypath=self.keypath, ip=self.ip,
-                                                      remove=self.remove, volume=self.volume, 
-                                                      transversal_workflow=self.transversal_workflow)
-                        
-                        self.workflow.add_task(parallel_task)
-
-                    self.workflow.make_dependencies()
-
-                    body = "echo \"Starting parallel tasks...\"\n"
-                    body += "ln -sf " + dst_path + "/" + local_path + " " + self.get_scratch_dir()
-                else:
+                # The command is executed once per file by this task, each file is staged on its own
+                local_paths = [local_path]
+                if self.mode == "parallel" and self.FAN_OUT and fan_out is None:
+                    local_paths = ["/" + path.relpath(file, task.get_scratch_dir())
+                                   for file in sorted(glob.glob(task.get_scratch_dir() + "/" + local_path))]
+                    fan_out = (arg, [dst_path + staged_path for staged_path in local_paths])
+
+                for staged_path in local_paths:
+                    # Create the destination directory
+                    header = header + "\n\n# Create the destination directory\n"
+                    header = header + "mkdir -p " + dst_path + "/" + path.dirname(staged_path) + "\n"
+                    header = header + "if [ $? -ne 0 ]; then code=1; fi\n\n"
+                    # Add the move data command
+                    with self.account("staging"):
+                        header = header + stager.stage_in(self, task, dst_path, staged_path)
+
+                if fan_out is None or fan_out[0] != arg:
                     # Change the body of the command
                     body = body.replace(dagon.Workflow.SCHEMA + arg, dst_path + "/" + local_path)
-            pos = pos2
+
+        # Wait for the data transferred asynchronously
+        with self.account("staging"):
+            self.wait_pending_transfers(stager)
+
+        # Each element of the fan-out reads one of the files staged
+        if fan_out is not None:
+            arg, files = fan_out
+            for index, file in enumerate(files):
+                filename, _ = path.splitext(path.basename(file))
+                self.elements.append({"index": index, "name": "{}_{}".format(self.name, filename), "file": file,
+                                      "command": body.replace(dagon.Workflow.SCHEMA + arg, file),
+                                      "state": "PENDING", "exit_code": None})
+            body = "echo \"Starting %d parallel elements...\"" % len(self.elements)
 
         # Invoke the command
         header = header + "\n\n# Invoke the command\n"
@@ -779,6 +970,180 @@ class Task(Thread):#estende la classe thread
         header = header + "if [ $? -ne 0 ]; then code=1; fi"
         return header
 
+    def expand(self):
+        """
+        Add a task to the workflow for each item, or for each file matched by the first workflow:// reference
+        with a glob pattern (the first reference if none has it). The tasks are executed in a directory
+        under the scratch directory of this task
+
+        :return: tasks added
+        :rtype: list(:class:`dagon.task.Task`)
+        """
+        commands = []
+        if self.map_items is not None:
+            for index, item in enumerate(self.map_items):
+                commands.append(("{}_{}".format(self.name, index), self.command.replace(dagon.Workflow.ITEM,
+                                                                                       str(item))))
+        else:
+            references = self.get_references()
+            globbing = [reference for reference in references
+                        if any(c in reference.local_path for c in "*?[")] or references[:1]
+            if not len(globbing):
+                raise Exception("%s: There is no workflow:// reference to be expanded" % self.name)
+            reference = globbing[0]
+            task = self.find_referenced_task(reference.get_workflow_name(self.workflow.name), reference.task_name)
+            if task is None:
+                raise Exception("%s: Task %s not found" % (self.name, reference.task_name))
+            prefix = reference.arg[:len(reference.arg) - len(reference.local_path)]
+            for file in sorted(glob.glob(task.get_scratch_dir() + "/" + reference.local_path)):
+                filename, _ = path.splitext(path.basename(file))
+                # Each task references one of the files
+                commands.append(("{}_{}".format(self.name, filename),
+                                 self.command.replace(dagon.Workflow.SCHEMA + reference.arg, dagon.Workflow.SCHEMA +
+                                                      prefix + "/" + path.relpath(file, task.get_scratch_dir()))))
+
+        children = []
+        for name, command in commands:
+            child = self.make_child(name, command)
+            child.working_dir = self.working_dir + "/" + name
+            children.append(child)
+        self.workflow.expand(self, children, self.fan_out_limit)
+        self.workflow.logger.debug("%s: Expanded in %d tasks", self.name, len(children))
+        return children
+
+    def make_child(self, name, command):
+        """
+        Create a task of the same type and in the same place than this one
+
+        :param name: name of the task
+        :type name: str
+
+        :param command: command to be executed
+        :type command: str
+
+        :return: the task
+        :rtype: :class:`dagon.task.Task`
+        """
+        if type(self) == dagon.batch.Batch:
+            return DagonTask(TaskType.BATCH, name, command, transversal_workflow=self.transversal_workflow)
+
+        elif type(self) == dagon.batch.RemoteBatch:
+            return DagonTask(TaskType.BATCH, name, command, ssh_username=self.ssh_username, keypath=self.keypath,
+                             ip=self.ip)
+
+        elif type(self) == dagon.batch.Slurm:
+            return DagonTask(TaskType.SLURM, name, command, partition=self.partition, ntasks=self.ntasks,
+                             memory=self.memory)
+
+        elif type(self) == dagon.batch.RemoteSlurm:
+            return DagonTask(TaskType.SLURM, name, command, partition=self.partition, ntasks=self.ntasks,
+                             memory=self.memory, ssh_username=self.ssh_username, keypath=self.keypath, ip=self.ip)
+
+        elif type(self) == dagon.remote.CloudTask:
+            return DagonTask(TaskType.CLOUD, name, command, provider=self.provider, ssh_username=self.ssh_username,
+                             key_options=self.key_options, instance_id=self.instance_id,
+                             instance_flavour=self.instance_flavour, instance_name=self.instance_name,
+                             stop_instance=self.stop_instance)
+
+        elif type(self) == dagon.docker_task.DockerTask:
+            return DagonTask(TaskType.DOCKER, name, command, image=self.image, container_id=self.container_id,
+                             remove=self.remove, volume=self.volume, transversal_workflow=self.transversal_workflow)
+
+        elif type(self) == dagon.docker_task.DockerRemoteTask:
+            return DagonTask(TaskType.DOCKER, name, command, image=self.image, container_id=self.container_id,
+                             ssh_username=self.ssh_username, keypath=self.keypath, ip=self.ip, remove=self.remove,
+                             volume=self.volume, transversal_workflow=self.transversal_workflow)
+
+        raise Exception("%s: The tasks of type %s can't be expanded" % (self.name, type(self).__name__))
+
+    def get_host_info_key(self):
+        """
+        Returns the key used to cache the context of the machine where the task is executed
+
+        :return: host, user and task type
+        :rtype: tuple(str, str, str)
+        """
+        return socket.gethostname(), getpass.getuser(), type(self).__name__.lower()
+
+    def reuse_context_key(self, key_dir):
+        """
+        Copy the temporal SSH key generated by the context script of other task on the same machine
+
+        :param key_dir: directory where the key was generated
+        :type key_dir: str
+        """
+        for key_file in ["ssh_key", "ssh_key.pub"]:
+            shutil.copy2(key_dir + "/" + key_file, self.working_dir + "/.dagon/" + key_file)
+
+    def get_context_key_dir(self):
+        """
+        Returns a new directory where the temporal SSH key of a cached context is kept, outside of the scratch
+        directories so it is not removed with the scratch directory of the task which generated it
+
+        :return: path of the directory
+        :rtype: str
+        """
+        return self.workflow.get_scratch_dir_base() + "/.dagon-context/" + uuid4().hex
+
+    def keep_context_key(self, key_dir):
+        """
+        Copy the temporal SSH key generated by the context script to a directory reused by the following tasks
+
+        :param key_dir: directory where the key was generated
+        :type key_dir: str
+
+        :return: directory where the key is kept
+        :rtype: str
+        """
+        keep_dir = self.get_context_key_dir()
+        makedirs(keep_dir, mode=0o700, exist_ok=True)
+        for key_file in ["ssh_key", "ssh_key.pub"]:
+            shutil.copy2(key_dir + "/" + key_file, keep_dir + "/" + key_file)
+        return keep_dir
+
+    def discover_context(self, header):
+        """
+        Set the information of the machine where the task is executed. The context script is executed
+        only when the information is not in the host info cache of the workflow
+
+        :param header: header of the context script
+        :type header: str
+
+        :raises Exception: a problem occurred during the execution of the context script
+        """
+        cache = self.workflow.host_info
+        key = self.get_host_info_key()
+
+        # Only one task at a time discovers the context of a machine
+        with cache.get_lock(key):
+            entry = cache.get(key)
+            if entry is not None:
+                try:
+                    self.reuse_context_key(entry['key_dir'])
+                    self.set_info(dict(entry['info']))
+                    return
+                except Exception as e:
+                    self.workflow.logger.debug("%s: Cached context not valid: %s", self.name, e)
+                    cache.invalidate(key[0])
+
+            # Add and execute the howim script
+            context_script = header + "cd " + self.working_dir + "/.dagon\n"
+            context_script += header + self.get_how_im_script() + "\n\n"
+
+            result = self.on_execute(context_script, "context.sh")  # execute context script
+
+            if result['code']:
+                raise Exception(result['message'])
+            self.set_info(loads(result['output']))
+            if cache.ttl <= 0:
+                return
+            try:
+                key_dir = self.keep_context_key(self.working_dir + "/.dagon")
+            except Exception as e:
+                self.workflow.logger.debug("%s: Context not cached, the key couldn't be kept: %s", self.name, e)
+                return
+            cache.put(key, self.info, key_dir)
+
     # process the command to execute
     def include_command(self, body):
         """
@@ -786,7 +1151,11 @@ class Task(Thread):#estende la classe thread
         :param body: Script body
         :return: Script body with the command
         """
-        return body + " |tee " + self.working_dir + "/.dagon/stdout.txt\n"
+        if self.stream_output:
+            # The executor writes the output of the launcher to .dagon/stdout.txt
+            return body + "\n"
+        # The exit code of the command is kept, the tasks chained to a job depend on it
+        return "set -o pipefail\n{ " + body + "\n} |tee " + self.working_dir + "/.dagon/stdout.txt\n"
 
     # Post process the command
     def post_process_command(self, command):
@@ -892,61 +1261,32 @@ class Task(Thread):#estende la classe thread
         # Remove the reference
         # For each workflow:// in the command
 
-        # Index of the starting position
-        pos = 0
-
-        # Forever unless no anymore dagon.Workflow.SCHEMA are present
-        while True:
-            # Get the position of the next dagon.Workflow.SCHEMA
-            pos1 = self.command.find(dagon.Workflow.SCHEMA, pos)
-
-            # Check if there is no dagon.Workflow.SCHEMA
-            if pos1 == -1:
-                # Exit the forever cycle
-                break
-
-            # Find the first occurrent of a whitespace (or if no occurrence means the end of the string)
-            pos2 = self.command.find(" ", pos1)
-
-            # Check if this is the last referenced argument
-            if pos2 == -1:
-                pos2 = len(self.command)
-
-            # Extract the parameter string
-            arg = self.command[pos1:pos2]
-
-            # Remove the dagon.Workflow.SCHEMA label
-            arg = arg.replace(dagon.Workflow.SCHEMA, "")
-
-            # Split each argument in elements by the slash
-            elements = arg.split("/")
-
-            # Extract the referenced task's workflow name
-            workflow_name = elements[0]
-
-            # The task name is the first element
-            task_name = elements[1]
-
-            # Set the default workflow name if needed
-            if workflow_name is None or workflow_name == "":
-                workflow_name = self.workflow.name
-
+        tasks = []
+        for reference in self.get_references():
             # Extract the reference task object
-            # task = self.workflow.find_task_by_name(workflow_name, task_name)
-            if self.workflows is None:
-                task = self.workflow.find_task_by_name(workflow_name, task_name)
-            else:
-                for wf in self.workflows:
-                    task = wf.find_task_by_name(workflow_name, task_name)
-                    if task is not None: break
+            task = self.find_referenced_task(reference.get_workflow_name(self.workflow.name),
+                                             reference.task_name)
 
             # Check if the refernced task is consistent
             if task is not None:
-                # Remove the reference from the task
-                task.decrement_reference_count()
+                tasks.append(task)
+
+        # Remove the files nobody else has to read
+        lineages = []
+        for task in tasks:
+            if task.workflow.lineage not in lineages:
+                lineages.append(task.workflow.lineage)
+        for lineage in lineages:
+            for task, file_path in lineage.finish(self):
+                if task.remove_scratch_dir is True:
+                    task.remove_intermediate(file_path)
 
-            # Go to the next element
-            pos = pos2
+        for task in tasks:
+            # Remove the reference from the task
+            task.decrement_reference_count()
+
+        # The directories waiting for this task can be removed now
+        self.workflow.scratch.collect()
 
     # Method execute
     def execute(self):
@@ -955,6 +1295,24 @@ class Task(Thread):#estende la classe thread
 
         :raises Exception: a problem occurred during the task  execution
         """
+        if self.ready_time is not None:
+            self.add_overhead("scheduling", time() - self.ready_time)
+
+        # Wait until the scratch directories are under the quota
+        self.workflow.scratch.wait_for_quota(self)
+        try:
+            self.execute_job()
+        finally:
+            self.workflow.scratch.add_usage(self)
+
+    def execute_job(self):
+        """
+        Create the scratch directory, stage in the data and invoke the executor
+
+        :raises Exception: a problem occurred during the task  execution
+        """
+        start_time = time()
+        nested = self.overhead.get("context", 0.0) + self.overhead.get("staging", 0.0)
         self.create_working_dir()
 
         # Apply some command pre processing
@@ -962,18 +1320,31 @@ class Task(Thread):#estende la classe thread
         # Apply some command post processing
         launcher_script = self.post_process_command(launcher_script)
 
+        # The context discovery and the staging are accounted by their own
+        nested = self.overhead.get("context", 0.0) + self.overhead.get("staging", 0.0) - nested
+        self.add_overhead("script", time() - start_time - nested)
+
         # Execute only if not dry
         if self.workflow.dry is False:
             # Invoke the actual executor
             start_time = time()
             self.result = self.on_execute(launcher_script, "launcher.sh")
+            self.add_overhead("execution", time() - start_time)
             self.workflow.logger.debug("%s Completed in %s seconds ---" % (self.name, (time() - start_time)))
             #print(self.result)
             # Check if the execution failed
             if self.result['code']:
                 raise Exception('Executable raised a execption ' + self.result['message'])
 
-        self.remove_reference_workflow()
+            # Execute the command once per file in parallel mode
+            if self.FAN_OUT and len(self.elements):
+                start_time = time()
+                self.result = self.execute_elements()
+                self.add_overhead("execution", time() - start_time)
+                self.workflow.logger.debug("%s: %d elements completed in %s seconds", self.name,
+                                           len(self.elements), time() - start_time)
+                if self.result['code']:
+                    raise Exception('Executable raised a execption ' + self.result['message'])
 
     def run(self):
         """
@@ -1005,6 +1376,11 @@ class Task(Thread):#estende la classe thread
                             break
                         else:
                             sleep(.5)
+                elif self.chains_to(task):
+                    # The dependency is resolved by the system executing both tasks
+                    while not task.is_submitted() and task.status != dagon.Status.FINISHED and \
+                            task.status != dagon.Status.FAILED:
+                        sleep(.5)
                 else:
                     while True:
                         if task.status == dagon.Status.WAITING or task.status == dagon.Status.READY:  # if this happends, the workflow is probably a meta-workflow
@@ -1017,16 +1393,29 @@ class Task(Thread):#estende la classe thread
             for task in self.prevs:
                 if task.status == dagon.Status.FAILED:
                     self.set_status(dagon.Status.FAILED)
+                    self.remove_reference_workflow()
                     return
 
+            # Wait until less tasks added by the same expansion are running than its limit
+            if self.expansion is not None:
+                self.expansion.acquire()
+
             # Change the status
+            self.mark_ready()
             self.set_status(dagon.Status.RUNNING)
             # Execute the task Job
             self.workflow.logger.debug("%s: Executing...", self.name)
-            # self.semaphore.acquire()
-            self.execute()
-            sleep(2)
-            # self.semaphore.release()
+            try:
+                with self.slot_manager.hold(self):
+                    self.execute()
+            except Exception:
+                self.set_status(dagon.Status.FAILED)
+                # The references are removed once the task ended, not before its dependents staged
+                self.remove_reference_workflow()
+                raise
+            finally:
+                if self.expansion is not None:
+                    self.expansion.release()
             """try:
                 self.workflow.logger.debug("%s: Executing...", self.name)
                 self.execute()
@@ -1048,6 +1437,7 @@ class Task(Thread):#estende la classe thread
             # Change the status
             # self.workflow.api.update_task(self.workflow.workflow_id, self.name, "working_dir", self.working_dir)
             self.set_status(dagon.Status.FINISHED)
+            self.remove_reference_workflow()
             return
 
     def get_public_key(self):
@@ -1078,45 +1468,11 @@ class Task(Thread):#estende la classe thread
         # Remove the reference
         # For each workflow:// in the command
 
-        # Index of the starting position
-        pos = 0
         temp = self.command
-        while True:
-            # Get the position of the next dagon.Workflow.SCHEMA
-            pos1 = self.command.find(dagon.Workflow.SCHEMA, pos)
-
-            # Check if there is no dagon.Workflow.SCHEMA
-            if pos1 == -1:
-                # Exit the forever cycle
-                break
-
-            # Find the first occurrent of a whitespace (or if no occurrence means the end of the string)
-            pos2 = self.command.find(" ", pos1)
-
-            # Check if this is the last referenced argument
-            if pos2 == -1:
-                pos2 = len(self.command)
-
-            # Extract the parameter string
-            arg = self.command[pos1:pos2]
-
-            # Remove the dagon.Workflow.SCHEMA label
-            arg = arg.replace(dagon.Workflow.SCHEMA, "")
-
-            # Split each argument in elements by the slash
-            elements = arg.split("/")
-
-            # Extract the referenced task's workflow name
-            workflow_name = elements[0]
-
-            # Set the default workflow name if needed
-            if workflow_name is None or workflow_name == "":
-                pass
-            else:
-                temp = temp.replace(workflow_name, "")
-
-            # Go to the next element
-            pos = pos2
+        for reference in self.get_references():
+            # Remove the workflow name if it is not the default one
+            if reference.workflow_name is not None and reference.workflow_name != "":
+                temp = temp.replace(reference.workflow_name, "")
         return temp
 
     def get_how_im_script(self):
@@ -0,0 +1,219 @@
+import threading
+from time import time, sleep
+
+import pytest
+
+from dagon.communication.data_transfer import GlobusManager
+
+
+class FakeTransferClient(object):
+    """
+    Transfer client keeping the transfers in memory. The tests decide when the files are transferred and
+    when the transfers end
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.transfers = {}
+        self.order = []
+        self.cancelled = []
+        self.cancel_error = None
+
+    def submit_transfer(self, data):
+        with self.lock:
+            task_id = "task-%d" % (len(self.order) + 1)
+            self.transfers[task_id] = {"source": data["source_endpoint"], "destination": data["destination_endpoint"],
+                                       "items": [(item["source_path"], item["destination_path"])
+                                                 for item in data["DATA"]],
+                                       "status": "ACTIVE", "nice_status": "OK", "transferred": []}
+            self.order.append(task_id)
+            return {"task_id": task_id}
+
+    def get_task(self, task_id):
+        with self.lock:
+            transfer = self.transfers[task_id]
+            return {"status": transfer['status'], "nice_status": transfer['nice_status']}
+
+    def task_successful_transfers(self, task_id, marker=None):
+        # One record per page, to go through the markers
+        with self.lock:
+            transferred = self.transfers[task_id]['transferred']
+            start = int(marker) if marker is not None else 0
+            next_marker = str(start + 1) if start + 1 < len(transferred) else None
+            return {"DATA": [{"destination_path": path} for path in transferred[start:start + 1]],
+                    "next_marker": next_marker}
+
+    def cancel_task(self, task_id):
+        self.cancelled.append(task_id)
+        if self.cancel_error is not None:
+            raise self.cancel_error
+
+    def get(self, index):
+        with self.lock:
+            return self.order[index], self.transfers[self.order[index]]
+
+    def transfer(self, task_id, destination_path):
+        with self.lock:
+            self.transfers[task_id]['transferred'].append(destination_path)
+
+    def end(self, task_id, status, nice_status="OK"):
+        with self.lock:
+            self.transfers[task_id]['status'] = status
+            self.transfers[task_id]['nice_status'] = nice_status
+
+
+def wait_until(condition, timeout=5):
+    deadline = time() + timeout
+    while not condition():
+        if time() > deadline:
+            raise AssertionError("Timeout waiting for the condition")
+        sleep(0.01)
+
+
+@pytest.fixture
+def client():
+    return FakeTransferClient()
+
+
+def make_manager(client, intermediate=None, timeout=None):
+    return GlobusManager("client-id", intermediate, token_file="/nonexistent/tokens.json", transfer_client=client,
+                         batch_delay=0.1, poll_interval=0.05, timeout=timeout)
+
+
+def test_items_are_batched_per_pair_of_endpoints(client):
+    manager = make_manager(client)
+    items = [manager.submit("ep-a", "ep-b", "/src/f%d" % i, "/dst/f%d" % i) for i in range(3)]
+    items.append(manager.submit("ep-a", "ep-c", "/src/g", "/dst/g"))
+
+    wait_until(lambda: len(client.order) == 2)
+    transfers = sorted((t['destination'], len(t['items'])) for t in client.transfers.values())
+    assert transfers == [("ep-b", 3), ("ep-c", 1)]
+    assert manager.get_metrics()['submitted'] == 2
+
+    for task_id in list(client.order):
+        client.end(task_id, "SUCCEEDED")
+    assert all(item.wait(5).is_ok() for item in items)
+
+
+def test_items_are_released_as_their_files_are_transferred(client):
+    manager = make_manager(client)
+    items = [manager.submit("ep-a", "ep-b", "/src/f%d" % i, "/dst/f%d" % i) for i in range(3)]
+    wait_until(lambda: len(client.order) == 1)
+    task_id, _ = client.get(0)
+
+    client.transfer(task_id, "/dst/f0")
+    client.transfer(task_id, "/dst/f2")
+    assert items[0].wait(5).is_ok()
+    assert items[2].wait(5).is_ok()
+    assert not items[1].done()
+
+    client.end(task_id, "SUCCEEDED")
+    assert items[1].wait(5).is_ok()
+    assert manager.get_metrics()['active'] == 0
+
+
+def test_files_go_through_the_intermediate_endpoint(client):
+    manager = make_manager(client, intermediate="ep-i")
+    first = manager.submit("ep-a", "ep-b", "/run1/output.txt", "/dst1/output.txt")
+    second = manager.submit("ep-a", "ep-b", "/run2/output.txt", "/dst2/output.txt")
+
+    wait_until(lambda: len(client.order) == 1)
+    task_id, transfer = client.get(0)
+    assert (transfer['source'], transfer['destination']) == ("ep-a", "ep-i")
+    intermediate_paths = [dst for _, dst in transfer['items']]
+    # Files with the same name don't share the intermediate path
+    assert len(set(intermediate_paths)) == 2
+    assert all(path.endswith("output.txt") for path in intermediate_paths)
+
+    # Only the first file reached the intermediate endpoint
+    client.transfer(task_id, intermediate_paths[0])
+    wait_until(lambda: len(client.order) == 2)
+    hop_id, hop = client.get(1)
+    assert (hop['source'], hop['destination']) == ("ep-i", "ep-b")
+    assert hop['items'] == [(intermediate_paths[0], "/dst1/output.txt")]
+    assert not first.done() and not second.done()
+
+    client.end(hop_id, "SUCCEEDED")
+    result = first.wait(5)
+    assert result.is_ok()
+    assert (result.src, result.dst) == ("/run1/output.txt", "/dst1/output.txt")
+    assert not second.done()
+
+
+def test_failed_transfer_releases_its_items_with_the_error(client):
+    manager = make_manager(client)
+    items = [manager.submit("ep-a", "ep-b", "/src/f%d" % i, "/dst/f%d" % i) for i in range(2)]
+    wait_until(lambda: len(client.order) == 1)
+    task_id, _ = client.get(0)
+
+    client.transfer(task_id, "/dst/f0")
+    assert items[0].wait(5).is_ok()
+    client.end(task_id, "FAILED", "PERMISSION_DENIED")
+    result = items[1].wait(5)
+    assert not result.is_ok()
+    assert "PERMISSION_DENIED" in result.error
+
+
+def test_failed_item_does_not_fail_the_other_tasks_of_the_batch(client):
+    manager = make_manager(client)
+    first_task = [manager.submit("ep-a", "ep-b", "/src/f%d" % i, "/dst/f%d" % i) for i in range(2)]
+    second_task = manager.submit("ep-a", "ep-b", "/src/missing", "/dst/missing")
+    wait_until(lambda: len(client.order) == 1)
+    task_id, transfer = client.get(0)
+    assert len(transfer['items']) == 3
+
+    # The batch fails right after a file was transferred, before a poll saw it
+    with client.lock:
+        client.transfers[task_id]['transferred'].append("/dst/f0")
+        client.transfers[task_id]['status'] = "FAILED"
+        client.transfers[task_id]['nice_status'] = "FILE_NOT_FOUND"
+    assert first_task[0].wait(5).is_ok()
+
+    # The items not transferred are submitted again on their own
+    wait_until(lambda: len(client.order) == 3)
+    retries = dict((client.get(i)[1]['items'][0][1], client.get(i)[0]) for i in (1, 2))
+    assert sorted(retries) == ["/dst/f1", "/dst/missing"]
+    assert not first_task[1].done() and not second_task.done()
+
+    client.end(retries["/dst/missing"], "FAILED", "FILE_NOT_FOUND")
+    client.end(retries["/dst/f1"], "SUCCEEDED")
+    assert first_task[1].wait(5).is_ok()
+    result = second_task.wait(5)
+    assert not result.is_ok()
+    assert "FILE_NOT_FOUND" in result.error
+    assert manager.get_metrics()['active'] == 0
+
+
+def test_not_a_directory_cancels_the_transfer(client):
+    manager = make_manager(client)
+    item = manager.submit("ep-a", "ep-b", "/src/f", "/dst/f")
+    wait_until(lambda: len(client.order) == 1)
+    task_id, _ = client.get(0)
+
+    client.end(task_id, "ACTIVE", "NOT_A_DIRECTORY")
+    result = item.wait(5)
+    assert "NOT_A_DIRECTORY" in result.error
+    assert client.cancelled == [task_id]
+
+
+def test_errors_do_not_stop_the_manager(client):
+    manager = make_manager(client)
+    client.cancel_error = RuntimeError("cancel failed")
+    item = manager.submit("ep-a", "ep-b", "/src/f", "/dst/f")
+    wait_until(lambda: len(client.order) == 1)
+    client.end(client.get(0)[0], "ACTIVE", "NOT_A_DIRECTORY")
+    assert "NOT_A_DIRECTORY" in item.wait(5).error
+
+    item = manager.submit("ep-a", "ep-b", "/src/g", "/dst/g")
+    wait_until(lambda: len(client.order) == 2)
+    client.end(client.get(1)[0], "SUCCEEDED")
+    assert item.wait(5).is_ok()
+    assert manager.thread.is_alive()
+
+
+def test_result_fails_when_the_timeout_expires(client):
+    manager = make_manager(client, timeout=0.3)
+    item = manager.submit("ep-a", "ep-b", "/src/f", "/dst/f")
+    result = item.get_result()
+    assert not result.is_ok()
+    assert "Timeout" in result.error
@@ -0,0 +1,271 @@
+import os
+import stat
+import subprocess
+from time import time, sleep
+
+import pytest
+
+from dagon.slurm import SlurmMonitor
+
+
+# Shims of the Slurm commands. The jobs never run: the tests write what squeue, sacct and scontrol report
+# for each job in the state directory, and every call is appended to its log
+SHIMS = {
+    "sbatch": """#!/bin/bash
+echo "sbatch $*" >> "$SLURM_SHIM_DIR/log"
+array=""
+for arg in "$@"; do
+    case "$arg" in
+        --array=*) array=${arg#--array=};;
+        *fail.sh) echo "sbatch: error: Batch job submission failed: Invalid account" >&2; exit 1;;
+    esac
+done
+id=$(( $(cat "$SLURM_SHIM_DIR/next" 2>/dev/null || echo 100) + 1 ))
+echo $id > "$SLURM_SHIM_DIR/next"
+[ -n "$array" ] && echo "$array" > "$SLURM_SHIM_DIR/$id.array"
+echo "$id;cluster"
+""",
+    "squeue": """#!/bin/bash
+echo "squeue $*" >> "$SLURM_SHIM_DIR/log"
+ids=${@: -1}
+for id in ${ids//,/ }; do
+    [ -f "$SLURM_SHIM_DIR/$id.squeue" ] && cat "$SLURM_SHIM_DIR/$id.squeue"
+done
+exit 0
+""",
+    "sacct": """#!/bin/bash
+echo "sacct $*" >> "$SLURM_SHIM_DIR/log"
+if [ -f "$SLURM_SHIM_DIR/no-accounting" ]; then
+    echo "sacct: error: Slurm accounting storage is disabled" >&2
+    exit 1
+fi
+ids=${@: -1}
+for id in ${ids//,/ }; do
+    [ -f "$SLURM_SHIM_DIR/$id.sacct" ] && cat "$SLURM_SHIM_DIR/$id.sacct"
+done
+exit 0
+""",
+    "scontrol": """#!/bin/bash
+echo "scontrol $*" >> "$SLURM_SHIM_DIR/log"
+if [ "$1 $2" = "show config" ]; then
+    cat "$SLURM_SHIM_DIR/config" 2>/dev/null
+    exit $?
+fi
+id=${@: -1}
+if [ ! -f "$SLURM_SHIM_DIR/$id.scontrol" ]; then
+    echo "slurm_load_jobs error: Invalid job id specified" >&2
+    exit 1
+fi
+cat "$SLURM_SHIM_DIR/$id.scontrol"
+"""
+}
+
+
+class Shims(object):
+    """
+    Slurm commands on the PATH of the commands executed by the monitors, and the state they report
+    """
+
+    def __init__(self, bin_dir, directory):
+        self.directory = str(directory)
+        self.env = dict(os.environ, PATH=str(bin_dir) + os.pathsep + os.environ["PATH"],
+                        SLURM_SHIM_DIR=self.directory)
+        self.monitors = []
+
+    def execute(self, command):
+        process = subprocess.run(["bash", "-c", command], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 universal_newlines=True, env=self.env)
+        return process.returncode, process.stdout, process.stderr
+
+    def monitor(self, execute=None):
+        monitor = SlurmMonitor(execute or self.execute, poll_interval=0.05)
+        self.monitors.append(monitor)
+        return monitor
+
+    def stop(self):
+        # The monitor threads never end, they are left without jobs to poll
+        for monitor in self.monitors:
+            with monitor.condition:
+                monitor.jobs.clear()
+
+    def set(self, job_id, command, text):
+        with open(os.path.join(self.directory, "%s.%s" % (job_id, command)), "w") as f:
+            f.write(text)
+
+    def clear(self, job_id, command):
+        os.remove(os.path.join(self.directory, "%s.%s" % (job_id, command)))
+
+    def set_config(self, text):
+        with open(os.path.join(self.directory, "config"), "w") as f:
+            f.write(text)
+
+    def disable_accounting(self):
+        open(os.path.join(self.directory, "no-accounting"), "w").close()
+
+    def calls(self, command):
+        log = os.path.join(self.directory, "log")
+        if not os.path.exists(log):
+            return []
+        with open(log) as f:
+            return [line.split(" ", 1)[1].strip() for line in f if line.startswith(command + " ")]
+
+
+@pytest.fixture
+def shims(tmp_path):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    state_dir = tmp_path / "state"
+    state_dir.mkdir()
+    for name, text in SHIMS.items():
+        shim = bin_dir / name
+        shim.write_text(text)
+        shim.chmod(shim.stat().st_mode | stat.S_IXUSR)
+    shims = Shims(bin_dir, state_dir)
+    yield shims
+    shims.stop()
+
+
+def wait_until(condition, timeout=5):
+    deadline = time() + timeout
+    while not condition():
+        if time() > deadline:
+            raise AssertionError("Timed out waiting for the condition")
+        sleep(0.01)
+
+
+def test_submit_batches_the_jobs(shims):
+    commands = []
+
+    def counting_execute(command):
+        commands.append(command)
+        return shims.execute(command)
+
+    monitor = shims.monitor(counting_execute)
+    jobs = [monitor.submit("sbatch --parsable job%d.sh" % i, "task%d" % i) for i in range(3)]
+
+    assert [job.wait_submitted(5) for job in jobs] == ["101", "102", "103"]
+    assert len(shims.calls("sbatch")) == 3
+    assert len([command for command in commands if "sbatch" in command]) == 1
+    assert monitor.get_metrics()['submitted'] == 3
+    assert all(job.state == "PENDING" and not job.done() for job in jobs)
+
+
+def test_poll_queries_all_the_jobs_at_once(shims):
+    monitor = shims.monitor()
+    ids = ["101", "102", "103"]
+    for job_id in ids:
+        shims.set(job_id, "squeue", "%s RUNNING\n" % job_id)
+    jobs = [monitor.submit("sbatch --parsable job%d.sh" % i) for i in range(3)]
+    assert [job.wait_submitted(5) for job in jobs] == ids
+
+    wait_until(lambda: all(job.state == "RUNNING" for job in jobs))
+    wait_until(lambda: len(shims.calls("squeue")) >= 2)
+    assert all(call.endswith("-j " + ",".join(ids)) for call in shims.calls("squeue"))
+    assert not len(shims.calls("sacct"))
+
+    shims.clear(ids[0], "squeue")
+    shims.set(ids[0], "sacct", "%s|COMPLETED|0:0\n" % ids[0])
+    shims.clear(ids[1], "squeue")
+    shims.set(ids[1], "sacct", "%s|FAILED|2:0\n" % ids[1])
+
+    assert jobs[0].wait(5)['code'] == 0
+    result = jobs[1].wait(5)
+    assert result['code'] == 1
+    assert (result['state'], result['exit_code'], result['job_id']) == ("FAILED", 2, ids[1])
+    assert not jobs[2].done()
+    # The job still queued is not asked to the accounting
+    assert all(ids[2] not in call for call in shims.calls("sacct"))
+    metrics = monitor.get_metrics()
+    assert (metrics['completed'], metrics['failed'], metrics['active']) == (1, 1, 1)
+
+
+def test_array_elements(shims):
+    monitor = shims.monitor()
+    job = monitor.submit("sbatch --parsable --array=0-2 array.sh")
+    job_id = job.wait_submitted(5)
+    shims.set(job_id, "squeue", "%s_0 RUNNING\n%s_[1-2] PENDING\n" % (job_id, job_id))
+
+    wait_until(lambda: job.elements.get(0) == ("RUNNING", None))
+
+    shims.set(job_id, "squeue", "%s_2 RUNNING\n" % job_id)
+    shims.set(job_id, "sacct", "%s_0|COMPLETED|0:0\n%s_1|COMPLETED|0:0\n" % (job_id, job_id))
+    wait_until(lambda: job.elements.get(2) == ("RUNNING", None))
+    assert not job.done()
+
+    # An array with elements still running has not ended, even out of the queue
+    shims.clear(job_id, "squeue")
+    shims.set(job_id, "sacct", "%s_0|COMPLETED|0:0\n%s_1|COMPLETED|0:0\n%s_2|RUNNING|0:0\n" %
+              (job_id, job_id, job_id))
+    wait_until(lambda: len(shims.calls("sacct")) >= 2)
+    assert not job.done()
+
+    shims.set(job_id, "sacct", "%s_0|COMPLETED|0:0\n%s_1|COMPLETED|0:0\n%s_2|FAILED|3:0\n" %
+              (job_id, job_id, job_id))
+    result = job.wait(5)
+    assert (result['state'], result['exit_code']) == ("FAILED", 3)
+    assert job.elements == {0: ("COMPLETED", 0), 1: ("COMPLETED", 0), 2: ("FAILED", 3)}
+
+
+def test_final_state_from_scontrol_without_accounting(shims):
+    shims.disable_accounting()
+    monitor = shims.monitor()
+    done, failed = monitor.submit("sbatch --parsable a.sh"), monitor.submit("sbatch --parsable b.sh")
+    done_id, failed_id = done.wait_submitted(5), failed.wait_submitted(5)
+    shims.set(done_id, "scontrol", "JobId=%s JobName=a.sh JobState=COMPLETED Reason=None ExitCode=0:0\n" % done_id)
+    shims.set(failed_id, "scontrol", "JobId=%s JobName=b.sh JobState=TIMEOUT Reason=TimeLimit ExitCode=0:15\n" %
+              failed_id)
+
+    assert done.wait(5)['code'] == 0
+    result = failed.wait(5)
+    assert (result['code'], result['state'], result['exit_code']) == (1, "TIMEOUT", 0)
+    assert len(shims.calls("sacct")) >= 1
+    assert {call.split()[-1] for call in shims.calls("scontrol")} == {done_id, failed_id}
+
+
+def test_max_array_size(shims):
+    shims.set_config("Configuration data as of 2024-01-01T00:00:00\nMaxArraySize            = 40001\n"
+                     "MaxJobCount             = 10000\n")
+    monitor = shims.monitor()
+    assert monitor.get_max_array_size() == 40001
+    assert monitor.get_max_array_size() == 40001
+    assert len(shims.calls("scontrol")) == 1
+
+
+def test_max_array_size_default(shims):
+    assert shims.monitor().get_max_array_size() == SlurmMonitor.MAX_ARRAY_SIZE
+
+
+def test_submission_failure(shims):
+    monitor = shims.monitor()
+    good, bad = monitor.submit("sbatch --parsable good.sh"), monitor.submit("sbatch --parsable fail.sh")
+
+    assert bad.wait_submitted(5) is None
+    result = bad.wait(5)
+    assert result['code'] == 1
+    assert result['state'] == "FAILED"
+    assert "Invalid account" in result['message']
+    assert good.wait_submitted(5) == "101"
+    assert not good.done()
+
+
+def test_execute_error_fails_the_batch(shims):
+    failures = {"left": 1}
+
+    def broken_execute(command):
+        if failures['left']:
+            failures['left'] -= 1
+            raise IOError("Socket is closed")
+        return shims.execute(command)
+
+    monitor = shims.monitor(broken_execute)
+    job = monitor.submit("sbatch --parsable job.sh")
+    result = job.wait(5)
+    assert result['code'] == 1
+    assert "Socket is closed" in result['message']
+
+    # The monitor keeps working after the error
+    job = monitor.submit("sbatch --parsable job.sh")
+    job_id = job.wait_submitted(5)
+    shims.set(job_id, "sacct", "%s|COMPLETED|0:0\n" % job_id)
+    assert job.wait(5)['code'] == 0
+    assert monitor.thread.is_alive()